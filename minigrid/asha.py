@@ -0,0 +1,161 @@
+"""
+Successive-halving scheduler over the rows of an experiment csv (same format as run-task.sh).
+
+Every configuration (csv row) is trained for every seed up to a first timestep budget,
+configurations are ranked on a metric averaged over seeds, and only the top
+1/reduction_factor are promoted to the next budget, resuming from their checkpoints.
+
+    python asha.py --experiments experiments/exp-2.csv --seeds 1-10 --metric average_eat_count \
+        --min-timesteps 2000000 --reduction-factor 3 --max-parallel 16 --cuda false
+"""
+import os
+import sys
+import csv
+import json
+import math
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from utils import strtobool
+
+# csv column -> train.py option, as in run-task.sh
+CSV_OPTIONS = ["env_id", "total_timesteps", "num_steps", "ent_coef", "time_cost", "action_cost",
+               "final_reward_penalty", "cont_energy_wrapper", "time_bonus", "box_reward",
+               "refuel_goal", "initial_energy", "gae_lambda"]
+
+
+def read_experiments(path):
+    with open(path) as f:
+        return [row for row in csv.DictReader(f)]
+
+def rung_budgets(min_timesteps, max_timesteps, reduction_factor):
+    """Timestep budgets min, min*eta, min*eta^2, ... capped by (and ending at) max."""
+    budgets = []
+    budget = min_timesteps
+    while budget < max_timesteps:
+        budgets.append(int(budget))
+        budget *= reduction_factor
+    return budgets + [int(max_timesteps)]
+
+def trial_name(args, row_idx, seed):
+    experiment = os.path.splitext(os.path.basename(args.experiments))[0]
+    return f"asha_{experiment}_{row_idx}_{seed}"
+
+def trial_command(args, row, row_idx, seed, budget, resume):
+    name = trial_name(args, row_idx, seed)
+    command = [sys.executable, "-u", "train.py"]
+    for key in CSV_OPTIONS:
+        value = budget if key == "total_timesteps" else row[key]
+        command += [f"--{key.replace('_', '-')}", str(value)]
+    wandb = args.wandb and row["wandb_project"] != ""
+    command += ["--wandb", str(wandb).lower(), "--verbose", "false", "--cuda", str(args.cuda).lower(),
+                "--seed", str(seed), "--exp-name", name,
+                "--checkpoint-path", f"trained-models/{row['env_id']}/checkpoint_{name}.pt", "--resume", str(resume).lower(),
+                "--summary-path", os.path.join(args.output_dir, f"{name}.json")]
+    if wandb:
+        command += ["--wandb-project", row["wandb_project"]]
+    return command + args.train_args
+
+def run_trial(args, row, row_idx, seed, budget, resume):
+    """
+    Trains one trial up to `budget` timesteps and returns its metric. Trials of the first
+    rung start from scratch, overwriting the checkpoints of an earlier sweep, the promoted
+    ones resume from their checkpoint.
+    """
+    name = trial_name(args, row_idx, seed)
+    summary_path = os.path.join(args.output_dir, f"{name}.json")
+    if not resume and os.path.exists(summary_path):
+        # summary of an earlier sweep, a promoted trial already at its budget keeps the one of its last rung
+        os.remove(summary_path)
+    with open(os.path.join(args.output_dir, f"{name}.log"), "a") as log:
+        result = subprocess.run(trial_command(args, row, row_idx, seed, budget, resume), stdout=log, stderr=subprocess.STDOUT)
+    if result.returncode != 0 or not os.path.exists(summary_path):
+        print(f"Trial {name} failed at budget {budget} (see its log)")
+        return float("nan")
+    with open(summary_path) as f:
+        return json.load(f).get(args.metric, float("nan"))
+
+def mean_score(values):
+    """Mean over seeds ignoring failed (nan) trials, nan if every trial failed."""
+    values = np.asarray(values, dtype=float)
+    return float("nan") if np.all(np.isnan(values)) else float(np.nanmean(values))
+
+def successive_halving(args):
+    rows = read_experiments(args.experiments)
+    start_seed, end_seed = map(int, args.seeds.split("-"))
+    seeds = list(range(start_seed, end_seed + 1))
+    max_timesteps = args.max_timesteps or max(int(row["total_timesteps"]) for row in rows)
+    budgets = rung_budgets(args.min_timesteps, max_timesteps, args.reduction_factor)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    alive = list(range(len(rows)))
+    history = []
+    for rung, budget in enumerate(budgets):
+        print(f"\nRung {rung}: {len(alive)} configurations x {len(seeds)} seeds up to {budget} timesteps")
+        trials = [(row_idx, seed) for row_idx in alive for seed in seeds]
+        with ThreadPoolExecutor(max_workers=args.max_parallel) as pool:
+            # a row never trains past its own total_timesteps
+            results = list(pool.map(lambda t: run_trial(args, rows[t[0]], t[0], t[1],
+                                                        min(budget, int(rows[t[0]]["total_timesteps"])), resume=rung > 0), trials))
+
+        scores = {}
+        for (row_idx, seed), value in zip(trials, results):
+            scores.setdefault(row_idx, []).append(value)
+        # best first, failed trials (nan) rank last
+        def rank_key(row_idx):
+            score = mean_score(scores[row_idx])
+            return math.inf if math.isnan(score) else (-score if args.mode == "max" else score)
+        ranking = sorted(alive, key=rank_key)
+        for position, row_idx in enumerate(ranking):
+            values = np.array(scores[row_idx])
+            print(f"  {position+1:>3}. row {row_idx:>3} {args.metric} = {mean_score(values):.4f} "
+                  f"({np.sum(~np.isnan(values))}/{len(values)} seeds)  "
+                  f"{', '.join(f'{k}={rows[row_idx][k]}' for k in CSV_OPTIONS if k != 'total_timesteps')}")
+        history.append({"rung": rung, "budget": budget,
+                        "scores": {str(i): scores[i] for i in alive}, "ranking": ranking})
+
+        if rung < len(budgets) - 1:
+            alive = ranking[:max(1, math.ceil(len(ranking) / args.reduction_factor))]
+
+        with open(os.path.join(args.output_dir, "state.json"), "w") as f:
+            json.dump({"experiments": args.experiments, "metric": args.metric, "seeds": seeds,
+                       "budgets": budgets, "rungs": history}, f, indent=2)
+
+    print(f"\nBest configuration: row {history[-1]['ranking'][0]} "
+          f"({', '.join(f'{k}={v}' for k, v in rows[history[-1]['ranking'][0]].items())})")
+    return history
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Successive-halving scheduler for experiment csv files")
+    parser.add_argument("--experiments", type=str, required=True,
+                        help="experiment csv (one configuration per row, as used by run-experiments.sh)")
+    parser.add_argument("--seeds", type=str, default="1-5",
+                        help="range of seeds trained per configuration, like '1-5'")
+    parser.add_argument("--metric", type=str, default="average_return",
+                        choices=["average_return", "success_rate", "average_eat_count"],
+                        help="train.py summary metric the configurations are ranked on (mean over seeds)")
+    parser.add_argument("--mode", type=str, default="max", choices=["max", "min"])
+    parser.add_argument("--min-timesteps", type=int, default=2000000,
+                        help="budget of the first rung")
+    parser.add_argument("--max-timesteps", type=int, default=None,
+                        help="budget of the last rung (largest total_timesteps in the csv by default)")
+    parser.add_argument("--reduction-factor", type=int, default=3,
+                        help="budgets grow and configurations shrink by this factor each rung")
+    parser.add_argument("--max-parallel", type=int, default=4,
+                        help="number of trials trained at the same time")
+    parser.add_argument("--cuda", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True)
+    parser.add_argument("--wandb", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+                        help="whether trials log to the wandb project of their csv row")
+    parser.add_argument("--output-dir", type=str, default=None,
+                        help="directory for trial logs, summaries and the scheduler state (outputs/asha/<csv> by default)")
+    parser.add_argument("train_args", nargs=argparse.REMAINDER,
+                        help="extra train.py options, after --")
+    args = parser.parse_args()
+    args.train_args = [a for a in args.train_args if a != "--"]
+    if args.output_dir is None:
+        args.output_dir = os.path.join("outputs", "asha", os.path.splitext(os.path.basename(args.experiments))[0])
+
+    successive_halving(args)
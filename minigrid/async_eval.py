@@ -0,0 +1,136 @@
+"""
+Greedy evaluation of the training agent in a background process.
+
+Every `--eval-interval` updates, train.py hands a CPU copy of the agent weights to
+AsyncEvaluator. A low-priority worker process runs the greedy policy of the snapshot on
+a fixed set of seeded episodes (the same for every snapshot) and sends the results back;
+the training loop collects them without waiting and logs them with its metrics. Snapshots
+are dropped when the worker is still busy with a previous one (the queue holds
+`queue_size` snapshots), so evaluation never slows down training beyond the copy.
+"""
+import os
+import queue
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+STOP = None
+
+
+def evaluate_snapshot(envs, agent, num_episodes, seed):
+    """
+    Greedy episodes of `agent` on `envs`: episode k is reset with seed + k and runs on env
+    k % len(envs), so every episode is the same for every snapshot (the env rng is not
+    carried over from the previous episode). Returns the episode returns, lengths and
+    final infos.
+    """
+    from utils import get_state_tensor
+    per_env = [len(range(i, num_episodes, len(envs))) for i in range(len(envs))]
+    states = [env.reset(seed=seed + i)[0] for i, env in enumerate(envs)]
+    returns, lengths, infos = [], [], []
+    episode_returns, episode_lengths, done_counts = np.zeros(len(envs)), np.zeros(len(envs), dtype=int), np.zeros(len(envs), dtype=int)
+    active = [i for i in range(len(envs)) if per_env[i] > 0]
+    while active:
+        obs = get_state_tensor({'image': np.stack([states[i]['image'] for i in active]),
+                                'direction': np.array([states[i]['direction'] for i in active])})
+        with torch.inference_mode():
+            actions = agent(obs)[0].argmax(dim=-1).numpy()
+        still_active = []
+        for i, action in zip(active, actions):
+            states[i], reward, terminated, truncated, info = envs[i].step(action)
+            episode_returns[i] += reward
+            episode_lengths[i] += 1
+            if terminated or truncated:
+                returns.append(episode_returns[i])
+                lengths.append(episode_lengths[i])
+                infos.append(info)
+                episode_returns[i], episode_lengths[i] = 0, 0
+                done_counts[i] += 1
+                if done_counts[i] == per_env[i]:
+                    continue
+                # env i runs the episodes i, i + len(envs), ...
+                states[i] = envs[i].reset(seed=int(seed + i + done_counts[i] * len(envs)))[0]
+            still_active.append(i)
+        active = still_active
+    return np.array(returns), np.array(lengths), infos
+
+def eval_worker(args, run_name, obs_dim, action_dim, snapshots, results):
+    """Evaluates the snapshots of the queue until STOP, at the lowest CPU priority."""
+    if hasattr(os, "nice"):
+        os.nice(args.eval_niceness)
+    torch.set_num_threads(1)
+    import copy
+    from train import make_env
+    from models import MiniGridAgent
+
+    env_args = copy.copy(args)
+    env_args.record_dir = None
+    envs = [make_env(env_args, idx, run_name)() for idx in range(args.eval_envs)]
+    agent = MiniGridAgent(obs_dim, action_dim, n_channels=4, encoder=args.encoder).eval()
+    boxes_env = "Energy" in args.env_id and not args.cont_energy_wrapper
+
+    while True:
+        snapshot = snapshots.get()
+        if snapshot is STOP:
+            break
+        update, timestep, state_dict = snapshot
+        start = time.perf_counter()
+        agent.load_state_dict(state_dict)
+        returns, lengths, infos = evaluate_snapshot(envs, agent, args.eval_episodes, args.eval_seed)
+        metrics = {"eval_update": update, "eval_timestep": timestep,
+                   "eval_return": returns.mean(), "eval_return_std": returns.std(), "eval_length": lengths.mean()}
+        if boxes_env:
+            metrics["eval_eat_count"] = np.mean([info['eat_count'] for info in infos])
+        else:
+            metrics["eval_success_rate"] = (returns > 0).mean()
+        metrics["eval_time"] = time.perf_counter() - start
+        results.put({key: float(value) for key, value in metrics.items()})
+    for env in envs:
+        env.close()
+
+
+class AsyncEvaluator:
+    """Hands agent snapshots to the evaluation worker and collects its results, never blocking."""
+
+    def __init__(self, args, run_name, obs_dim, action_dim, queue_size=1):
+        ctx = mp.get_context("spawn")
+        self.snapshots = ctx.Queue(maxsize=queue_size)
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=eval_worker, daemon=True,
+                                   args=(args, run_name, tuple(obs_dim), action_dim, self.snapshots, self.results))
+        self.process.start()
+        self.submitted, self.dropped = 0, 0
+
+    def submit(self, update, timestep, agent):
+        """Queues a copy of the agent weights, dropped if the worker has not taken the previous one yet."""
+        state_dict = {name: tensor.detach().to("cpu", copy=True) for name, tensor in agent.state_dict().items()}
+        try:
+            self.snapshots.put_nowait((update, timestep, state_dict))
+            self.submitted += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def poll(self):
+        """Results of the evaluations finished since the previous call."""
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def close(self, timeout=60.):
+        """Lets the worker finish the queued snapshots (for at most `timeout` seconds) and returns their results."""
+        deadline = time.perf_counter() + timeout
+        results = []
+        try:
+            self.snapshots.put(STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        while self.process.is_alive() and time.perf_counter() < deadline:
+            results += self.poll()
+            self.process.join(timeout=0.1)
+        if self.process.is_alive():
+            self.process.terminate()
+        return results + self.poll()
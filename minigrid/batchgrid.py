@@ -0,0 +1,315 @@
+"""
+Array-backed batched engine for the standard MiniGrid tasks of Experiment 1.
+
+`BatchedGridEnv` holds the N grids as a single uint8 array of (object, color, state)
+planes and steps all of them with vectorised numpy ops, as a drop-in replacement of
+
+    SyncVectorEnv([RecordEpisodeStatistics(TimeCostWrapper(gym.make(env_id), ...)), ...])
+
+Layouts are still generated by the upstream `_gen_grid` of one MiniGridEnv per env
+(only at reset), so seeds give the same grids as the upstream envs. Check the
+equivalence (and the throughput) with
+
+    python batchgrid.py --env-id MiniGrid-DoorKey-8x8-v0 --num-envs 16 --num-steps 5000
+"""
+import time
+import argparse
+import gymnasium as gym
+import numpy as np
+from minigrid.core.constants import OBJECT_TO_IDX, COLOR_TO_IDX, DIR_TO_VEC
+from minigrid.envs import EmptyEnv, DoorKeyEnv, CrossingEnv, FourRoomsEnv
+
+# envs whose dynamics are the plain MiniGridEnv.step
+SUPPORTED_ENVS = (EmptyEnv, DoorKeyEnv, CrossingEnv, FourRoomsEnv)
+
+EMPTY, WALL, FLOOR, DOOR = OBJECT_TO_IDX['empty'], OBJECT_TO_IDX['wall'], OBJECT_TO_IDX['floor'], OBJECT_TO_IDX['door']
+KEY, BALL, BOX = OBJECT_TO_IDX['key'], OBJECT_TO_IDX['ball'], OBJECT_TO_IDX['box']
+GOAL, LAVA = OBJECT_TO_IDX['goal'], OBJECT_TO_IDX['lava']
+SUPPORTED_OBJECTS = [EMPTY, WALL, FLOOR, DOOR, KEY, BALL, GOAL, LAVA]
+# door states
+OPEN, CLOSED, LOCKED = 0, 1, 2
+# MiniGridEnv.Actions
+LEFT, RIGHT, FORWARD, PICKUP, DROP, TOGGLE, DONE = range(7)
+
+
+def rotate_left(x):
+    """Grid.rotate_left on a square [i, j] array."""
+    return x.T[:, ::-1]
+
+def view_offsets(view_size):
+    """
+    Offsets (dx, dy), each of shape (4, view_size, view_size), from the agent position to
+    the grid cell shown at every position of the egocentric view, for each direction
+    (MiniGridEnv.get_view_exts followed by agent_dir + 1 left rotations).
+    """
+    half = view_size // 2
+    tops = [(0, -half), (-half, 0), (-view_size + 1, -half), (-half, -view_size + 1)]
+    i, j = np.meshgrid(np.arange(view_size), np.arange(view_size), indexing='ij')
+    dx, dy = [], []
+    for direction, (top_x, top_y) in enumerate(tops):
+        x, y = top_x + i, top_y + j
+        for _ in range(direction + 1):
+            x, y = rotate_left(x), rotate_left(y)
+        dx.append(x)
+        dy.append(y)
+    return np.array(dx), np.array(dy)
+
+
+class BatchedGridEnv(gym.vector.VectorEnv):
+    """
+    N MiniGrid envs of the same id stepped together on integer arrays.
+
+    Observations, rewards, terminations, truncations and the autoreset infos
+    (final_observation, final_info with RecordEpisodeStatistics' 'episode') match the
+    SyncVectorEnv of TimeCostWrapper-wrapped upstream envs. Rendering is not supported.
+    """
+
+    def __init__(self, env_id, num_envs, env_kwargs={}, time_cost=0, action_cost=0,
+                 final_reward_penalty=False, noops_actions=[4, 6]):
+        # the upstream envs only generate the layouts at reset
+        self.generators = [gym.make(env_id, **env_kwargs).unwrapped for _ in range(num_envs)]
+        generator = self.generators[0]
+        if not isinstance(generator, SUPPORTED_ENVS):
+            raise NotImplementedError(f"Env {env_id} is not supported by the batched engine")
+        super().__init__(num_envs, generator.observation_space, generator.action_space)
+
+        self.time_cost = time_cost
+        self.action_cost = action_cost
+        self.final_penalty = final_reward_penalty
+        self.noops_actions = np.array(noops_actions)
+
+        self.width, self.height = generator.width, generator.height
+        self.view_size = generator.agent_view_size
+        self.see_through_walls = generator.see_through_walls
+        self.max_steps = generator.max_steps
+        # out-of-grid cells of a view are walls, as in Grid.slice
+        self.pad = self.view_size - 1
+        self.view_dx, self.view_dy = view_offsets(self.view_size)
+        self.dir_to_vec = np.array(DIR_TO_VEC)
+        self.wall = np.array([WALL, COLOR_TO_IDX['grey'], 0], dtype=np.uint8)
+
+        self.grid = np.empty((num_envs, self.width + 2 * self.pad, self.height + 2 * self.pad, 3), dtype=np.uint8)
+        self.agent_pos = np.zeros((num_envs, 2), dtype=np.int64)
+        self.agent_dir = np.zeros(num_envs, dtype=np.int64)
+        self.carrying = np.zeros((num_envs, 2), dtype=np.uint8) # (object, color), object 0 if nothing
+        self.step_count = np.zeros(num_envs, dtype=np.int64)
+        self.missions = [None] * num_envs
+        self.env_idx = np.arange(num_envs)
+
+        # RecordEpisodeStatistics
+        self.episode_returns = np.zeros(num_envs, dtype=np.float32)
+        self.episode_lengths = np.zeros(num_envs, dtype=np.int32)
+        self.episode_start_times = np.zeros(num_envs)
+
+    def _reset_env(self, i, seed=None):
+        """Generates a new layout with the upstream env and loads it into the arrays."""
+        generator = self.generators[i]
+        generator.reset(seed=seed)
+        layout = generator.grid.encode()
+        if not np.isin(layout[..., 0], SUPPORTED_OBJECTS).all():
+            raise NotImplementedError("Layout contains objects not supported by the batched engine")
+        self.grid[i] = self.wall
+        self.grid[i, self.pad:self.pad + self.width, self.pad:self.pad + self.height] = layout
+        self.agent_pos[i] = generator.agent_pos
+        self.agent_dir[i] = generator.agent_dir
+        self.carrying[i] = 0
+        self.step_count[i] = 0
+        self.missions[i] = generator.mission
+        self.episode_returns[i] = 0
+        self.episode_lengths[i] = 0
+        self.episode_start_times[i] = time.perf_counter()
+
+    def _process_vis(self, view):
+        """Grid.process_vis on a batch of (k, view_size, view_size, 3) views."""
+        size = self.view_size
+        see_behind = ~((view[..., 0] == WALL) | ((view[..., 0] == DOOR) & (view[..., 2] != OPEN)))
+        mask = np.zeros(view.shape[:3], dtype=bool)
+        mask[:, size // 2, size - 1] = True
+        for j in reversed(range(size)):
+            for i in range(size - 1):
+                spread = mask[:, i, j] & see_behind[:, i, j]
+                mask[:, i + 1, j] |= spread
+                if j > 0:
+                    mask[:, i + 1, j - 1] |= spread
+                    mask[:, i, j - 1] |= spread
+            for i in reversed(range(1, size)):
+                spread = mask[:, i, j] & see_behind[:, i, j]
+                mask[:, i - 1, j] |= spread
+                if j > 0:
+                    mask[:, i - 1, j - 1] |= spread
+                    mask[:, i, j - 1] |= spread
+        return mask
+
+    def _observe(self, idx):
+        """Egocentric view images of the envs `idx` (MiniGridEnv.gen_obs)."""
+        direction = self.agent_dir[idx]
+        x = self.agent_pos[idx, 0, None, None] + self.view_dx[direction] + self.pad
+        y = self.agent_pos[idx, 1, None, None] + self.view_dy[direction] + self.pad
+        view = self.grid[idx[:, None, None], x, y]
+        mask = None if self.see_through_walls else self._process_vis(view)
+        # the agent sees what it is carrying
+        agent_cell = view[:, self.view_size // 2, self.view_size - 1]
+        carrying = self.carrying[idx, 0] > 0
+        agent_cell[:] = (EMPTY, 0, 0)
+        agent_cell[carrying, :2] = self.carrying[idx[carrying]]
+        if mask is not None:
+            view[~mask] = 0
+        return view
+
+    def _observations(self, image):
+        return {'direction': self.agent_dir.copy(), 'image': image, 'mission': tuple(self.missions)}
+
+    def reset(self, *, seed=None, options=None):
+        """Resets every env, an int seed s seeds the envs with s, s+1, ... as in SyncVectorEnv."""
+        if seed is None:
+            seed = [None] * self.num_envs
+        elif isinstance(seed, int):
+            seed = [seed + i for i in range(self.num_envs)]
+        for i in range(self.num_envs):
+            self._reset_env(i, seed[i])
+        return self._observations(self._observe(self.env_idx)), {}
+
+    def step(self, actions):
+        actions = np.asarray(actions)
+        n = self.env_idx
+        self.step_count += 1
+        reward = np.zeros(self.num_envs)
+        terminated = np.zeros(self.num_envs, dtype=bool)
+
+        # cell in front of the agent, before the action
+        front = self.agent_pos + self.dir_to_vec[self.agent_dir]
+        front_x, front_y = front[:, 0] + self.pad, front[:, 1] + self.pad
+        obj, color, state = self.grid[n, front_x, front_y].T
+
+        self.agent_dir[actions == LEFT] -= 1
+        self.agent_dir[actions == RIGHT] += 1
+        self.agent_dir %= 4
+
+        can_overlap = np.isin(obj, [EMPTY, FLOOR, GOAL, LAVA]) | ((obj == DOOR) & (state == OPEN))
+        move = (actions == FORWARD) & can_overlap
+        self.agent_pos[move] = front[move]
+        goal = (actions == FORWARD) & (obj == GOAL)
+        terminated |= goal
+        reward[goal] = 1 - 0.9 * (self.step_count[goal] / self.max_steps)
+        terminated |= (actions == FORWARD) & (obj == LAVA)
+
+        pickup = (actions == PICKUP) & np.isin(obj, [KEY, BALL, BOX]) & (self.carrying[:, 0] == 0)
+        self.carrying[pickup] = np.stack([obj[pickup], color[pickup]], axis=1)
+        self.grid[n[pickup], front_x[pickup], front_y[pickup]] = (EMPTY, 0, 0)
+
+        drop = (actions == DROP) & (obj == EMPTY) & (self.carrying[:, 0] > 0)
+        self.grid[n[drop], front_x[drop], front_y[drop], :2] = self.carrying[drop]
+        self.grid[n[drop], front_x[drop], front_y[drop], 2] = 0
+        self.carrying[drop] = 0
+
+        toggle = (actions == TOGGLE) & (obj == DOOR)
+        has_key = (self.carrying[:, 0] == KEY) & (self.carrying[:, 1] == color)
+        unlock = toggle & (state == LOCKED) & has_key
+        flip = toggle & (state != LOCKED)
+        self.grid[n[unlock], front_x[unlock], front_y[unlock], 2] = OPEN
+        self.grid[n[flip], front_x[flip], front_y[flip], 2] = CLOSED - state[flip]
+
+        truncated = self.step_count >= self.max_steps
+
+        # TimeCostWrapper
+        if not self.final_penalty:
+            reward[terminated] = 1
+        reward -= self.time_cost
+        reward[~np.isin(actions, self.noops_actions)] -= self.action_cost
+
+        # RecordEpisodeStatistics
+        self.episode_returns += reward.astype(np.float32)
+        self.episode_lengths += 1
+
+        image = self._observe(n)
+        infos = {}
+        done = np.flatnonzero(terminated | truncated)
+        if len(done) > 0:
+            now = time.perf_counter()
+            final_observation = np.full(self.num_envs, None, dtype=object)
+            final_info = np.full(self.num_envs, None, dtype=object)
+            for i in done:
+                final_observation[i] = {'direction': int(self.agent_dir[i]), 'image': image[i].copy(),
+                                        'mission': self.missions[i]}
+                final_info[i] = {'episode': {'r': self.episode_returns[i:i+1].copy(),
+                                             'l': self.episode_lengths[i:i+1].copy(),
+                                             't': np.round([now - self.episode_start_times[i]], 6)}}
+                self._reset_env(i)
+            image[done] = self._observe(done)
+            mask = np.zeros(self.num_envs, dtype=bool)
+            mask[done] = True
+            infos = {'final_observation': final_observation, '_final_observation': mask,
+                     'final_info': final_info, '_final_info': mask.copy()}
+
+        return self._observations(image), reward, terminated, truncated, infos
+
+
+def make_reference_envs(args, env_kwargs):
+    from utils import TimeCostWrapper
+    def make_env():
+        env = gym.make(args.env_id, **env_kwargs)
+        env = TimeCostWrapper(env, time_cost=args.time_cost, action_cost=args.action_cost,
+                              final_reward_penalty=args.final_reward_penalty, noops_actions=[4, 6])
+        return gym.wrappers.RecordEpisodeStatistics(env)
+    return gym.vector.SyncVectorEnv([make_env for _ in range(args.num_envs)])
+
+def check_equivalence(args):
+    """Steps the batched engine and the upstream envs with the same seeds and random actions."""
+    env_kwargs = {"max_steps": args.max_steps} if args.max_steps else {}
+    reference = make_reference_envs(args, env_kwargs)
+    batched = BatchedGridEnv(args.env_id, args.num_envs, env_kwargs, time_cost=args.time_cost,
+                             action_cost=args.action_cost, final_reward_penalty=args.final_reward_penalty)
+    rng = np.random.default_rng(args.seed)
+    actions = rng.integers(0, batched.single_action_space.n, size=(args.num_steps, args.num_envs))
+
+    def compare(step, name, expected, actual):
+        if not np.array_equal(expected, actual):
+            raise AssertionError(f"Step {step}: {name} differs\nupstream:\n{expected}\nbatched:\n{actual}")
+
+    ref_obs, _ = reference.reset(seed=args.seed)
+    obs, _ = batched.reset(seed=args.seed)
+    compare(0, "image", ref_obs['image'], obs['image'])
+    compare(0, "direction", ref_obs['direction'], obs['direction'])
+    episodes = 0
+    for t in range(args.num_steps):
+        ref_obs, ref_reward, ref_terminated, ref_truncated, ref_info = reference.step(actions[t])
+        obs, reward, terminated, truncated, info = batched.step(actions[t])
+        for name in ['image', 'direction']:
+            compare(t + 1, name, ref_obs[name], obs[name])
+        compare(t + 1, "reward", ref_reward, reward)
+        compare(t + 1, "terminated", ref_terminated, terminated)
+        compare(t + 1, "truncated", ref_truncated, truncated)
+        compare(t + 1, "final_info mask", ref_info.get('_final_info'), info.get('_final_info'))
+        for i in np.flatnonzero(info.get('_final_info', [])):
+            compare(t + 1, "final image", ref_info['final_observation'][i]['image'], info['final_observation'][i]['image'])
+            for key in ['r', 'l']:
+                compare(t + 1, f"episode {key}", ref_info['final_info'][i]['episode'][key],
+                        info['final_info'][i]['episode'][key])
+            episodes += 1
+    print(f"{args.env_id}: {args.num_envs} envs x {args.num_steps} steps ({episodes} episodes) identical")
+
+    # throughput with the same action sequence
+    for name, envs in [("upstream", reference), ("batched", batched)]:
+        envs.reset(seed=args.seed)
+        start = time.perf_counter()
+        for t in range(args.num_steps):
+            envs.step(actions[t])
+        print(f"{name:>10}: {args.num_envs * args.num_steps / (time.perf_counter() - start):.0f} steps/s")
+    reference.close()
+    batched.close()
+
+
+if __name__ == "__main__":
+    from utils import strtobool
+    parser = argparse.ArgumentParser(description="Equivalence check and throughput of the batched grid engine")
+    parser.add_argument("--env-id", type=str, default="MiniGrid-DoorKey-8x8-v0")
+    parser.add_argument("--max-steps", type=int, default=0,
+                        help="max_steps passed to the env (0 keeps the env default)")
+    parser.add_argument("--num-envs", type=int, default=16)
+    parser.add_argument("--num-steps", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--time-cost", type=float, default=0)
+    parser.add_argument("--action-cost", type=float, default=0)
+    parser.add_argument("--final-reward-penalty", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True)
+    args = parser.parse_args()
+    check_equivalence(args)
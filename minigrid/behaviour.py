@@ -0,0 +1,117 @@
+import os
+import time
+import argparse
+import gymnasium as gym
+import numpy as np
+import torch
+from customenvs import ENERGY_ENVS
+from utils import get_state_tensor
+from export import load_policy
+from weightstore import agent_paths
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+# per-episode counters reported by the EnergyBoxes envs in their final info
+EPISODE_KEYS = ['red_count', 'blue_count', 'eat_count', 'mix_rate', 'agent_distance', 'consecutive_boxes']
+
+
+def make_env(args, idx):
+    def thunk():
+        env = ENERGY_ENVS[args.env_id](agent_start_dir="random",
+                                       agent_start_pos="random" if args.env_id == "EnergyBoxesDelay" else (1,1),
+                                       time_bonus=args.time_bonus,
+                                       box_open_reward=args.box_reward,
+                                       seed=args.seed + idx * 100,
+                                       track_timestep_counts=True)
+        env = gym.wrappers.RecordEpisodeStatistics(env)
+        return env
+    return thunk
+
+def analyse_agent(agent, args):
+    """
+    Runs `agent` for `max_timesteps` on `num_envs` seeded envs and returns
+    the summed eat-time histogram and the per-episode counters.
+    """
+    envs = gym.vector.SyncVectorEnv([make_env(args, idx) for idx in range(args.num_envs)])
+    episodes = {key: [] for key in EPISODE_KEYS + ['return', 'length']}
+
+    state = envs.reset()[0]
+    with torch.inference_mode():
+        for t in range(args.max_timesteps):
+            obs = get_state_tensor(state).to(device)
+            action = agent.get_action_and_value(obs)[0]
+            state, reward, terminated, truncated, info = envs.step(action.cpu().numpy())
+
+            if 'final_info' in info:
+                for env_final_info in info['final_info']:
+                    if env_final_info is not None:
+                        for key in EPISODE_KEYS:
+                            episodes[key].append(env_final_info[key])
+                        episodes['return'].append(env_final_info['episode']['r'].item())
+                        episodes['length'].append(env_final_info['episode']['l'].item())
+
+    timestep_counts = np.sum(envs.get_attr('timestep_counts'), axis=0)
+    envs.close()
+    return timestep_counts, {key: np.array(values) for key, values in episodes.items()}
+
+def find_agents(args):
+    """Paths of the selected checkpoints in trained-models/<env-id> (memory-mapped .json if converted, .pth otherwise)."""
+    names = args.agents
+    if args.where:
+        from catalogue import Catalogue
+        names = Catalogue(args.catalogue).run_names(f"env_id = ? AND status = 'finished' AND ({args.where})", (args.env_id,))
+        if args.agents is not None: names = [name for name in names if name in args.agents]
+    return agent_paths(os.path.join('trained-models', args.env_id), names)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batch behavioural analysis of trained EnergyBoxes agents')
+    parser.add_argument("--env-id", type=str, default="EnergyBoxes", choices=list(ENERGY_ENVS))
+    parser.add_argument("--agents", type=str, nargs="+", default=None,
+                        help="agent names (actor_<name>.pth or .json), all agents of the env by default")
+    parser.add_argument("--where", type=str, default=None,
+                        help="SQL condition selecting the finished runs of the run catalogue to analyse, e.g. \"time_bonus = 0.1 AND seed < 50\"")
+    parser.add_argument("--catalogue", type=str, default="runs.sqlite")
+    parser.add_argument("--experiment", type=str, default=None,
+                        help="name of the output file outputs/behaviour-<experiment>.npz (env id by default)")
+    parser.add_argument("--num-envs", type=int, default=32,
+                        help="number of seeded envs each agent is run on")
+    parser.add_argument("--max-timesteps", type=int, default=2048,
+                        help="timesteps per env")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--time-bonus", type=float, default=0.1)
+    parser.add_argument("--box-reward", type=float, default=0)
+    args = parser.parse_args()
+
+    paths = find_agents(args)
+    print(f"Analysing {len(paths)} agents on {args.num_envs} envs x {args.max_timesteps} timesteps")
+
+    agent_names, timestep_counts, episode_agent = [], [], []
+    episodes = {key: [] for key in EPISODE_KEYS + ['return', 'length']}
+    for i, path in enumerate(paths):
+        start = time.time()
+        agent = load_policy(path, device).eval()
+        counts, agent_episodes = analyse_agent(agent, args)
+
+        agent_names.append(os.path.splitext(os.path.basename(path))[0][len('actor_'):])
+        timestep_counts.append(counts)
+        episode_agent.append(np.full(len(agent_episodes['return']), i))
+        for key in episodes:
+            episodes[key].append(agent_episodes[key])
+
+        eat_counts = agent_episodes['eat_count']
+        print(f"{agent_names[-1]}: {len(eat_counts)} episodes, "
+              f"eat counts {eat_counts.mean() if len(eat_counts) else 0:.2f}, "
+              f"mix rate {agent_episodes['mix_rate'].mean() if len(eat_counts) else 0:.3f} "
+              f"({time.time() - start:.1f}s)")
+
+    experiment = args.experiment or args.env_id
+    os.makedirs('outputs', exist_ok=True)
+    output_path = f'outputs/behaviour-{experiment}.npz'
+    np.savez_compressed(output_path,
+                        agent_names=np.array(agent_names),
+                        timestep_counts=np.array(timestep_counts),
+                        episode_agent=np.concatenate(episode_agent) if episode_agent else np.array([], dtype=int),
+                        **{f'episode_{key}': np.concatenate(values) if values else np.array([])
+                           for key, values in episodes.items()})
+    print(f"Saved {output_path}")
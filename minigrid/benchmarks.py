@@ -0,0 +1,837 @@
+"""
+Performance benchmarks for the training and evaluation code.
+
+Every benchmark is a subcommand, e.g.
+
+    python benchmarks.py precision --env-id EnergyBoxes --num-updates 30 --seeds 1 2 3
+
+Training-based benchmarks run each configuration in a fresh subprocess (`run` subcommand)
+so that torch thread settings and import costs do not leak between configurations.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+
+def run_training(train_argv, num_updates):
+    """Runs `num_updates` collect/update iterations with the train.py setup and returns timings and returns."""
+    from train import parse_args, setup_torch, build_training
+
+    args = parse_args(train_argv + ["--wandb", "false", "--plot", "false", "--verbose", "false"])
+    setup_torch(args)
+    envs, agent, storage, ppo = build_training(args, run_name="benchmark")
+
+    collect_times, update_times, mean_returns, policy_lags = [], [], [], []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for update in range(num_updates):
+            start = time.perf_counter()
+            batch, stats = storage.collect_trajectories()
+            collect_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            ppo.update_ppo_agent(batch, save_path=os.path.join(tmp_dir, "actor.pth"))
+            update_times.append(time.perf_counter() - start)
+
+            returns = stats['episode_returns']
+            mean_returns.append(float(returns.mean()) if len(returns) > 0 else float("nan"))
+            policy_lags.append(stats.get('policy_lag', 0))
+    if args.pipeline:
+        storage.close()
+    envs.close()
+
+    import resource
+    return {"collect_times": collect_times,
+            "update_times": update_times,
+            "mean_returns": mean_returns,
+            "policy_lags": policy_lags,
+            "batch_size": args.batch_size,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def launch_training(train_argv, num_updates):
+    """Runs `run_training` in a subprocess and returns its result dict."""
+    command = [sys.executable, os.path.abspath(__file__), "run", "--num-updates", str(num_updates), "--"] + train_argv
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarise_training(results, reference=None):
+    """Wall-time and learning-curve summary of a list of per-seed `run_training` results."""
+    wall_times = np.array([np.sum(r["collect_times"]) + np.sum(r["update_times"]) for r in results])
+    curve = np.nanmean([r["mean_returns"] for r in results], axis=0)
+    n_final = max(1, len(curve) // 5)
+    summary = {"wall_time": wall_times.mean(),
+               "sps": results[0]["batch_size"] * len(curve) / wall_times.mean(),
+               "collect_time": np.mean([np.sum(r["collect_times"]) for r in results]),
+               "update_time": np.mean([np.sum(r["update_times"]) for r in results]),
+               "final_return": np.nanmean(curve[-n_final:]),
+               "policy_lag": np.mean([np.mean(r["policy_lags"]) for r in results]),
+               "curve": curve}
+    if reference is not None:
+        summary["speedup"] = reference["wall_time"] / summary["wall_time"]
+        summary["max_curve_gap"] = np.nanmax(np.abs(curve - reference["curve"]))
+        summary["final_return_gap"] = summary["final_return"] - reference["final_return"]
+    return summary
+
+
+def compare_training(configs, base_argv, seeds, num_updates, output=None):
+    """Trains every (name, extra_argv) config for each seed and prints a comparison against the first config."""
+    summaries = {}
+    for name, extra_argv in configs:
+        results = []
+        for seed in seeds:
+            print(f"Running {name} (seed {seed})...")
+            results.append(launch_training(base_argv + extra_argv + ["--seed", str(seed)], num_updates))
+        summaries[name] = summarise_training(results, reference=summaries.get(configs[0][0]))
+
+    print(f"\n{'mode':<24}{'wall (s)':>10}{'SPS':>10}{'collect':>10}{'update':>10}{'speedup':>9}"
+          f"{'final ret':>11}{'Δ final':>9}{'max Δ curve':>13}{'lag':>6}")
+    for name, s in summaries.items():
+        print(f"{name:<24}{s['wall_time']:>10.2f}{s['sps']:>10.0f}{s['collect_time']:>10.2f}{s['update_time']:>10.2f}"
+              f"{s.get('speedup', 1.0):>9.2f}{s['final_return']:>11.3f}{s.get('final_return_gap', 0.0):>9.3f}"
+              f"{s.get('max_curve_gap', 0.0):>13.3f}{s['policy_lag']:>6.2f}")
+
+    if output is not None:
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w") as f:
+            json.dump({name: {k: (v.tolist() if isinstance(v, np.ndarray) else float(v)) for k, v in s.items()}
+                       for name, s in summaries.items()}, f, indent=2)
+        print(f"Saved report to {output}")
+    return summaries
+
+
+def benchmark_precision(args):
+    """fp32 vs bfloat16 autocast (and channels_last) CPU training on the same seeds."""
+    threads = ["--torch-threads", str(args.threads), "--torch-interop-threads", str(args.interop_threads)]
+    base_argv = ["--env-id", args.env_id, "--cuda", "false",
+                 "--num-envs", str(args.num_envs), "--num-steps", str(args.num_steps)] + threads
+    configs = [("fp32", []),
+               ("bf16", ["--bf16", "true"]),
+               ("bf16+channels_last", ["--bf16", "true", "--channels-last", "true"])]
+    compare_training(configs, base_argv, args.seeds, args.num_updates, output=args.output)
+
+
+def benchmark_pipeline(args):
+    """Sequential vs pipelined (overlapped collection and update) training."""
+    base_argv = ["--env-id", args.env_id, "--cuda", "false",
+                 "--num-envs", str(args.num_envs), "--num-steps", str(args.num_steps)]
+    configs = [("sequential", [])] + [(f"pipeline (max lag {lag})", ["--pipeline", "true", "--max-policy-lag", str(lag)])
+                                      for lag in args.max_policy_lags]
+    compare_training(configs, base_argv, args.seeds, args.num_updates, output=args.output)
+
+
+def parse_importtime(stderr):
+    """Parses `python -X importtime` output into (total self time, {top-level module: cumulative time}) in ms."""
+    total, top_level = 0.0, {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        total += int(self_us) / 1000
+        if not name[1:].startswith(" "): # nested imports are indented
+            top_level[name.strip()] = int(cumulative_us) / 1000
+    return total, top_level
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def benchmark_startup(args):
+    """Interpreter startup (imports + argument parsing) of the entry-point scripts with default options."""
+    rows = []
+    for script in args.scripts:
+        wall_times, import_times, top_level = [], [], {}
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            # --help exits right after argument parsing, i.e. after every module-level import
+            result = subprocess.run([sys.executable, "-X", "importtime", script, "--help"],
+                                    capture_output=True, text=True)
+            wall_times.append((time.perf_counter() - start) * 1000)
+            total, top_level = parse_importtime(result.stderr)
+            import_times.append(total)
+        slowest = sorted(top_level.items(), key=lambda item: -item[1])[:args.top]
+        rows.append({"script": script,
+                     "wall_ms": float(np.median(wall_times)),
+                     "import_ms": float(np.median(import_times)),
+                     "slowest": " ".join(f"{name}:{ms:.0f}" for name, ms in slowest)})
+
+    print(f"{'script':<20}{'wall (ms)':>12}{'imports (ms)':>14}   slowest top-level imports (ms)")
+    for row in rows:
+        print(f"{row['script']:<20}{row['wall_ms']:>12.0f}{row['import_ms']:>14.0f}   {row['slowest']}")
+
+    # append to a csv so startup time can be tracked across commits
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    write_header = not os.path.exists(args.output)
+    revision, date = git_revision(), time.strftime("%Y-%m-%d %H:%M:%S")
+    with open(args.output, "a") as f:
+        if write_header:
+            f.write("date,revision,script,wall_ms,import_ms,slowest\n")
+        for row in rows:
+            f.write(f"{date},{revision},{row['script']},{row['wall_ms']:.1f},{row['import_ms']:.1f},{row['slowest']}\n")
+    print(f"Appended results to {args.output}")
+
+
+def make_fullyobs_env(env_id, seed, wrapper):
+    from customenvs import ENERGY_ENVS
+    import gymnasium as gym
+    if env_id in ENERGY_ENVS:
+        env = wrapper(ENERGY_ENVS[env_id](agent_start_dir="random", seed=seed))
+        env.reset()
+    else:
+        env = wrapper(gym.make(env_id, max_steps=1024) if env_id == "MiniGrid-FourRooms-v0" else gym.make(env_id))
+        env.reset(seed=seed)
+    return env
+
+
+def benchmark_fullyobs(args):
+    """Incremental vs upstream fully observable encoding: equivalence and step throughput."""
+    from minigrid.wrappers import FullyObsWrapper
+    from utils import IncrementalFullyObsWrapper
+
+    print(f"{'env':<32}{'upstream (steps/s)':>20}{'incremental (steps/s)':>23}{'speedup':>9}")
+    for env_id in args.env_ids:
+        envs = {name: make_fullyobs_env(env_id, args.seed, wrapper)
+                for name, wrapper in [("upstream", FullyObsWrapper), ("incremental", IncrementalFullyObsWrapper)]}
+        actions = np.random.default_rng(args.seed).integers(0, envs["upstream"].action_space.n, size=args.num_steps)
+
+        # same seeds and actions, so the observations must match at every step
+        for t, action in enumerate(actions):
+            upstream, incremental = [env.step(action)[:4] for env in envs.values()]
+            assert np.array_equal(upstream[0]["image"], incremental[0]["image"]), f"{env_id}: observations differ at step {t}"
+            if upstream[2] or upstream[3]:
+                for env in envs.values():
+                    env.reset()
+
+        steps_per_second = {}
+        for name, env in envs.items():
+            start = time.perf_counter()
+            for action in actions:
+                _, _, terminated, truncated, _ = env.step(action)
+                if terminated or truncated:
+                    env.reset()
+            steps_per_second[name] = args.num_steps / (time.perf_counter() - start)
+        print(f"{env_id:<32}{steps_per_second['upstream']:>20.0f}{steps_per_second['incremental']:>23.0f}"
+              f"{steps_per_second['incremental'] / steps_per_second['upstream']:>9.2f}")
+
+
+def benchmark_layouts(args):
+    """Reset throughput of regenerated vs pooled layouts, with the same seeds and the same episodes."""
+    import gymnasium as gym
+    from utils import LayoutPoolWrapper
+    from recording import TrajectoryRecorder
+    from train import parse_args, make_env
+
+    def make(env_id):
+        return gym.make(env_id, max_steps=1024) if env_id == "MiniGrid-FourRooms-v0" else gym.make(env_id)
+
+    def layout_pool(env):
+        while not isinstance(env, LayoutPoolWrapper):
+            env = env.env
+        return env
+
+    print(f"{'env':<32}{'regenerated (resets/s)':>24}{'pooled (resets/s)':>19}{'speedup':>9}")
+    for env_id in args.env_ids:
+        regenerated = make(env_id)
+        pooled = LayoutPoolWrapper(make(env_id), args.num_layouts)
+        seeds = [seed % args.num_layouts for seed in range(args.num_resets)]
+
+        # the pooled env reproduces the regenerated episodes, including the first steps after a restore
+        rng = np.random.default_rng(0)
+        for seed in seeds[:2 * args.num_layouts]:
+            obs = [regenerated.reset(seed=seed)[0], pooled.reset()[0]]
+            assert np.array_equal(obs[0]["image"], obs[1]["image"]), f"{env_id}: observations differ at seed {seed}"
+            assert np.array_equal(regenerated.unwrapped.grid.encode(), pooled.unwrapped.grid.encode())
+            for action in rng.integers(0, regenerated.action_space.n, size=args.check_steps):
+                obs = [env.step(action)[0] for env in (regenerated, pooled)]
+                assert np.array_equal(obs[0]["image"], obs[1]["image"]), f"{env_id}: episodes differ at seed {seed}"
+
+        # recording does not change the layouts, the recorder resets with the seeds of the pool cycle
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            unrecorded = LayoutPoolWrapper(make(env_id), args.num_layouts, seed_offset=args.num_layouts // 2)
+            recorded = TrajectoryRecorder(LayoutPoolWrapper(make(env_id), args.num_layouts, seed_offset=args.num_layouts // 2),
+                                          tmp_dir, 0)
+            for _ in seeds[:2 * args.num_layouts]:
+                obs = [unrecorded.reset()[0], recorded.reset()[0]]
+                assert recorded.episode_seed == unrecorded.key[1], f"{env_id}: recorded layout {recorded.episode_seed} instead of {unrecorded.key[1]}"
+                assert np.array_equal(obs[0]["image"], obs[1]["image"]), f"{env_id}: recording changes the layouts"
+            recorded.close()
+
+        # with the train.py seed offsets, the envs of one vector env start on distinct layout seeds
+        # (compared by seed, a few seeds generate the same grid)
+        envs = gym.vector.SyncVectorEnv([make_env(parse_args(["--env-id", env_id, "--num-envs", str(args.num_envs),
+                                                               "--num-layouts", str(args.num_layouts)]), idx, "benchmark")
+                                         for idx in range(args.num_envs)])
+        for _ in range(3):
+            envs.reset()
+            starts = {layout_pool(env).key for env in envs.envs}
+            assert len(starts) == args.num_envs, f"{env_id}: {args.num_envs} envs start on {len(starts)} distinct layouts"
+        envs.close()
+
+        resets_per_second = {}
+        for name, reset in [("regenerated", lambda seed: regenerated.reset(seed=seed)),
+                            ("pooled", lambda seed: pooled.reset())]:
+            start = time.perf_counter()
+            for seed in seeds:
+                reset(seed)
+            resets_per_second[name] = args.num_resets / (time.perf_counter() - start)
+        print(f"{env_id:<32}{resets_per_second['regenerated']:>24.0f}{resets_per_second['pooled']:>19.0f}"
+              f"{resets_per_second['pooled'] / resets_per_second['regenerated']:>9.2f}")
+
+
+def benchmark_sampling(args):
+    """Categorical vs Gumbel-max action sampling: distributional equivalence and per-step time."""
+    import torch
+    from torch.distributions.categorical import Categorical
+    from models import MiniGridAgent, gumbel_noise
+
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.threads)
+
+    # both samplers must draw the same action frequencies and log-probs for the same logits
+    logits = torch.randn(args.num_actions) * 2
+    probs = torch.softmax(logits, dim=0)
+    categorical = Categorical(logits=logits.expand(args.num_samples, -1)).sample()
+    log_probs = torch.log_softmax(logits, dim=0).expand(args.num_samples, -1)
+    gumbel = (log_probs + gumbel_noise((args.num_samples, args.num_actions))).argmax(dim=-1)
+    print(f"{'action':>6}{'p':>9}{'categorical':>13}{'gumbel-max':>12}")
+    for a in range(args.num_actions):
+        print(f"{a:>6}{probs[a]:>9.4f}{(categorical == a).float().mean():>13.4f}{(gumbel == a).float().mean():>12.4f}")
+    logprob_error = (log_probs.gather(-1, gumbel.unsqueeze(-1)).squeeze(-1)
+                     - Categorical(logits=logits.expand(args.num_samples, -1)).log_prob(gumbel)).abs().max()
+    print(f"max log-prob difference: {logprob_error:.2e}")
+
+    agent = MiniGridAgent((4, 7, 7), args.num_actions)
+    obs = torch.rand((args.num_envs, 4, 7, 7))
+    rollout_noise = gumbel_noise((args.num_steps, args.num_envs, args.num_actions))
+    steppers = {"categorical": lambda step: agent.get_action_and_value(obs),
+                "gumbel-max": lambda step: agent.sample_action_and_value(obs, rollout_noise[step])}
+    print(f"\n{'sampler':<14}{'ms/step':>9}   ({args.num_envs} envs, including the forward pass)")
+    for name, stepper in steppers.items():
+        with torch.no_grad():
+            start = time.perf_counter()
+            for step in range(args.num_steps):
+                stepper(step)
+        print(f"{name:<14}{(time.perf_counter() - start) * 1000 / args.num_steps:>9.3f}")
+    start = time.perf_counter()
+    gumbel_noise((args.num_steps, args.num_envs, args.num_actions))
+    print(f"noise of a rollout: {(time.perf_counter() - start) * 1000:.3f} ms")
+
+
+def benchmark_rng(args):
+    """Per-draw and per-step cost of the EnergyBoxes random numbers, drawn one at a time vs in blocks."""
+    from customenvs import ENERGY_ENVS, BlockRNG
+
+    generator = np.random.default_rng(args.seed)
+    rng = BlockRNG(np.random.default_rng(args.seed), args.block_size)
+    draws = {"np_random.uniform()": generator.uniform,
+             "BlockRNG.uniform()": rng.uniform,
+             "np_random.choice(positions)": lambda: generator.choice([(1, 1), (3, 3)]),
+             "BlockRNG.integers(2)": lambda: rng.integers(2)}
+    print(f"{'draw':<30}{'ns/draw':>9}")
+    for name, draw in draws.items():
+        start = time.perf_counter()
+        for _ in range(args.num_draws):
+            draw()
+        print(f"{name:<30}{(time.perf_counter() - start) * 1e9 / args.num_draws:>9.0f}")
+
+    actions = np.random.default_rng(args.seed).integers(0, 7, size=args.num_steps)
+    print(f"\n{'env':<20}{'block size':>11}{'us/step':>9}")
+    for env_id, env_class in ENERGY_ENVS.items():
+        for block_size in [0, args.block_size]:
+            # the same seed and block size must give the same episodes
+            envs = [env_class(agent_start_dir="random", seed=args.seed, rng_block_size=block_size) for _ in range(2)]
+            for env in envs:
+                env.reset()
+            for action in actions[:1000]:
+                steps = [env.step(action) for env in envs]
+                assert np.array_equal(steps[0][0]["image"], steps[1][0]["image"]) and steps[0][1] == steps[1][1]
+            start = time.perf_counter()
+            for action in actions:
+                _, _, terminated, truncated, _ = envs[0].step(action)
+                if truncated:
+                    envs[0].reset()
+            print(f"{env_id:<20}{block_size:>11}{(time.perf_counter() - start) * 1e6 / args.num_steps:>9.1f}")
+
+
+def benchmark_memory(args):
+    """Peak memory and time of training with rollout storage on the device vs memory-bounded (--memory-cap-mb)."""
+    base_argv = ["--env-id", args.env_id, "--cuda", "false", "--num-envs", str(args.num_envs),
+                 "--num-steps", str(args.num_steps), "--num-minibatches", str(args.num_minibatches), "--seed", str(args.seed)]
+    obs_mb = args.num_envs * args.num_steps * 4 * 7 * 7 / 2**20
+    print(f"{args.num_envs} envs x {args.num_steps} steps: float32 observations {4 * obs_mb:.0f} MB, uint8 {obs_mb:.0f} MB\n")
+    print(f"{'memory cap (MB)':<18}{'obs storage':>14}{'peak RSS (MB)':>15}{'collect (s)':>13}{'update (s)':>12}{'final ret':>11}")
+    for cap in [0] + args.caps:
+        result = launch_training(base_argv + ["--memory-cap-mb", str(cap)], args.num_updates)
+        storage = "device" if cap == 0 else "host" if obs_mb <= cap else "memory-mapped"
+        print(f"{cap if cap else '-':<18}{storage:>14}{result['peak_rss_mb']:>15.0f}{np.sum(result['collect_times']):>13.2f}"
+              f"{np.sum(result['update_times']):>12.2f}{np.nanmean(result['mean_returns']):>11.3f}")
+
+
+def benchmark_dedup(args):
+    """Memory and PPO update time of deduplicated observations on the exp-2 configs, and equivalence of the updates."""
+    import copy
+    import torch
+    from train import parse_args, setup_torch, build_training
+
+    print(f"{'env':<18}{'distinct obs':>14}{'obs (MB)':>10}{'dedup (MB)':>12}"
+          f"{'update (s)':>12}{'dedup (s)':>11}{'speedup':>9}{'max Δ param':>13}")
+    for env_id in args.env_ids:
+        train_args = parse_args(["--env-id", env_id, "--num-envs", str(args.num_envs), "--num-steps", str(args.num_steps),
+                                 "--ent-coef", "0.02", "--dedup-obs", "--seed", str(args.seed), "--torch-threads", str(args.threads),
+                                 "--wandb", "false", "--plot", "false", "--verbose", "false", "--cuda", "false"])
+        setup_torch(train_args)
+        envs, agent, storage, ppo = build_training(train_args, run_name="benchmark")
+        batch, stats = storage.collect_trajectories()
+        envs.close()
+        dense = {key: value for key, value in batch.items() if key not in ("obs_table", "obs_idx")}
+        dense["obs"] = batch["obs_table"][batch["obs_idx"]]
+        dense_mb = dense["obs"].nelement() * dense["obs"].element_size() / 2**20
+        dedup_mb = sum(batch[key].nelement() * batch[key].element_size() for key in ("obs_table", "obs_idx")) / 2**20
+
+        # the same update (same initial weights and minibatches) on both batches
+        initial = copy.deepcopy(agent.state_dict()), copy.deepcopy(ppo.optimizer.state_dict())
+        update_times, params = [], []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for update_batch in (dense, batch):
+                agent.load_state_dict(initial[0])
+                ppo.optimizer.load_state_dict(initial[1])
+                np.random.seed(args.seed)
+                start = time.perf_counter()
+                ppo.update_ppo_agent(update_batch, save_path=os.path.join(tmp_dir, "actor.pth"))
+                update_times.append(time.perf_counter() - start)
+                params.append(torch.cat([p.detach().flatten().clone() for p in agent.parameters()]))
+        print(f"{env_id:<18}{stats['unique_obs']:>14}{dense_mb:>10.2f}{dedup_mb:>12.3f}{update_times[0]:>12.2f}"
+              f"{update_times[1]:>11.2f}{update_times[0] / update_times[1]:>9.2f}{(params[0] - params[1]).abs().max().item():>13.2e}")
+
+
+def benchmark_rewards(args):
+    """Returns of several reward configurations from one rollout vs one rollout per configuration."""
+    import gymnasium as gym
+    from customenvs import ENERGY_ENVS
+    from utils import TimeCostWrapper
+    from rewards import MultiRewardWrapper, reward_configs_from_csv, config_name
+
+    def make_env(env_id, config=None):
+        if env_id in ENERGY_ENVS:
+            config = config or {}
+            return ENERGY_ENVS[env_id](agent_start_dir="random", time_bonus=config.get("time_bonus", 0.1),
+                                       box_open_reward=config.get("box_reward", 0))
+        env = gym.make(env_id)
+        if config is None:
+            return env
+        return TimeCostWrapper(env, time_cost=config.get("time_cost", 0.01), action_cost=config.get("action_cost", 0.01),
+                               final_reward_penalty=config.get("final_reward_penalty", False), noops_actions=[4, 6])
+
+    def run(env, actions):
+        """Returns (and last infos) of one episode per seed with the random `actions`, reset with seeds 0, 1, ..."""
+        returns, infos, t = [], [], 0
+        for seed in range(args.num_episodes):
+            env.reset(seed=seed)
+            episode_return = 0
+            while True:
+                _, reward, terminated, truncated, info = env.step(actions[t % len(actions)])
+                episode_return += reward
+                t += 1
+                if terminated or truncated:
+                    break
+            returns.append(episode_return)
+            infos.append(info)
+        return np.array(returns), infos
+
+    actions = np.random.default_rng(args.seed).integers(0, 7, size=100000)
+    for env_id, experiments in zip(args.env_ids, args.experiments):
+        configs = reward_configs_from_csv(experiments, env_id)
+        start = time.perf_counter()
+        _, infos = run(MultiRewardWrapper(make_env(env_id), configs), actions)
+        multi_time = time.perf_counter() - start
+        config_returns = np.array([info["config_returns"] for info in infos])
+
+        print(f"\n{env_id} ({experiments}, {args.num_episodes} random episodes)")
+        print(f"{'reward config':<60}{'mean return':>13}{'max |diff|':>12}")
+        separate_time = 0
+        for i, config in enumerate(configs):
+            start = time.perf_counter()
+            returns, _ = run(make_env(env_id, config), actions)
+            separate_time += time.perf_counter() - start
+            print(f"{config_name(config):<60}{returns.mean():>13.3f}{np.abs(returns - config_returns[:, i]).max():>12.2e}")
+        print(f"one rollout per config: {separate_time:.2f} s, one rollout for all configs: {multi_time:.2f} s "
+              f"({separate_time / multi_time:.2f}x)")
+
+
+def benchmark_encoder(args):
+    """Conv vs embedding input encoder: equivalence to a one-hot conv, inference latency, update time and learning curves."""
+    import torch
+    import torch.nn.functional as F
+    from models import MiniGridAgent, EmbeddingConvBase
+
+    torch.set_num_threads(args.threads)
+    # the embedding layer is a 3x3 conv over the one-hot planes
+    encoder = EmbeddingConvBase()
+    obs = torch.stack([torch.randint(0, size, (64, 7, 7)) for size in encoder.VOCAB_SIZES], dim=1)
+    one_hot = torch.cat([F.one_hot(obs[:, p], size).permute(0, 3, 1, 2) for p, size in enumerate(encoder.VOCAB_SIZES)], dim=1)
+    weight = encoder.conv_weight()
+    error = (encoder.first_layer(obs) - F.conv2d(one_hot.float(), weight, encoder.bias, padding=1)).abs().max().item()
+    print(f"max difference to the one-hot conv: {error:.2e}\n")
+
+    print(f"{'env':<26}{'encoder':<11}{'batch 1 (ms)':>14}{'batch 256 (ms)':>16}")
+    for env_id in args.env_ids:
+        agents = {name: MiniGridAgent((4, 7, 7), 7, encoder=name).eval() for name in ("conv", "embedding")}
+        observations = collect_observations(["--env-id", env_id, "--seed", str(args.seed)], agents["conv"], 1024)
+        for name, agent in agents.items():
+            inputs = observations.to(torch.uint8) if name == "embedding" else observations
+            with torch.inference_mode():
+                print(f"{env_id:<26}{name:<11}{median_latency(agent, inputs[:1], args.repeats):>14.3f}"
+                      f"{median_latency(agent, inputs[:256], args.repeats):>16.3f}")
+
+    for env_id in args.env_ids:
+        print(f"\nTraining on {env_id}")
+        base_argv = ["--env-id", env_id, "--cuda", "false", "--num-envs", str(args.num_envs), "--num-steps", str(args.num_steps),
+                     "--torch-threads", str(args.threads)]
+        compare_training([("conv", []), ("embedding", ["--encoder", "embedding"])], base_argv, args.seeds, args.num_updates,
+                         output=args.output.format(env_id=env_id) if args.output else None)
+
+
+def collect_observations(train_argv, agent, num_steps):
+    """Observations visited by `agent` on the train.py envs configured by `train_argv`."""
+    import gymnasium as gym
+    import torch
+    from train import parse_args, make_env
+    from utils import get_state_tensor
+
+    args = parse_args(train_argv)
+    envs = gym.vector.SyncVectorEnv([make_env(args, idx, "benchmark") for idx in range(args.num_envs)])
+    state = envs.reset(seed=args.seed)[0]
+    observations = []
+    for _ in range(num_steps // args.num_envs):
+        obs = get_state_tensor(state)
+        observations.append(obs)
+        with torch.inference_mode():
+            action = agent.get_action_and_value(obs)[0]
+        state = envs.step(action.numpy())[0]
+    envs.close()
+    return torch.cat(observations)
+
+
+def median_latency(policy, obs, repeats):
+    """Median wall time (ms) of a forward pass of `policy` on `obs`."""
+    for _ in range(10):
+        policy(obs)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        policy(obs)
+        times.append((time.perf_counter() - start) * 1000)
+    return float(np.median(times))
+
+
+def benchmark_weights(args):
+    """Load time of pickled agents vs memory-mapped checkpoints, converted in a temporary copy of trained-models."""
+    import glob
+    import shutil
+    import torch
+    from weightstore import convert, load_agent, load_forward, read_header
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pth_paths = []
+        for path in sorted(glob.glob(os.path.join(args.models_dir, "*", "actor_*.pth"))):
+            copy = os.path.join(tmp_dir, os.path.basename(os.path.dirname(path)), os.path.basename(path))
+            os.makedirs(os.path.dirname(copy), exist_ok=True)
+            shutil.copy(path, copy)
+            pth_paths.append(copy)
+        json_paths = [convert(path)[0] for path in pth_paths]
+        blobs = {read_header(path)["blob"] for path in json_paths}
+        print(f"{len(pth_paths)} agents, {len(blobs)} distinct blobs\n")
+
+        obs = torch.rand(1, 4, 7, 7)
+        loaders = {"torch.load (.pth)": (pth_paths, lambda path: torch.load(path, map_location="cpu", weights_only=False)),
+                   "load_agent (.json)": (json_paths, load_agent),
+                   "load_forward (.json)": (json_paths, load_forward)}
+        print(f"{'loader':<24}{'ms/agent':>10}{'first forward (ms)':>20}")
+        for name, (paths, load) in loaders.items():
+            policies = [load(path) for path in paths] # warm up the page cache and lazy imports
+            start = time.perf_counter()
+            for _ in range(args.repeats):
+                policies = [load(path) for path in paths]
+            load_time = (time.perf_counter() - start) / (args.repeats * len(paths))
+            start = time.perf_counter()
+            with torch.inference_mode():
+                for policy in policies:
+                    policy(obs)
+            print(f"{name:<24}{load_time * 1000:>10.3f}{(time.perf_counter() - start) * 1000 / len(paths):>20.3f}")
+
+
+def benchmark_catalogue(args):
+    """Indexed queries of the run catalogue vs the same conditions on the args json (full table scan)."""
+    import re
+    import copy
+    from train import parse_args
+    from catalogue import Catalogue
+
+    rng = np.random.default_rng(0)
+    base = parse_args([])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        catalogue = Catalogue(os.path.join(tmp_dir, "runs.sqlite"))
+        start = time.perf_counter()
+        for i in range(args.num_runs):
+            run_args = copy.copy(base)
+            run_args.env_id = rng.choice(["EnergyBoxes", "EnergyBoxesHard", "EnergyBoxesDelay", "MiniGrid-Empty-8x8-v0"])
+            run_args.seed = int(rng.integers(1000))
+            run_args.time_bonus = float(rng.choice([0.01, 0.05, 0.1, 0.2]))
+            run_args.box_reward = float(rng.choice([0., 0.5, 1.]))
+            catalogue.register_run(f"run_{i}", run_args)
+            catalogue.finish_run(f"run_{i}", {"average_return": rng.normal(), "timestep": run_args.total_timesteps})
+        print(f"Registered {args.num_runs} runs in {time.perf_counter() - start:.1f}s\n")
+
+        queries = {"env and seed range": ("env_id = ? AND seed < ?", ("EnergyBoxesHard", 50)),
+                   "env, reward and seed": ("env_id = ? AND time_bonus = ? AND box_reward = ? AND seed < ?",
+                                            ("EnergyBoxesHard", 0.1, 0.5, 500))}
+        print(f"{'query':<24}{'runs':>6}{'indexed (ms)':>14}{'json scan (ms)':>16}")
+        for name, (where, params) in queries.items():
+            scan_where = re.sub(r"\b(env_id|seed|time_bonus|box_reward)\b", r"json_extract(args, '$.\1')", where)
+            times = []
+            for condition in (where, scan_where):
+                start = time.perf_counter()
+                for _ in range(args.repeats):
+                    runs = catalogue.select(condition, params, metrics=True)
+                times.append((time.perf_counter() - start) * 1000 / args.repeats)
+            print(f"{name:<24}{len(runs):>6}{times[0]:>14.2f}{times[1]:>16.2f}")
+        catalogue.close()
+
+
+def benchmark_export(args):
+    """Per-step latency and action agreement of the exported (and int8) policies against the pickled agent."""
+    import torch
+    from export import export_agent, load_policy
+
+    torch.set_num_threads(args.threads)
+    agent = load_policy(args.agent_path)
+    policies = {"eager (.pth)": agent}
+    for path in export_agent(args.agent_path, args.formats, quantize=True):
+        policies[os.path.basename(path)] = load_policy(path)
+
+    train_argv = ["--env-id", args.env_id, "--fully-obs", str(args.fully_obs), "--seed", str(args.seed)]
+    observations = collect_observations(train_argv, agent, args.num_steps)
+    reference = agent(observations)[0].detach()
+
+    print(f"{len(observations)} observations visited by the agent on {args.env_id}")
+    print(f"{'policy':<36}{'batch 1 (ms)':>14}{'batch 256 (ms)':>16}{'greedy agreement':>18}{'max Δ logit':>13}")
+    for name, policy in policies.items():
+        logits = policy(observations)[0]
+        agreement = (logits.argmax(dim=1) == reference.argmax(dim=1)).float().mean().item()
+        print(f"{name:<36}{median_latency(policy, observations[:1], args.repeats):>14.3f}"
+              f"{median_latency(policy, observations[:256], args.repeats):>16.3f}"
+              f"{agreement:>18.4f}{(logits - reference).abs().max().item():>13.4f}")
+
+
+def count_decoded_frames(path):
+    """Frames decoded back from a captured gif (by PIL, as gif viewers) or video (by ffmpeg)."""
+    if path.endswith(".gif"):
+        from PIL import Image, ImageSequence
+        with Image.open(path) as image:
+            return sum(1 for frame in ImageSequence.Iterator(image) if frame.load() is not None)
+    import imageio_ffmpeg
+    reader = imageio_ffmpeg.read_frames(path)
+    next(reader) # metadata
+    return sum(1 for _ in reader)
+
+
+def benchmark_capture(args):
+    """Write throughput of the streamed trajectory captures, checking they decode back to every frame."""
+    import gymnasium as gym
+    from capture import TrajectoryWriter
+
+    env = gym.make(args.env_id, render_mode="rgb_array")
+    env.reset(seed=args.seed)
+    rng = np.random.default_rng(args.seed)
+    frames = []
+    for action in rng.integers(0, env.action_space.n, size=args.num_frames):
+        frames.append(env.render())
+        if any(env.step(action)[2:4]):
+            env.reset()
+
+    print(f"{'format':<8}{'frames':>8}{'decoded':>9}{'frames/s':>10}{'size (kB)':>11}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for extension in args.formats:
+            path = os.path.join(tmp_dir, f"trajectory.{extension}")
+            start = time.perf_counter()
+            with TrajectoryWriter(path) as writer:
+                for t, frame in enumerate(frames):
+                    writer.append(frame, texts=[((10, 10), f"step {t}")])
+            elapsed = time.perf_counter() - start
+            decoded = count_decoded_frames(path)
+            print(f"{extension:<8}{writer.num_frames:>8}{decoded:>9}{writer.num_frames / elapsed:>10.0f}"
+                  f"{os.path.getsize(path) / 1024:>11.1f}")
+            assert decoded == writer.num_frames, f"{path} decodes to {decoded} of {writer.num_frames} frames"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Performance benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    run_parser = subparsers.add_parser("run", help="(internal) train for a few updates and print a json summary")
+    run_parser.add_argument("--num-updates", type=int, default=10)
+    run_parser.add_argument("train_argv", nargs=argparse.REMAINDER)
+
+    precision_parser = subparsers.add_parser("precision", help="fp32 vs bf16/channels_last CPU training")
+    precision_parser.add_argument("--env-id", type=str, default="EnergyBoxes")
+    precision_parser.add_argument("--num-updates", type=int, default=30)
+    precision_parser.add_argument("--num-envs", type=int, default=32)
+    precision_parser.add_argument("--num-steps", type=int, default=256)
+    precision_parser.add_argument("--threads", type=int, default=4)
+    precision_parser.add_argument("--interop-threads", type=int, default=1)
+    precision_parser.add_argument("--seeds", type=int, nargs="+", default=[1, 2, 3])
+    precision_parser.add_argument("--output", type=str, default="outputs/benchmark-precision.json")
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="sequential vs pipelined collection/update")
+    pipeline_parser.add_argument("--env-id", type=str, default="EnergyBoxes")
+    pipeline_parser.add_argument("--num-updates", type=int, default=30)
+    pipeline_parser.add_argument("--num-envs", type=int, default=32)
+    pipeline_parser.add_argument("--num-steps", type=int, default=512)
+    pipeline_parser.add_argument("--max-policy-lags", type=int, nargs="+", default=[1, 2])
+    pipeline_parser.add_argument("--seeds", type=int, nargs="+", default=[1, 2, 3])
+    pipeline_parser.add_argument("--output", type=str, default="outputs/benchmark-pipeline.json")
+
+    startup_parser = subparsers.add_parser("startup", help="import time of the entry-point scripts")
+    startup_parser.add_argument("--scripts", type=str, nargs="+", default=["train.py", "evaluation.py", "exploitation.py"])
+    startup_parser.add_argument("--repeats", type=int, default=5)
+    startup_parser.add_argument("--top", type=int, default=5)
+    startup_parser.add_argument("--output", type=str, default="outputs/startup-times.csv")
+
+    fullyobs_parser = subparsers.add_parser("fullyobs", help="incremental vs upstream FullyObsWrapper")
+    fullyobs_parser.add_argument("--env-ids", type=str, nargs="+",
+                                 default=["MiniGrid-Empty-16x16-v0", "MiniGrid-FourRooms-v0", "MiniGrid-DoorKey-8x8-v0",
+                                          "MiniGrid-Dynamic-Obstacles-6x6-v0", "EnergyBoxes"])
+    fullyobs_parser.add_argument("--num-steps", type=int, default=20000)
+    fullyobs_parser.add_argument("--seed", type=int, default=1)
+
+    layouts_parser = subparsers.add_parser("layouts", help="reset throughput of regenerated vs pooled layouts")
+    layouts_parser.add_argument("--env-ids", type=str, nargs="+",
+                                default=["MiniGrid-DoorKey-8x8-v0", "MiniGrid-SimpleCrossingS9N2-v0", "MiniGrid-FourRooms-v0"])
+    layouts_parser.add_argument("--num-layouts", type=int, default=1000)
+    layouts_parser.add_argument("--num-resets", type=int, default=20000)
+    layouts_parser.add_argument("--num-envs", type=int, default=8,
+                                help="envs of the vector env whose starting layouts must be distinct")
+    layouts_parser.add_argument("--check-steps", type=int, default=20,
+                                help="random steps compared after each reset of the equivalence check")
+
+    sampling_parser = subparsers.add_parser("sampling", help="Categorical vs Gumbel-max rollout action sampling")
+    sampling_parser.add_argument("--num-envs", type=int, default=32)
+    sampling_parser.add_argument("--num-steps", type=int, default=256)
+    sampling_parser.add_argument("--num-actions", type=int, default=7)
+    sampling_parser.add_argument("--num-samples", type=int, default=1000000,
+                                 help="samples of the distributional check")
+    sampling_parser.add_argument("--threads", type=int, default=1)
+    sampling_parser.add_argument("--seed", type=int, default=1)
+
+    rng_parser = subparsers.add_parser("rng", help="EnergyBoxes random numbers drawn one at a time vs in blocks")
+    rng_parser.add_argument("--block-size", type=int, default=1024)
+    rng_parser.add_argument("--num-draws", type=int, default=200000)
+    rng_parser.add_argument("--num-steps", type=int, default=50000)
+    rng_parser.add_argument("--seed", type=int, default=1)
+
+    memory_parser = subparsers.add_parser("memory", help="device vs memory-bounded rollout storage and PPO updates")
+    memory_parser.add_argument("--env-id", type=str, default="EnergyBoxesDelay")
+    memory_parser.add_argument("--num-envs", type=int, default=128)
+    memory_parser.add_argument("--num-steps", type=int, default=1024)
+    memory_parser.add_argument("--num-minibatches", type=int, default=4)
+    memory_parser.add_argument("--num-updates", type=int, default=2)
+    memory_parser.add_argument("--caps", type=float, nargs="+", default=[256, 16],
+                               help="memory caps (MB) to compare against unbounded training")
+    memory_parser.add_argument("--seed", type=int, default=1)
+
+    dedup_parser = subparsers.add_parser("dedup", help="PPO update on deduplicated vs dense observations (exp-2 envs)")
+    dedup_parser.add_argument("--env-ids", type=str, nargs="+", default=["EnergyBoxes", "EnergyBoxesHard", "EnergyBoxesDelay"])
+    dedup_parser.add_argument("--num-envs", type=int, default=32)
+    dedup_parser.add_argument("--num-steps", type=int, default=512)
+    dedup_parser.add_argument("--threads", type=int, default=1)
+    dedup_parser.add_argument("--seed", type=int, default=1)
+
+    rewards_parser = subparsers.add_parser("rewards", help="returns of several reward configurations from one rollout")
+    rewards_parser.add_argument("--env-ids", type=str, nargs="+", default=["MiniGrid-Empty-16x16-v0", "EnergyBoxes"])
+    rewards_parser.add_argument("--experiments", type=str, nargs="+", default=["experiments/exp-1-mc.csv", "experiments/exp-2.csv"],
+                                help="experiment csv of the reward configurations of each env")
+    rewards_parser.add_argument("--num-episodes", type=int, default=100)
+    rewards_parser.add_argument("--seed", type=int, default=1)
+
+    encoder_parser = subparsers.add_parser("encoder", help="conv vs embedding input encoder")
+    encoder_parser.add_argument("--env-ids", type=str, nargs="+", default=["MiniGrid-Empty-16x16-v0", "EnergyBoxes"])
+    encoder_parser.add_argument("--num-updates", type=int, default=30)
+    encoder_parser.add_argument("--num-envs", type=int, default=32)
+    encoder_parser.add_argument("--num-steps", type=int, default=256)
+    encoder_parser.add_argument("--threads", type=int, default=1)
+    encoder_parser.add_argument("--repeats", type=int, default=200)
+    encoder_parser.add_argument("--seed", type=int, default=1)
+    encoder_parser.add_argument("--seeds", type=int, nargs="+", default=[1, 2, 3])
+    encoder_parser.add_argument("--output", type=str, default="outputs/benchmark-encoder-{env_id}.json")
+
+    weights_parser = subparsers.add_parser("weights", help="load time of pickled vs memory-mapped agents")
+    weights_parser.add_argument("--models-dir", type=str, default="trained-models")
+    weights_parser.add_argument("--repeats", type=int, default=20)
+
+    catalogue_parser = subparsers.add_parser("catalogue", help="indexed queries of the run catalogue vs full scans")
+    catalogue_parser.add_argument("--num-runs", type=int, default=10000)
+    catalogue_parser.add_argument("--repeats", type=int, default=20)
+
+    export_parser = subparsers.add_parser("export", help="latency and action agreement of exported policies")
+    export_parser.add_argument("--agent-path", type=str, required=True)
+    export_parser.add_argument("--env-id", type=str, default="EnergyBoxes")
+    export_parser.add_argument("--fully-obs", type=str, default="false")
+    export_parser.add_argument("--formats", type=str, nargs="+", default=["torchscript", "onnx"])
+    export_parser.add_argument("--num-steps", type=int, default=4096,
+                               help="number of observations the agreement is measured on")
+    export_parser.add_argument("--repeats", type=int, default=200)
+    export_parser.add_argument("--threads", type=int, default=1)
+    export_parser.add_argument("--seed", type=int, default=1)
+
+    capture_parser = subparsers.add_parser("capture", help="write throughput of streamed gif/video captures")
+    capture_parser.add_argument("--env-id", type=str, default="MiniGrid-DoorKey-8x8-v0")
+    capture_parser.add_argument("--formats", type=str, nargs="+", default=["gif", "mp4"])
+    capture_parser.add_argument("--num-frames", type=int, default=300)
+    capture_parser.add_argument("--seed", type=int, default=1)
+
+    args = parser.parse_args()
+
+    if args.benchmark == "run":
+        train_argv = [a for a in args.train_argv if a != "--"]
+        print(json.dumps(run_training(train_argv, args.num_updates)))
+    elif args.benchmark == "precision":
+        benchmark_precision(args)
+    elif args.benchmark == "pipeline":
+        benchmark_pipeline(args)
+    elif args.benchmark == "startup":
+        benchmark_startup(args)
+    elif args.benchmark == "fullyobs":
+        benchmark_fullyobs(args)
+    elif args.benchmark == "layouts":
+        benchmark_layouts(args)
+    elif args.benchmark == "sampling":
+        benchmark_sampling(args)
+    elif args.benchmark == "rng":
+        benchmark_rng(args)
+    elif args.benchmark == "memory":
+        benchmark_memory(args)
+    elif args.benchmark == "dedup":
+        benchmark_dedup(args)
+    elif args.benchmark == "rewards":
+        benchmark_rewards(args)
+    elif args.benchmark == "encoder":
+        benchmark_encoder(args)
+    elif args.benchmark == "weights":
+        benchmark_weights(args)
+    elif args.benchmark == "catalogue":
+        benchmark_catalogue(args)
+    elif args.benchmark == "export":
+        benchmark_export(args)
+    elif args.benchmark == "capture":
+        benchmark_capture(args)
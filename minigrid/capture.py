@@ -0,0 +1,61 @@
+import os
+import numpy as np
+
+
+class TrajectoryWriter:
+    """
+    Streams rendered frames to a gif or video file as they are produced,
+    so memory does not grow with the number of captured timesteps.
+    Text overlays are drawn onto a single reused canvas.
+    """
+
+    def __init__(self, path, duration=0.1):
+        """
+        Args:
+            path: output file, the format (`.gif`, `.mp4`, ...) is chosen from its extension, encoded by ffmpeg
+            duration: time per frame in seconds
+        """
+        # imported lazily, only needed when capturing
+        from PIL import Image, ImageDraw
+        self._image, self._image_draw = Image, ImageDraw
+        self.path = path
+        self.duration = duration
+        self.writer = None
+        self.canvas = None
+        self.draw = None
+        self.num_frames = 0
+
+    def _open(self, width, height):
+        # ffmpeg encodes each frame as it is sent, imageio's PIL gif writer writes corrupt gifs with Pillow >= 10
+        import imageio_ffmpeg
+        if os.path.splitext(self.path)[1].lower() == ".gif":
+            options = dict(codec="gif", pix_fmt_out="rgb8", macro_block_size=1, output_params=["-loop", "0", "-sws_dither", "none"])
+        else:
+            options = {}
+        self.writer = imageio_ffmpeg.write_frames(self.path, (width, height), fps=1 / self.duration, **options)
+        self.writer.send(None)
+
+    def append(self, frame, texts=()):
+        """Writes an RGB frame with `texts`, a list of ((x, y), text) overlays."""
+        height, width = frame.shape[:2]
+        if self.writer is None:
+            self._open(width, height)
+        if self.canvas is None or self.canvas.size != (width, height):
+            self.canvas = self._image.new("RGB", (width, height))
+            self.draw = self._image_draw.Draw(self.canvas)
+        self.canvas.frombytes(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+        for xy, text in texts:
+            self.draw.text(xy, text)
+        self.writer.send(np.asarray(self.canvas))
+        self.num_frames += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
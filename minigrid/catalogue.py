@@ -0,0 +1,142 @@
+"""
+Local SQLite catalogue of training runs.
+
+train.py --catalogue runs.sqlite registers every run in the catalogue: its full arguments, git
+commit, start and end time, status, final metrics and artifact paths. The configuration
+options of the experiment csvs are indexed columns, so runs are selected with plain SQL:
+
+    from catalogue import Catalogue
+    runs = Catalogue().select("env_id = ? AND time_bonus = ? AND seed < ?", ("EnergyBoxesHard", 0.1, 50))
+
+    python catalogue.py --where "env_id = 'EnergyBoxesHard' AND time_bonus = 0.1 AND seed < 50"
+
+Options that are not columns can be queried with json_extract(args, '$.<option>').
+"""
+import os
+import json
+import sqlite3
+import argparse
+import subprocess
+from datetime import datetime
+from functools import lru_cache
+
+# indexed configuration columns and their types, the other options are only in the args json
+CONFIG_COLUMNS = {
+    "env_id": "TEXT", "seed": "INTEGER", "exp_name": "TEXT", "wandb_project": "TEXT",
+    "total_timesteps": "INTEGER", "num_envs": "INTEGER", "num_steps": "INTEGER",
+    "learning_rate": "REAL", "ent_coef": "REAL", "gamma": "REAL", "gae_lambda": "REAL",
+    "time_cost": "REAL", "action_cost": "REAL", "final_reward_penalty": "INTEGER",
+    "cont_energy_wrapper": "INTEGER", "time_bonus": "REAL", "box_reward": "REAL",
+    "refuel_goal": "REAL", "initial_energy": "REAL", "fully_obs": "INTEGER",
+}
+RUN_COLUMNS = {
+    "run_name": "TEXT PRIMARY KEY", **CONFIG_COLUMNS, "args": "TEXT", "git_hash": "TEXT",
+    "status": "TEXT", "start_time": "TEXT", "end_time": "TEXT", "artifacts": "TEXT",
+}
+
+
+@lru_cache(maxsize=None)
+def git_hash():
+    """Commit of the code a run is trained with, None outside of a git checkout."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def now():
+    return datetime.now().isoformat(sep=" ", timespec="seconds")
+
+
+class Catalogue:
+    """Runs and their final metrics, the database is created on first use."""
+
+    def __init__(self, path="runs.sqlite"):
+        self.path = path
+        # many runs of a sweep may finish at the same time, wait for the write lock
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS runs "
+                                    f"({', '.join(f'{name} {kind}' for name, kind in RUN_COLUMNS.items())})")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS metrics (run_name TEXT, key TEXT, value REAL, "
+                                    "PRIMARY KEY (run_name, key))")
+            for column in CONFIG_COLUMNS:
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS runs_{column} ON runs ({column})")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS runs_env_seed ON runs (env_id, seed)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS metrics_key ON metrics (key, value)")
+
+    def register_run(self, run_name, args, artifacts=None):
+        """Adds a run (or restarts a resumed one, keeping its start time) with status 'running'."""
+        options = vars(args)
+        row = {"run_name": run_name, **{column: options.get(column) for column in CONFIG_COLUMNS},
+               "args": json.dumps(options, default=str), "git_hash": git_hash(), "status": "running",
+               "start_time": now(), "end_time": None, "artifacts": json.dumps(artifacts or {})}
+        updates = ", ".join(f"{column} = excluded.{column}" for column in row if column not in ("run_name", "start_time"))
+        with self.connection:
+            self.connection.execute(f"INSERT INTO runs ({', '.join(row)}) VALUES ({', '.join('?' * len(row))}) "
+                                    f"ON CONFLICT (run_name) DO UPDATE SET {updates}", list(row.values()))
+
+    def finish_run(self, run_name, metrics=None, status="finished"):
+        """Sets the end time, status and final metrics of a run."""
+        with self.connection:
+            self.connection.execute("UPDATE runs SET status = ?, end_time = ? WHERE run_name = ?", (status, now(), run_name))
+            if metrics:
+                self.connection.executemany("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?)",
+                                            [(run_name, key, float(value)) for key, value in metrics.items()])
+
+    def select(self, where="1", params=(), metrics=False):
+        """
+        Runs matching the SQL condition `where` (with `?` placeholders for `params`), as dicts
+        with the args and artifacts decoded, and with their final metrics if `metrics`.
+        """
+        rows = [dict(row) for row in self.connection.execute(f"SELECT * FROM runs WHERE {where} ORDER BY run_name", params)]
+        for row in rows:
+            row["args"], row["artifacts"] = json.loads(row["args"]), json.loads(row["artifacts"])
+        if metrics and rows:
+            names = [row["run_name"] for row in rows]
+            values = {}
+            for start in range(0, len(names), 500): # sqlite bound parameters limit
+                chunk = names[start:start + 500]
+                for name, key, value in self.connection.execute(
+                        f"SELECT run_name, key, value FROM metrics WHERE run_name IN ({', '.join('?' * len(chunk))})", chunk):
+                    values.setdefault(name, {})[key] = value
+            for row in rows:
+                row["metrics"] = values.get(row["run_name"], {})
+        return rows
+
+    def run_names(self, where="1", params=()):
+        return [row[0] for row in self.connection.execute(f"SELECT run_name FROM runs WHERE {where} ORDER BY run_name", params)]
+
+    def close(self):
+        self.connection.close()
+
+
+def update_catalogue(path, method, *args, **kwargs):
+    """Calls Catalogue(path).<method>, a database error only prints a warning: bookkeeping never stops a run."""
+    try:
+        catalogue = Catalogue(path)
+        try:
+            getattr(catalogue, method)(*args, **kwargs)
+        finally:
+            catalogue.close()
+    except sqlite3.Error as e:
+        print(f"Warning: could not {method.replace('_', ' ')} in the run catalogue {path}: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the run catalogue")
+    parser.add_argument("--catalogue", type=str, default="runs.sqlite")
+    parser.add_argument("--where", type=str, default="1",
+                        help="SQL condition on the runs table, e.g. \"env_id = 'EnergyBoxesHard' AND time_bonus = 0.1 AND seed < 50\"")
+    parser.add_argument("--metrics", type=str, nargs="*", default=["average_return"],
+                        help="final metrics to print")
+    args = parser.parse_args()
+
+    runs = Catalogue(args.catalogue).select(args.where, metrics=True)
+    print(f"{'run':<32}{'env':<20}{'seed':>6}{'status':>10}  {'start':<20}"
+          + "".join(f"{key:>22}" for key in args.metrics))
+    for run in runs:
+        print(f"{run['run_name']:<32}{run['env_id']:<20}{run['seed']:>6}{run['status']:>10}  {run['start_time']:<20}"
+              + "".join(f"{run['metrics'].get(key, float('nan')):>22.3f}" for key in args.metrics))
+    print(f"{len(runs)} runs")
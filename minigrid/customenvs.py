@@ -58,6 +58,29 @@ class SimpleFoodBox(WorldObj):
             fill_coords(img, point_in_circle(0.5, 0.5, 0.2), c)
             return
 
+class BlockRNG:
+    """
+    Uniform draws of a numpy Generator, buffered `block_size` at a time: one Generator
+    call per block instead of one per draw. The blocks are drawn in order from the
+    generator, so the draws are reproducible from its seed.
+    """
+
+    def __init__(self, generator, block_size=1024):
+        self.generator = generator
+        self.block_size = block_size
+        self.block, self.idx = [], 0
+
+    def uniform(self):
+        if self.idx == len(self.block):
+            self.block, self.idx = self.generator.random(self.block_size).tolist(), 0
+        self.idx += 1
+        return self.block[self.idx - 1]
+
+    def integers(self, high):
+        """Uniform integer in [0, high), from a single uniform draw."""
+        return int(self.uniform() * high)
+
+
 class EnergyBoxesEnv(MiniGridEnv):
 
     def __init__(
@@ -73,12 +96,15 @@ class EnergyBoxesEnv(MiniGridEnv):
         box_energy_refuel=8,
         seed=0,
         track_timestep_counts=False,
+        rng_block_size=0,
         **kwargs,
     ):  
         
         # set seed
         self.seed = seed
         self.np_random, _ = seeding.np_random(self.seed)
+        # refills and start states draw from blocks of uniforms (0 draws one at a time from np_random)
+        self.rng = BlockRNG(self.np_random, rng_block_size) if rng_block_size > 0 else None
 
         self.width = size
         self.height = size
@@ -125,11 +151,18 @@ class EnergyBoxesEnv(MiniGridEnv):
             **kwargs,
         )
 
+    def _uniform(self):
+        return self.rng.uniform() if self.rng is not None else self.np_random.uniform()
+
     def _rand_pos(self):
+        if self.rng is not None:
+            return [(1,1), (self.width-2, self.height-2)][self.rng.integers(2)]
         pos = self.np_random.choice([(1,1), (self.width-2, self.height-2)])
         return pos
     
     def _rand_dir(self):
+        if self.rng is not None:
+            return self.rng.integers(4)
         return self.np_random.integers(0, 4)
 
     @staticmethod
@@ -148,7 +181,7 @@ class EnergyBoxesEnv(MiniGridEnv):
         self.grid.set(*self.box_positions[1], SimpleFoodBox(COLOR_NAMES[4])) # red
 
         # Put food in one of the boxes at random
-        if self.np_random.uniform() < 0.5:
+        if self._uniform() < 0.5:
             self.grid.get(*self.box_positions[0]).state = 1
         else:
             self.grid.get(*self.box_positions[1]).state = 1
@@ -162,10 +195,15 @@ class EnergyBoxesEnv(MiniGridEnv):
 
         self.mission = EnergyBoxesEnv._gen_mission()
 
-    def reset(self, **kwargs):
+    def reset(self, *, seed=None, options=None):
 
         #self.np_random, self.seed = seeding.np_random(self.seed) # reset seed
-        obs = super().reset()
+        # a seed reseeds np_random (and its blocks), so that the episode only depends on the seed and the actions
+        if seed is not None:
+            self.np_random, _ = seeding.np_random(seed)
+            if self.rng is not None:
+                self.rng = BlockRNG(self.np_random, self.rng.block_size)
+        obs = super().reset(options=options)
 
         self.agent_pos = self._rand_pos() if self.start_pos_random else self.agent_start_pos
         self.agent_dir = self._rand_dir() if self.start_dir_random else self.agent_start_dir
@@ -204,7 +242,7 @@ class EnergyBoxesEnv(MiniGridEnv):
         for box_pos in self.box_positions:
             box = self.grid.get(*box_pos)
             if box.state == 0: # empty -> full with some probability
-                if self.np_random.uniform() < self.refill_prob:
+                if self._uniform() < self.refill_prob:
                     box.state = 1
         
         # energy dynamics
@@ -289,4 +327,12 @@ class EnergyBoxesDelayEnv(EnergyBoxesEnv):
             box_energy_refuel=10,
             max_steps=512,
             **kwargs,
-        )
\ No newline at end of file
+        )
+
+
+# custom envs by id, as used by --env-id
+ENERGY_ENVS = {
+    "EnergyBoxes": EnergyBoxesEnv,
+    "EnergyBoxesHard": EnergyBoxesHardEnv,
+    "EnergyBoxesDelay": EnergyBoxesDelayEnv,
+}
@@ -0,0 +1,73 @@
+import os
+import socket
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def init_process(rank, world_size, port, backend="gloo"):
+    """Joins the single-node process group (gloo works on CPU)."""
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def broadcast_parameters(module, src=0):
+    """Copies the weights (and buffers) of rank `src` to every rank."""
+    for tensor in module.state_dict().values():
+        dist.broadcast(tensor, src)
+
+def all_reduce_gradients(module):
+    """Averages gradients over ranks with a single all-reduce on a flat buffer."""
+    grads = [p.grad for p in module.parameters() if p.grad is not None]
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= get_world_size()
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset + g.numel()].view_as(g))
+        offset += g.numel()
+
+def all_reduce_mean(value):
+    """Mean of a scalar tensor over ranks."""
+    value = value.detach().clone().float()
+    dist.all_reduce(value)
+    return value / get_world_size()
+
+def global_mean_std(x):
+    """Mean and (unbiased) std of `x` over the union of every rank's elements."""
+    moments = torch.stack([x.sum(), (x ** 2).sum(), torch.tensor(float(x.numel()), device=x.device)]).float()
+    dist.all_reduce(moments)
+    total, total_sq, n = moments
+    mean = total / n
+    var = (total_sq - n * mean ** 2) / (n - 1)
+    return mean, var.clamp(min=0).sqrt()
+
+def gather_objects(value):
+    """List of the (picklable) `value` of every rank, in rank order (called on all ranks)."""
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, value)
+    return gathered
+
+def gather_stats(stats):
+    """Concatenates the per-episode arrays of every rank's rollout stats (called on all ranks)."""
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, stats)
+    merged = dict(stats)
+    for key, value in stats.items():
+        if isinstance(value, np.ndarray):
+            merged[key] = np.concatenate([rank_stats[key] for rank_stats in gathered])
+    return merged
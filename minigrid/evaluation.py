@@ -2,16 +2,36 @@ import os
 import gymnasium as gym
 import torch
 import numpy as np
-import wandb
 import argparse
-from minigrid.wrappers import FullyObsWrapper
-from utils import get_state_tensor
-from distutils.util import strtobool
-
+from utils import get_state_tensor, strtobool, IncrementalFullyObsWrapper
+from export import load_policy
+from recording import TrajectoryRecorder, write_config
+from customenvs import ENERGY_ENVS
+from rewards import MultiRewardWrapper, parse_reward_config, reward_configs_from_csv, config_name
+
+
+def make_env(args, idx=0):
+    if args.env_id in ENERGY_ENVS:
+        env = ENERGY_ENVS[args.env_id](agent_start_dir="random",
+                                       agent_start_pos="random" if args.env_id == "EnergyBoxesDelay" else (1,1),
+                                       time_bonus=args.time_bonus,
+                                       box_open_reward=args.box_reward,
+                                       seed=args.seed + idx * 100)
+    else:
+        env = gym.make(args.env_id)
+    if args.fully_obs:
+        env = IncrementalFullyObsWrapper(env)
+    if args.reward_configs:
+        env = MultiRewardWrapper(env, args.reward_configs)
+    if args.record_dir:
+        env = TrajectoryRecorder(env, args.record_dir, idx, seed=args.seed + idx * 100)
+    return env
 
 def evaluate_agent(env, agent, num_episodes, verbose=True):
+    """Returns the episode returns and lengths, and the per-config returns if the env is a MultiRewardWrapper."""
     total_returns = []
     episode_lengths = []
+    config_returns = []
 
     for i in range(num_episodes):
         state = env.reset()[0]
@@ -31,10 +51,18 @@ def evaluate_agent(env, agent, num_episodes, verbose=True):
             if terminated or truncated:
                 total_returns.append(episode_return)
                 episode_lengths.append(episode_length)
+                if 'config_returns' in info:
+                    config_returns.append(info['config_returns'])
                 if verbose: print(f'Episode {i+1} return: {episode_return}, length: {episode_length}')
                 break
 
-    return total_returns, episode_lengths
+    return total_returns, episode_lengths, config_returns
+
+def print_config_returns(configs, config_returns):
+    config_returns = np.array(config_returns)
+    print(f"{'reward config':<60}{'mean return':>13}{'std':>9}")
+    for i, config in enumerate(configs):
+        print(f"{config_name(config):<60}{config_returns[:, i].mean():>13.3f}{config_returns[:, i].std():>9.3f}")
 
 
 if __name__ == '__main__':
@@ -44,35 +72,68 @@ if __name__ == '__main__':
                         help='the id of the environment')
     parser.add_argument("--fully-obs", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
                         help="whether to use the fully observable wrapper")
+    parser.add_argument('--agent-path', type=str, default=None,
+                        help='agent checkpoint (.pth) or exported policy (.pt TorchScript, .onnx), first agent of the env by default')
     parser.add_argument('--num-episodes', type=int, default=100,
                         help='number of episodes for evaluation')
     parser.add_argument("--verbose", type=lambda x: bool(strtobool(x)), default=True, nargs="?", const=True,
                         help="whether to print metrics and training logs")
     parser.add_argument("--wandb", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
                         help="whether to use wandb to log metrics")
+    parser.add_argument("--num-workers", type=int, default=0,
+                        help="if positive, envs are stepped in this many worker processes and the agent acts on dynamic batches")
+    parser.add_argument("--envs-per-worker", type=int, default=4,
+                        help="number of envs stepped by each worker process")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="seed of the envs (and of the recorded episodes)")
+    parser.add_argument("--time-bonus", type=float, default=0.1,
+                        help="time bonus of the EnergyBoxes envs")
+    parser.add_argument("--box-reward", type=float, default=0,
+                        help="box reward of the EnergyBoxes envs")
+    parser.add_argument("--reward-configs", type=str, nargs="+", default=[],
+                        help="reward configurations to compute the returns of from the same episodes, "
+                             "e.g. 'time_cost=0.0025,final_reward_penalty=false' or 'time_bonus=0,box_reward=1'")
+    parser.add_argument("--experiments", type=str, default=None,
+                        help="experiment csv whose reward configurations for --env-id are added to --reward-configs")
+    parser.add_argument("--record-dir", type=str, default=None,
+                        help="if set, the reset seed and actions of every episode are recorded in this directory (see replay.py)")
 
 
     args = parser.parse_args()
+    args.reward_configs = [parse_reward_config(spec) for spec in args.reward_configs]
+    if args.experiments:
+        args.reward_configs += reward_configs_from_csv(args.experiments, args.env_id)
 
-    # Environment setup
-    env = gym.make(args.env_id)
-    if args.fully_obs:
-        env = FullyObsWrapper(env)
+    if args.record_dir:
+        write_config(args.record_dir, "evaluation", args)
 
     # Loading agent model
-    model_dir = os.path.join('trained-models', args.env_id)
-    model_files = [f for f in os.listdir(model_dir) if f.endswith('.pth')]
-    agent_model_path = os.path.join(model_dir, model_files[0]) # TODO: take first one for now
-    agent = torch.load(agent_model_path)
+    agent_model_path = args.agent_path
+    if agent_model_path is None:
+        model_dir = os.path.join('trained-models', args.env_id)
+        model_files = [f for f in os.listdir(model_dir) if f.endswith('.pth')]
+        agent_model_path = os.path.join(model_dir, model_files[0]) # TODO: take first one for now
+    agent = load_policy(agent_model_path)
 
     # Wandb initialization
     if args.wandb:
+        import wandb # imported lazily, only needed with --wandb
         wandb.init(project="action-cost-experiments", 
                     entity="nauqs",
                     config=args)
 
     # Evaluation
-    total_returns, episode_lengths = evaluate_agent(env, agent, args.num_episodes, verbose=args.verbose)
+    if args.num_workers > 0:
+        from inference_server import evaluate_served
+        env_fns = [lambda idx=idx: gym.wrappers.RecordEpisodeStatistics(make_env(args, idx))
+                   for idx in range(args.num_workers * args.envs_per_worker)]
+        total_returns, episode_lengths, config_returns, server = evaluate_served(env_fns, agent, args.num_episodes,
+                                                                 envs_per_worker=args.envs_per_worker)
+        if args.verbose: server.print_histograms()
+    else:
+        env = make_env(args)
+        total_returns, episode_lengths, config_returns = evaluate_agent(env, agent, args.num_episodes, verbose=args.verbose)
+        env.close()
 
     # Logging results to wandb
     if args.wandb:
@@ -86,6 +147,5 @@ if __name__ == '__main__':
     if args.verbose:
         print(f'Average return: {sum(total_returns) / len(total_returns)}')
         print(f'Average episode length: {sum(episode_lengths) / len(episode_lengths)}')
-
-    # Close the environment
-    env.close()
+        if args.reward_configs:
+            print_config_returns(args.reward_configs, config_returns)
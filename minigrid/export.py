@@ -0,0 +1,109 @@
+"""
+Export trained agents as standalone inference artifacts.
+
+    python export.py --agent-path trained-models/EnergyBoxes/actor_test.pth --formats torchscript onnx --quantize
+
+writes actor_test.pt (TorchScript, only needs torch) and actor_test.onnx (only needs onnxruntime)
+next to the checkpoint, and actor_test-int8.pt / actor_test-int8.onnx with the MLP heads
+dynamically quantized to int8. `load_policy` loads any of them (or a pickled .pth agent)
+with the `get_action_and_value` interface used by evaluation.py and exploitation.py.
+"""
+import os
+import copy
+import argparse
+import torch
+import torch.nn as nn
+from torch.distributions.categorical import Categorical
+
+FORMATS = {"torchscript": ".pt", "onnx": ".onnx"}
+
+
+def example_input(agent, batch_size=1):
+    # agents saved before obs_dim was stored are partially observable
+    return torch.zeros((batch_size,) + tuple(getattr(agent, 'obs_dim', (4, 7, 7))))
+
+def quantize_heads(agent):
+    """Copy of the agent with the Linear layers (actor and critic heads) dynamically quantized to int8."""
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(agent).cpu(), {nn.Linear}, dtype=torch.qint8)
+
+def export_torchscript(agent, path):
+    with torch.inference_mode():
+        traced = torch.jit.trace(agent, example_input(agent))
+    torch.jit.save(torch.jit.freeze(traced), path)
+
+def export_onnx(agent, path, quantize=False):
+    torch.onnx.export(agent, example_input(agent), path,
+                      input_names=["obs"], output_names=["logits", "value"],
+                      dynamic_axes={"obs": {0: "batch"}, "logits": {0: "batch"}, "value": {0: "batch"}})
+    if quantize:
+        # onnxruntime quantizes the exported graph, Gemm/MatMul are the MLP heads
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(path, path, weight_type=QuantType.QInt8, op_types_to_quantize=["Gemm", "MatMul"])
+
+def export_agent(agent_path, formats, quantize=False):
+    """Exports the pickled agent at `agent_path` in every format, returns the artifact paths."""
+    agent = torch.load(agent_path, map_location='cpu', weights_only=False).eval()
+    base = os.path.splitext(agent_path)[0]
+    paths = []
+    for variant in ([False, True] if quantize else [False]):
+        for format in formats:
+            path = base + ("-int8" if variant else "") + FORMATS[format]
+            if format == "torchscript":
+                export_torchscript(quantize_heads(agent) if variant else agent, path)
+            else:
+                export_onnx(agent, path, quantize=variant)
+            paths.append(path)
+    return paths
+
+
+class ExportedPolicy:
+    """
+    Exported artifact with the inference interface of MiniGridAgent:
+    `forward` maps observations to (logits, value).
+    """
+
+    def __init__(self, forward):
+        self.forward = forward
+
+    def __call__(self, x):
+        with torch.inference_mode():
+            return self.forward(x)
+
+    def eval(self):
+        return self
+
+    def get_action_and_value(self, x, action=None):
+        logits, value = self(x)
+        probs = Categorical(logits=logits)
+        if action is None:
+            action = probs.sample()
+        return action, probs.log_prob(action), probs.entropy(), value
+
+def load_policy(path, device=torch.device('cpu')):
+    """Loads a pickled agent (.pth), a memory-mapped checkpoint (.json), a TorchScript (.pt) or an ONNX (.onnx) policy."""
+    if path.endswith(".pth"):
+        return torch.load(path, map_location=device, weights_only=False)
+    if path.endswith(".json"):
+        from weightstore import load_forward
+        return ExportedPolicy(load_forward(path, device))
+    if path.endswith(".onnx"):
+        import onnxruntime # imported lazily, only needed for onnx artifacts
+        session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+        def forward(x):
+            logits, value = session.run(None, {"obs": x.cpu().numpy()})
+            return torch.from_numpy(logits).to(device), torch.from_numpy(value).to(device)
+        return ExportedPolicy(forward)
+    return ExportedPolicy(torch.jit.load(path, map_location=device))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a trained agent as TorchScript/ONNX inference artifacts")
+    parser.add_argument("--agent-path", type=str, required=True,
+                        help="pickled agent, e.g. trained-models/<env-id>/actor_<name>.pth")
+    parser.add_argument("--formats", type=str, nargs="+", default=["torchscript"], choices=list(FORMATS))
+    parser.add_argument("--quantize", default=False, action='store_true',
+                        help="also export a variant with the MLP heads dynamically quantized to int8")
+    args = parser.parse_args()
+
+    for path in export_agent(args.agent_path, args.formats, args.quantize):
+        print(f"Saved {path}")
@@ -0,0 +1,190 @@
+"""
+Local dynamic-batching inference service for environments stepped in worker processes.
+
+Each worker process owns `envs_per_worker` envs. After every step it writes the
+observations, rewards and dones of its envs into shared-memory tensors and puts its id
+(with the final infos of the episodes that just ended) on the request queue, then waits
+on its own event for the actions. The server gathers requests into dynamic batches of up
+to `max_batch_size` envs, waiting at most `max_latency` seconds after the first request,
+runs a single batched forward pass (done by the caller, see ServedCollector and
+evaluate_served) and scatters the actions back.
+"""
+import time
+import queue
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from collections import Counter
+from gymnasium.vector.utils import CloudpickleWrapper
+from utils import get_state_tensor
+
+CONTINUE, STOP = 0, 1
+
+
+def env_worker(worker_id, env_fns, shared, requests, event, rollout_steps):
+    """
+    Steps `env_fns` with the served actions. With `rollout_steps`, every rollout starts from
+    a reset (as in TrajectoryCollector) and the request after the last step only asks for
+    the bootstrap value.
+    """
+    import gymnasium as gym
+    torch.set_num_threads(1)
+    envs = gym.vector.SyncVectorEnv(env_fns)
+    rows = slice(worker_id * len(env_fns), (worker_id + 1) * len(env_fns))
+    image, direction = shared['image'].numpy(), shared['direction'].numpy()
+    reward, done, action = shared['reward'].numpy(), shared['done'].numpy(), shared['action'].numpy()
+
+    def write(state, step_reward, step_done):
+        image[rows], direction[rows] = state['image'], state['direction']
+        reward[rows], done[rows] = step_reward, step_done
+
+    step, episodes = 0, []
+    while True:
+        if step == 0:
+            write(envs.reset()[0], 0, False)
+        requests.put((worker_id, episodes))
+        episodes = []
+        event.wait()
+        event.clear()
+        if shared['command'][worker_id] == STOP:
+            break
+        if rollout_steps is not None and step == rollout_steps:
+            step = 0
+            continue
+        state, step_reward, terminated, truncated, info = envs.step(action[rows].copy())
+        write(state, step_reward, terminated | truncated)
+        if 'final_info' in info:
+            episodes = [(i, final_info) for i, final_info in enumerate(info['final_info']) if final_info is not None]
+        step += 1
+    envs.close()
+
+
+class InferenceServer:
+    """Dynamic batching of the observation requests of env worker processes."""
+
+    def __init__(self, env_fns, envs_per_worker, max_batch_size=0, max_latency=0.002, rollout_steps=None):
+        """
+        Args:
+            env_fns: one env constructor per env, split between workers in order
+            envs_per_worker: number of envs stepped by each worker process
+            max_batch_size: maximum number of envs per batch (0 for all envs)
+            max_latency: maximum time (s) a batch waits for more requests after its first one
+            rollout_steps: steps per training rollout, None to step forever (evaluation)
+        """
+        assert len(env_fns) % envs_per_worker == 0, "the number of envs must be divisible by envs_per_worker"
+        self.num_envs = len(env_fns)
+        self.envs_per_worker = envs_per_worker
+        self.num_workers = self.num_envs // envs_per_worker
+        self.max_batch_size = max_batch_size or self.num_envs
+        self.max_latency = max_latency
+
+        probe = env_fns[0]()
+        image_shape = probe.observation_space['image'].shape
+        probe.close()
+        self.shared = {
+            'image': torch.zeros((self.num_envs,) + image_shape, dtype=torch.uint8).share_memory_(),
+            'direction': torch.zeros(self.num_envs, dtype=torch.int64).share_memory_(),
+            'reward': torch.zeros(self.num_envs, dtype=torch.float64).share_memory_(),
+            'done': torch.zeros(self.num_envs, dtype=torch.bool).share_memory_(),
+            'action': torch.zeros(self.num_envs, dtype=torch.int64).share_memory_(),
+            'command': torch.zeros(self.num_workers, dtype=torch.int8).share_memory_(),
+        }
+
+        ctx = mp.get_context("spawn")
+        self.requests = ctx.Queue()
+        self.events = [ctx.Event() for _ in range(self.num_workers)]
+        self.pending = [] # requests put back by the caller, served before the queue
+        self.workers = []
+        for w in range(self.num_workers):
+            worker_env_fns = [CloudpickleWrapper(fn) for fn in env_fns[w * envs_per_worker:(w + 1) * envs_per_worker]]
+            process = ctx.Process(target=env_worker, daemon=True,
+                                  args=(w, worker_env_fns, self.shared, self.requests, self.events[w], rollout_steps))
+            process.start()
+            self.workers.append(process)
+
+        self.batch_sizes = Counter() # envs per batch
+        self.queue_depths = Counter() # requests waiting when a batch is formed
+
+    def next_batch(self):
+        """Blocks for a first request, then gathers more up to the batch size or latency budget."""
+        if self.pending:
+            batch, self.pending = self.pending[:self.max_batch_size // self.envs_per_worker], \
+                                  self.pending[self.max_batch_size // self.envs_per_worker:]
+            return batch
+        batch = [self.requests.get()]
+        try:
+            self.queue_depths[self.requests.qsize() + 1] += 1
+        except NotImplementedError: # qsize is not available on macOS
+            pass
+        deadline = time.perf_counter() + self.max_latency
+        while (len(batch) + 1) * self.envs_per_worker <= self.max_batch_size:
+            try:
+                batch.append(self.requests.get(timeout=max(0, deadline - time.perf_counter())))
+            except queue.Empty:
+                break
+        self.batch_sizes[len(batch) * self.envs_per_worker] += 1
+        return batch
+
+    def rows(self, workers):
+        """Env indices of the requests of `workers`."""
+        return np.concatenate([np.arange(w * self.envs_per_worker, (w + 1) * self.envs_per_worker) for w in workers])
+
+    def observations(self, rows):
+        return get_state_tensor({'image': self.shared['image'][rows].numpy(),
+                                 'direction': self.shared['direction'][rows].numpy()})
+
+    def respond(self, workers, rows, actions):
+        self.shared['action'][rows] = actions.cpu().long()
+        for w in workers:
+            self.events[w].set()
+
+    def snapshot(self):
+        return self.batch_sizes.copy(), self.queue_depths.copy()
+
+    def metrics(self, since=(Counter(), Counter())):
+        """Mean batch size and queue depth of the batches formed after the `since` snapshot."""
+        def mean(counter):
+            return sum(k * v for k, v in counter.items()) / max(1, sum(counter.values()))
+        return {"inference_batch_size": mean(self.batch_sizes - since[0]),
+                "inference_queue_depth": mean(self.queue_depths - since[1])}
+
+    def print_histograms(self):
+        for name, counter in [("Batch size (envs)", self.batch_sizes), ("Queue depth", self.queue_depths)]:
+            total = max(1, sum(counter.values()))
+            print(f"{name} histogram:")
+            for value in sorted(counter):
+                print(f"  {value:>4}: {counter[value]:>8} ({100 * counter[value] / total:5.1f}%)")
+
+    def close(self):
+        self.shared['command'][:] = STOP
+        for process in self.workers:
+            # a worker may clear its event right after it was set, keep waking it up
+            while process.is_alive():
+                for event in self.events:
+                    event.set()
+                process.join(timeout=0.1)
+
+
+def evaluate_served(env_fns, agent, num_episodes, envs_per_worker=1, max_batch_size=0, max_latency=0.002):
+    """
+    Runs `agent` on envs stepped by worker processes until `num_episodes` episodes ended.
+    The envs must be wrapped in RecordEpisodeStatistics. Returns the episode returns and lengths,
+    and the per-config returns of the envs wrapped in a MultiRewardWrapper.
+    """
+    server = InferenceServer(env_fns, envs_per_worker, max_batch_size, max_latency)
+    total_returns, episode_lengths, config_returns = [], [], []
+    while len(total_returns) < num_episodes:
+        requests = server.next_batch()
+        workers = [w for w, _ in requests]
+        for _, episodes in requests:
+            for _, final_info in episodes:
+                total_returns.append(final_info['episode']['r'].item())
+                episode_lengths.append(final_info['episode']['l'].item())
+                if 'config_returns' in final_info:
+                    config_returns.append(final_info['config_returns'])
+        rows = server.rows(workers)
+        with torch.inference_mode():
+            action = agent.get_action_and_value(server.observations(rows))[0]
+        server.respond(workers, rows, action)
+    server.close()
+    return total_returns[:num_episodes], episode_lengths[:num_episodes], config_returns[:num_episodes], server
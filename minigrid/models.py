@@ -4,6 +4,11 @@ import torch.nn.functional as F
 import numpy as np
 from torch.distributions.categorical import Categorical
 
+def gumbel_noise(shape, device=None):
+    """Standard Gumbel noise, -log(-log(u)) for u uniform in (0, 1)."""
+    uniform = torch.rand(shape, device=device).clamp_(min=torch.finfo(torch.float32).tiny)
+    return -torch.log(-torch.log(uniform))
+
 def layer_init(layer, std=np.sqrt(2), bias_const=0.0):
     torch.nn.init.orthogonal_(layer.weight, std)
     torch.nn.init.constant_(layer.bias, bias_const)
@@ -32,12 +37,15 @@ class BasicAgent(nn.Module):
     def get_value(self, x):
         return self.critic(x)
 
+    def forward(self, x):
+        return self.actor(x), self.critic(x)
+
     def get_action_and_value(self, x, action=None):
-        logits = self.actor(x)
+        logits, value = self(x)
         probs = Categorical(logits=logits)
         if action is None:
             action = probs.sample()
-        return action, probs.log_prob(action), probs.entropy(), self.critic(x)
+        return action, probs.log_prob(action), probs.entropy(), value
 
     
     def save(self, file_path="trained-models/actor.pth"):
@@ -45,26 +53,98 @@ class BasicAgent(nn.Module):
 
 
 class ConvBase(nn.Module):
+    channels_last = False
+
     def __init__(self, n_channels=4):
         super(ConvBase, self).__init__()
         self.conv1 = nn.Conv2d(n_channels, 16, kernel_size=3, stride=1, padding=1)
         self.conv2 = nn.Conv2d(16, 32, kernel_size=3, stride=1, padding=1)
         self.pool = nn.MaxPool2d(2, 2)
 
+    def to_channels_last(self):
+        """Store the conv weights (and convert inputs) in channels_last format."""
+        self.channels_last = True
+        return self.to(memory_format=torch.channels_last)
+
+    def output_size(self, obs_dim):
+        """Flattened output size for inputs of shape (C, H, W), computed without a forward pass."""
+        _, height, width = obs_dim
+        # each block keeps the spatial size (3x3 conv, padding 1) and halves it (2x2 max pool)
+        for _ in range(2):
+            height, width = height // 2, width // 2
+        return self.conv2.out_channels * height * width
+
     def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         x = self.pool(F.relu(self.conv1(x)))
         x = self.pool(F.relu(self.conv2(x)))
         x = torch.flatten(x, start_dim=x.dim()-3)
         return x
 
 
+class EmbeddingConvBase(ConvBase):
+    """
+    ConvBase whose first layer reads the (object, color, state, direction) planes as
+    categories: a 3x3 convolution over their one-hot encoding, without the one-hot.
+    Each cell gathers the sum of the embeddings of its 4 values (an EmbeddingBag), which
+    holds its contribution to the 3x3 output cells around it, and `fold` adds up the
+    contributions every output cell receives.
+    Takes integer (or integer-valued float) observations of shape (batch, 4, H, W).
+    """
+
+    # object, color, state and direction vocabularies (minigrid OBJECT_TO_IDX, COLOR_TO_IDX, door/box states)
+    VOCAB_SIZES = (11, 6, 4, 4)
+
+    def __init__(self, n_channels=4, out_channels=16, kernel_size=3):
+        super().__init__(n_channels=n_channels)
+        assert n_channels == len(self.VOCAB_SIZES), "the embedding encoder expects the 4 minigrid planes"
+        del self.conv1
+        self.kernel_size = kernel_size
+        self.vocab = sum(self.VOCAB_SIZES)
+        self.register_buffer("plane_offsets", torch.tensor(np.cumsum((0,) + self.VOCAB_SIZES[:-1])).view(1, -1, 1, 1))
+        self.register_buffer("plane_max", torch.tensor(self.VOCAB_SIZES).view(1, -1, 1, 1) - 1)
+        # row v holds the (out_channels, kernel_size, kernel_size) contribution of value v to its neighbourhood
+        self.embedding = nn.EmbeddingBag(self.vocab, out_channels * kernel_size ** 2, mode="sum")
+        self.bias = nn.Parameter(torch.empty(out_channels))
+        # same initialisation as the Conv2d it replaces, whose fan-in is n_channels * kernel_size**2
+        bound = 1 / np.sqrt(n_channels * kernel_size ** 2)
+        nn.init.uniform_(self.embedding.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def conv_weight(self):
+        """The equivalent Conv2d weight over the concatenated one-hot planes, (out_channels, vocab, k, k)."""
+        k = self.kernel_size
+        # the contribution to the output cell at (+dy, +dx) is the conv weight at the opposite kernel offset
+        return self.embedding.weight.view(self.vocab, -1, k, k).flip(2, 3).transpose(0, 1)
+
+    def first_layer(self, x):
+        batch, planes, height, width = x.shape
+        values = torch.minimum(x.long(), self.plane_max) + self.plane_offsets
+        cells = self.embedding(values.permute(0, 2, 3, 1).reshape(-1, planes))
+        cells = cells.view(batch, height * width, -1).transpose(1, 2)
+        # zero padding: contributions falling outside the grid are dropped
+        out = F.fold(cells, (height, width), self.kernel_size, padding=self.kernel_size // 2)
+        return out + self.bias.view(1, -1, 1, 1)
+
+    def forward(self, x):
+        x = self.pool(F.relu(self.first_layer(x)))
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        x = self.pool(F.relu(self.conv2(x)))
+        x = torch.flatten(x, start_dim=x.dim()-3)
+        return x
+
+
 class MiniGridAgent(nn.Module):
-    def __init__(self, obs_dim, action_dim, n_channels=4):
+    def __init__(self, obs_dim, action_dim, n_channels=4, encoder="conv"):
         super(MiniGridAgent, self).__init__()
         
+        self.obs_dim = tuple(obs_dim)
+
         # Convolutional base
-        self.conv = ConvBase(n_channels=n_channels)
-        self.conv_output_size = self.conv(torch.randn(1, *obs_dim)).shape[-1]
+        self.conv = EmbeddingConvBase(n_channels=n_channels) if encoder == "embedding" else ConvBase(n_channels=n_channels)
+        self.conv_output_size = self.conv.output_size(obs_dim)
         print("conv output size:", self.conv_output_size)
 
         # Critic head
@@ -85,17 +165,47 @@ class MiniGridAgent(nn.Module):
             layer_init(nn.Linear(64, action_dim), std=0.01),
         )
 
-    def get_value(self, x):
-        x = self.conv(x)
-        return self.critic(x)
+    def forward(self, x):
+        """Single pass through the conv trunk shared by both heads, returns (logits, value)."""
+        hidden = self.conv(x)
+        # heads may run in bfloat16 under autocast, keep outputs in float32
+        return self.actor(hidden).float(), self.critic(hidden).float()
 
-    def get_action_and_value(self, x, action=None):
-        x = self.conv(x)
-        logits = self.actor(x)
+    def get_value(self, x):
+        # only the critic head is needed for bootstrapping
+        return self.critic(self.conv(x)).float()
+
+    def get_action_and_value(self, x, action=None, index=None):
+        """With `index`, `x` holds distinct observations and the outputs are those of the rows x[index]."""
+        logits, value = self(x)
+        if index is not None:
+            logits, value = logits[index], value[index]
         probs = Categorical(logits=logits)
         if action is None:
             action = probs.sample()
-        return action, probs.log_prob(action), probs.entropy(), self.critic(x)
+        return action, probs.log_prob(action), probs.entropy(), value
+
+    def activation_bytes(self):
+        """Bytes of the layer outputs of a forward pass, per observation."""
+        sizes = []
+        hooks = [module.register_forward_hook(lambda module, inputs, output: sizes.append(output.nelement() * output.element_size()))
+                 for module in self.modules() if not list(module.children())]
+        with torch.no_grad():
+            self(torch.zeros((1,) + self.obs_dim, device=next(self.parameters()).device))
+        for hook in hooks:
+            hook.remove()
+        return sum(sizes)
+
+    def sample_action_and_value(self, x, gumbel):
+        """
+        Same distribution as get_action_and_value without building a Categorical:
+        Gumbel-max sampling with the pre-drawn `gumbel` noise of shape (batch, actions).
+        Returns (action, log_prob, value).
+        """
+        logits, value = self(x)
+        log_probs = F.log_softmax(logits, dim=-1)
+        action = (log_probs + gumbel).argmax(dim=-1)
+        return action, log_probs.gather(-1, action.unsqueeze(-1)).squeeze(-1), value
 
     def save(self, file_path="trained-models/actor.pth"):
         torch.save(self, file_path)
@@ -1,6 +1,9 @@
 import torch
 import torch.nn as nn
 import numpy as np
+from utils import autocast
+from storage import chunk_size
+from distributed import get_rank, get_world_size, all_reduce_gradients, all_reduce_mean, global_mean_std
 
 class PPO(nn.Module):
 
@@ -11,6 +14,27 @@ class PPO(nn.Module):
         self.agent = agent
         self.args = args
         self.optimizer = torch.optim.Adam(agent.parameters(), lr=self.args.learning_rate, eps=1e-5)
+        # in data-parallel mode batch_size/minibatch_size are the per-rank slices
+        self.world_size = get_world_size()
+        self.obs_dtype = torch.uint8 if args.encoder == "embedding" else torch.float32
+        # with a memory cap, minibatches are streamed from the rollout storage in micro-batches
+        self.micro_batch_size = chunk_size(agent, args.memory_cap_mb, training=True) if args.memory_cap_mb > 0 else args.minibatch_size
+
+    def _forward(self, batch, inds):
+        """New log probs, entropies and values of the rows `inds` of the batch."""
+        actions = batch["actions"].long()[inds]
+        # only the forward pass runs under autocast, losses and backward stay in float32
+        with autocast(self.args, self.device):
+            if "obs_idx" in batch:
+                # forward pass once per distinct observation of the rows, gathered back per row
+                unique_idx, inverse = torch.unique(batch["obs_idx"][inds], return_inverse=True)
+                _, newlogprob, entropy, newvalue = self.agent.get_action_and_value(
+                    batch["obs_table"][unique_idx], actions, index=inverse)
+            else:
+                # no-op unless the observations are the host bytes of a memory-bounded rollout
+                obs = batch["obs"][inds].to(self.device, self.obs_dtype)
+                _, newlogprob, entropy, newvalue = self.agent.get_action_and_value(obs, actions)
+        return newlogprob, entropy, newvalue.view(-1)
 
     def update_ppo_agent(self, batch, save_path="trained-models/actor.pth"):
 
@@ -22,51 +46,73 @@ class PPO(nn.Module):
             for start in range(0, self.args.batch_size, self.args.minibatch_size):
                 end = start + self.args.minibatch_size
                 mb_inds = b_inds[start:end]
+                if self.micro_batch_size < len(mb_inds):
+                    # rows in storage order, spilled observations are then read sequentially
+                    mb_inds = np.sort(mb_inds)
+
+                # the advantages are normalised with the statistics of the whole minibatch
+                if self.args.norm_adv:
+                    mb_advantages = batch["advantages"][mb_inds]
+                    if self.world_size > 1:
+                        # normalise over the whole minibatch, i.e. the union of every rank's slice
+                        adv_mean, adv_std = global_mean_std(mb_advantages)
+                    else:
+                        adv_mean, adv_std = mb_advantages.mean(), mb_advantages.std()
 
-                _, newlogprob, entropy, newvalue = self.agent.get_action_and_value(batch["obs"][mb_inds], batch["actions"].long()[mb_inds])
-                logratio = newlogprob - batch["log_probs"][mb_inds]
-                ratio = logratio.exp()
+                # the gradients of the micro-batches are accumulated, the losses are sums over the minibatch size
+                self.optimizer.zero_grad()
+                approx_kl, clipped = 0., 0.
+                for micro_start in range(0, len(mb_inds), self.micro_batch_size):
+                    inds = mb_inds[micro_start:micro_start + self.micro_batch_size]
+                    newlogprob, entropy, newvalue = self._forward(batch, inds)
+                    logratio = newlogprob - batch["log_probs"][inds]
+                    ratio = logratio.exp()
 
-                with torch.no_grad():
-                    old_approx_kl = (-logratio).mean()
-                    approx_kl = ((ratio - 1) - logratio).mean()
-                    clipfracs += [((ratio - 1.0).abs() > self.args.clip_coef).float().mean().item()]
+                    with torch.no_grad():
+                        approx_kl += ((ratio - 1) - logratio).sum()
+                        clipped += ((ratio - 1.0).abs() > self.args.clip_coef).float().sum()
 
-                mb_advantages = batch["advantages"][mb_inds]
-                if self.args.norm_adv:
-                    mb_advantages = (mb_advantages - mb_advantages.mean()) / (mb_advantages.std() + 1e-8)
+                    advantages = batch["advantages"][inds]
+                    if self.args.norm_adv:
+                        advantages = (advantages - adv_mean) / (adv_std + 1e-8)
 
-                # Policy loss
-                pg_loss1 = -mb_advantages * ratio
-                pg_loss2 = -mb_advantages * torch.clamp(ratio, 1 - self.args.clip_coef, 1 + self.args.clip_coef)
-                pg_loss = torch.max(pg_loss1, pg_loss2).mean()
+                    # Policy loss
+                    pg_loss1 = -advantages * ratio
+                    pg_loss2 = -advantages * torch.clamp(ratio, 1 - self.args.clip_coef, 1 + self.args.clip_coef)
+                    pg_loss = torch.max(pg_loss1, pg_loss2).sum()
 
-                # Value loss
-                newvalue = newvalue.view(-1)
-                if self.args.clip_vloss:
-                    v_loss_unclipped = (newvalue - batch["returns"][mb_inds]) ** 2
-                    v_clipped = batch["values"][mb_inds] + torch.clamp(
-                        newvalue - batch["values"][mb_inds],
-                        -self.args.clip_coef,
-                        self.args.clip_coef,
-                    )
-                    v_loss_clipped = (v_clipped - batch["returns"][mb_inds]) ** 2
-                    v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
-                    v_loss = 0.5 * v_loss_max.mean()
-                else:
-                    v_loss = 0.5 * ((newvalue - batch["returns"][mb_inds]) ** 2).mean()
+                    # Value loss
+                    if self.args.clip_vloss:
+                        v_loss_unclipped = (newvalue - batch["returns"][inds]) ** 2
+                        v_clipped = batch["values"][inds] + torch.clamp(
+                            newvalue - batch["values"][inds],
+                            -self.args.clip_coef,
+                            self.args.clip_coef,
+                        )
+                        v_loss_clipped = (v_clipped - batch["returns"][inds]) ** 2
+                        v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
+                        v_loss = 0.5 * v_loss_max.sum()
+                    else:
+                        v_loss = 0.5 * ((newvalue - batch["returns"][inds]) ** 2).sum()
 
-                entropy_loss = entropy.mean()
-                loss = pg_loss - self.args.ent_coef * entropy_loss + v_loss * self.args.vf_coef
+                    entropy_loss = entropy.sum()
+                    loss = (pg_loss - self.args.ent_coef * entropy_loss + v_loss * self.args.vf_coef) / len(mb_inds)
+                    loss.backward()
 
-                self.optimizer.zero_grad()
-                loss.backward()
+                approx_kl = approx_kl / len(mb_inds)
+                clipfracs += [clipped.item() / len(mb_inds)]
+                if self.world_size > 1:
+                    all_reduce_gradients(self.agent)
                 nn.utils.clip_grad_norm_(self.agent.parameters(), self.args.max_grad_norm)
                 self.optimizer.step()
             
             # Check target KL
             if self.args.target_kl is not None:
+                if self.world_size > 1:
+                    # every rank has to take the same decision
+                    approx_kl = all_reduce_mean(approx_kl)
                 if approx_kl > self.args.target_kl:
                     break
         
-        self.agent.save(file_path=save_path)
\ No newline at end of file
+        if get_rank() == 0:
+            self.agent.save(file_path=save_path)
\ No newline at end of file
@@ -0,0 +1,115 @@
+"""
+Compact trajectory recording: a reset seed and one action byte per step.
+
+Episodes are deterministic given the env config, the reset seed and the actions, so a
+recording only stores those and `replay.py` re-simulates the observations, rewards and
+info counters on demand. A recording directory holds
+
+    config.json          script that created the envs and its arguments
+    env-<i>.actions      uint8 actions of every episode of env i, appended back to back
+    env-<i>.episodes     EPISODE_DTYPE records: reset seed, offset in the actions file,
+                         length, return and how the episode ended
+
+Both files are only appended to while recording and are read with np.memmap.
+"""
+import os
+import json
+import numpy as np
+import gymnasium as gym
+
+EPISODE_DTYPE = np.dtype([('seed', '<i8'), ('offset', '<i8'), ('length', '<i4'), ('return', '<f4'),
+                          ('terminated', 'u1'), ('truncated', 'u1')])
+
+
+def write_config(directory, source, args):
+    """Stores the script (`train`, `evaluation` or `exploitation`) and arguments the recorded envs are made with."""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "config.json"), "w") as f:
+        json.dump({"source": source, "args": vars(args)}, f, indent=2, default=str)
+
+
+def wrapper_method(env, name):
+    """Method `name` of the outermost wrapper of `env` that defines it, None if none does."""
+    while isinstance(env, gym.Wrapper):
+        if hasattr(type(env), name):
+            return getattr(env, name)
+        env = env.env
+    return None
+
+
+class TrajectoryRecorder(gym.Wrapper):
+    """
+    Resets the env with seeds drawn from a generator seeded with `seed` (or, when a wrapper
+    of the env chooses its reset seeds, e.g. LayoutPoolWrapper, with the seeds it would
+    use) and appends the seed and actions of every episode to the files of env `env_idx`
+    in `directory`.
+    Episodes cut short by a reset (e.g. at the start of a rollout) are recorded as well,
+    with neither the terminated nor the truncated flag.
+    """
+
+    def __init__(self, env, directory, env_idx, seed=0):
+        super().__init__(env)
+        assert self.action_space.n <= 256, "actions are recorded as single bytes"
+        os.makedirs(directory, exist_ok=True)
+        self.actions_file = open(os.path.join(directory, f"env-{env_idx}.actions"), "ab")
+        self.episodes_file = open(os.path.join(directory, f"env-{env_idx}.episodes"), "ab")
+        self.offset = self.actions_file.tell()
+        self.seed_rng = np.random.default_rng(seed)
+        self.next_seed = wrapper_method(env, "next_seed") or (lambda: int(self.seed_rng.integers(2**31 - 1)))
+        self.episode_seed, self.actions, self.episode_return = None, bytearray(), 0.
+
+    def reset(self, *, seed=None, options=None):
+        self.write_episode(False, False)
+        if seed is None:
+            seed = self.next_seed()
+        self.episode_seed = seed
+        return self.env.reset(seed=seed, options=options)
+
+    def step(self, action):
+        obs, reward, terminated, truncated, info = self.env.step(action)
+        self.actions.append(int(action))
+        self.episode_return += float(reward)
+        if terminated or truncated:
+            self.write_episode(terminated, truncated)
+        return obs, reward, terminated, truncated, info
+
+    def write_episode(self, terminated, truncated):
+        if not self.actions:
+            return
+        record = np.array([(self.episode_seed, self.offset, len(self.actions), self.episode_return,
+                            terminated, truncated)], dtype=EPISODE_DTYPE)
+        self.actions_file.write(self.actions)
+        self.episodes_file.write(record.tobytes())
+        self.offset += len(self.actions)
+        self.actions, self.episode_return = bytearray(), 0.
+
+    def close(self):
+        if not self.actions_file.closed:
+            self.write_episode(False, False)
+            self.actions_file.close()
+            self.episodes_file.close()
+        super().close()
+
+
+class Recording:
+    """Read access to a recording directory, the files are memory-mapped."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "config.json")) as f:
+            self.config = json.load(f)
+        self.env_indices = sorted(int(name[len("env-"):-len(".episodes")]) for name in os.listdir(directory)
+                                  if name.startswith("env-") and name.endswith(".episodes"))
+
+    def _memmap(self, env_idx, suffix, dtype):
+        path = os.path.join(self.directory, f"env-{env_idx}.{suffix}")
+        if os.path.getsize(path) == 0: # np.memmap cannot map empty files
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r')
+
+    def episodes(self, env_idx):
+        return self._memmap(env_idx, "episodes", EPISODE_DTYPE)
+
+    def actions(self, env_idx, episode):
+        record = self.episodes(env_idx)[episode]
+        return self._memmap(env_idx, "actions", np.uint8)[record['offset']:record['offset'] + record['length']]
@@ -0,0 +1,98 @@
+"""
+Re-simulates recorded episodes (see recording.py).
+
+    python replay.py recordings/<run name>                          # summary of the recording
+    python replay.py recordings/<run name> --env-idx 3 --episode 10 # step by step trajectory
+    python replay.py recordings/<run name> --env-idx 3 --episode 10 --output outputs/episode.npz
+"""
+import argparse
+import numpy as np
+from recording import Recording
+
+# per-step info counters of the EnergyBoxes envs and of ContEnergyWrapper
+INFO_COUNTERS = ["eat_count", "red_count", "blue_count", "agent_distance", "consecutive_boxes", "mix_rate", "goal_counts"]
+
+
+def make_replay_env(config, env_idx):
+    """The env `env_idx` of a recording, as created by the recorded script but without the recorder."""
+    args = argparse.Namespace(**{**config["args"], "record_dir": None})
+    if config["source"] == "train":
+        from train import make_env
+        return make_env(args, env_idx, "replay")()
+    if config["source"] == "evaluation":
+        from evaluation import make_env
+        return make_env(args, env_idx)
+    if config["source"] == "exploitation":
+        from exploitation import make_env
+        return make_env(args, render_mode=None)
+    raise ValueError(f"unknown recording source {config['source']}")
+
+def replay_episode(recording, env_idx, episode, env=None):
+    """
+    Re-simulates an episode from its seed and actions. Returns the observations (one more
+    than actions), actions, rewards, the energy of the EnergyBoxes envs and the info counters.
+    """
+    env = env if env is not None else make_replay_env(recording.config, env_idx)
+    record = recording.episodes(env_idx)[episode]
+    actions = np.array(recording.actions(env_idx, episode))
+
+    state = env.reset(seed=int(record['seed']))[0]
+    images, directions, rewards = [state['image']], [state['direction']], []
+    energy = [env.unwrapped.energy] if hasattr(env.unwrapped, "energy") else None
+    info_counters = {}
+    for action in actions:
+        state, reward, terminated, truncated, info = env.step(int(action))
+        images.append(state['image'])
+        directions.append(state['direction'])
+        rewards.append(reward)
+        if energy is not None:
+            energy.append(env.unwrapped.energy)
+        for key in INFO_COUNTERS:
+            if key in info:
+                info_counters.setdefault(key, []).append(info[key])
+
+    rewards = np.array(rewards, dtype=np.float32)
+    assert np.isclose(rewards.sum(), record['return'], atol=1e-3), \
+        f"replayed return {rewards.sum()} differs from the recorded {record['return']}, the env is not deterministic"
+    if record['terminated'] or record['truncated']: # otherwise the episode was cut short by a reset
+        assert (terminated, truncated) == (bool(record['terminated']), bool(record['truncated'])), \
+            "the replayed episode ends differently"
+    return {"images": np.array(images), "directions": np.array(directions), "actions": actions, "rewards": rewards,
+            "energy": np.array(energy) if energy is not None else None,
+            **{key: np.array(values) for key, values in info_counters.items()}}
+
+def print_summary(recording):
+    print(f"Recorded by {recording.config['source']}.py on {recording.config['args']['env_id']}")
+    print(f"{'env':>4}{'episodes':>10}{'steps':>10}{'mean return':>13}{'bytes/step':>12}")
+    for env_idx in recording.env_indices:
+        episodes = recording.episodes(env_idx)
+        steps = int(episodes['length'].sum())
+        size = steps + episodes.nbytes
+        mean_return = episodes['return'].mean() if len(episodes) else float("nan")
+        print(f"{env_idx:>4}{len(episodes):>10}{steps:>10}{mean_return:>13.3f}{size / max(1, steps):>12.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded episodes")
+    parser.add_argument("directory", type=str, help="recording directory")
+    parser.add_argument("--env-idx", type=int, default=None, help="env of the episode to replay, summary only if not set")
+    parser.add_argument("--episode", type=int, default=0, help="index of the episode in the recording of the env")
+    parser.add_argument("--output", type=str, default=None, help="npz file to save the replayed episode to")
+    args = parser.parse_args()
+
+    recording = Recording(args.directory)
+    if args.env_idx is None:
+        print_summary(recording)
+    else:
+        trajectory = replay_episode(recording, args.env_idx, args.episode)
+        counters = [key for key in INFO_COUNTERS if key in trajectory]
+        print(f"{'t':>5}{'action':>8}{'reward':>9}" + ("" if trajectory["energy"] is None else f"{'energy':>8}")
+              + "".join(f"{key:>18}" for key in counters))
+        for t, action in enumerate(trajectory["actions"]):
+            print(f"{t:>5}{action:>8}{trajectory['rewards'][t]:>9.3f}"
+                  + ("" if trajectory["energy"] is None else f"{trajectory['energy'][t + 1]:>8}")
+                  + "".join(f"{trajectory[key][t]:>18.3f}" for key in counters))
+        print(f"Return: {trajectory['rewards'].sum():.3f}, length: {len(trajectory['actions'])}")
+        if args.output:
+            np.savez_compressed(args.output, **{key: value for key, value in trajectory.items() if value is not None})
+            print(f"Saved {args.output}")
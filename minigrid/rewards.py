@@ -0,0 +1,110 @@
+"""
+Returns of one set of episodes under several reward configurations.
+
+The reward schemes compared in the experiments only differ in how they weight a few raw
+events of a step: the step itself, a costly (non no-op) action, the minigrid goal reward
+and termination (TimeCostWrapper, exp-1), and a box eaten and energy death (EnergyBoxes,
+exp-2). MultiRewardWrapper records these events once per step and accumulates the return
+of every configuration, so evaluating an agent under all schemes costs a single rollout.
+
+A configuration is a dict with the reward columns of the experiment csvs (time_cost,
+action_cost, final_reward_penalty for the minigrid envs, time_bonus, box_reward for the
+EnergyBoxes envs), e.g. parsed from "time_cost=0.0025,final_reward_penalty=false".
+"""
+import csv
+import numpy as np
+import gymnasium as gym
+from utils import strtobool
+
+# raw events of a step, see MultiRewardWrapper.events
+EVENTS = ["step", "costly_action", "goal_reward", "termination_bonus", "box_eaten", "energy_death"]
+REWARD_KEYS = {"time_cost": float, "action_cost": float, "final_reward_penalty": lambda x: bool(strtobool(str(x))),
+               "time_bonus": float, "box_reward": float}
+ENERGY_KEYS = ["time_bonus", "box_reward"]
+
+
+def parse_reward_config(spec):
+    """"key=value,key=value" (REWARD_KEYS) to a configuration dict."""
+    config = {}
+    for item in filter(None, spec.split(",")):
+        key, _, value = item.partition("=")
+        key = key.strip().replace("-", "_")
+        if key not in REWARD_KEYS:
+            raise ValueError(f"unknown reward key {key}, expected one of {list(REWARD_KEYS)}")
+        config[key] = REWARD_KEYS[key](value.strip())
+    return config
+
+def reward_configs_from_csv(path, env_id):
+    """Distinct reward configurations of the rows of an experiment csv that train on `env_id`."""
+    # as in train.py, only the EnergyBoxes envs use the energy keys and only the others TimeCostWrapper
+    keys = [key for key in REWARD_KEYS if (key in ENERGY_KEYS) == ("Energy" in env_id)]
+    configs = []
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            row = {key.replace("-", "_"): value for key, value in row.items()}
+            if row.get("env_id") != env_id:
+                continue
+            config = {key: REWARD_KEYS[key](row[key]) for key in keys if row.get(key) not in (None, "")}
+            if config not in configs:
+                configs.append(config)
+    return configs
+
+def config_name(config):
+    return ",".join(f"{key}={value}" for key, value in config.items()) or "default"
+
+def reward_weights(config, energy_env, initial_energy=0):
+    """Weights of the EVENTS in the reward of `config`."""
+    weights = dict.fromkeys(EVENTS, 0.)
+    if energy_env: # EnergyBoxesEnv.step
+        time_bonus = config.get("time_bonus", 0.1)
+        weights["step"] = time_bonus
+        weights["box_eaten"] = config.get("box_reward", 0.)
+        weights["energy_death"] = -initial_energy * time_bonus
+    else: # TimeCostWrapper.step
+        weights["step"] = -config.get("time_cost", 0.01)
+        weights["costly_action"] = -config.get("action_cost", 0.01)
+        weights["goal_reward"] = 1.
+        weights["termination_bonus"] = 0. if config.get("final_reward_penalty", False) else 1.
+    return np.array([weights[event] for event in EVENTS])
+
+
+class MultiRewardWrapper(gym.Wrapper):
+    """
+    Accumulates the returns of several reward configurations from the raw events of the
+    env, which must not be wrapped in TimeCostWrapper (the minigrid reward is one of the
+    events). The returns are stored in `info['config_returns']` at the end of an episode
+    and the step reward is that of the first configuration.
+    """
+
+    def __init__(self, env, configs, noops_actions=[4, 6]):
+        super().__init__(env)
+        self.configs = configs
+        self.noops_actions = noops_actions
+        self.energy_env = hasattr(self.env.unwrapped, "energy")
+        initial_energy = getattr(self.env.unwrapped, "initial_energy", 0)
+        self.weights = np.stack([reward_weights(config, self.energy_env, initial_energy) for config in configs])
+        self.returns = np.zeros(len(configs))
+        self.eat_count = 0
+
+    def reset(self, **kwargs):
+        self.returns[:] = 0
+        self.eat_count = 0
+        return self.env.reset(**kwargs)
+
+    def events(self, action, reward, terminated, info):
+        if self.energy_env:
+            # the eat count of the info is reset after the last step of an episode
+            box_eaten = info["eat_count"] - self.eat_count
+            self.eat_count = info["eat_count"]
+            return np.array([1., 0., 0., 0., box_eaten, terminated], dtype=np.float64)
+        return np.array([1., action not in self.noops_actions, reward, terminated * (1. - reward), 0., 0.])
+
+    def step(self, action):
+        obs, reward, terminated, truncated, info = self.env.step(action)
+        rewards = self.weights @ self.events(action, reward, terminated, info)
+        self.returns += rewards
+        if terminated or truncated:
+            info["config_returns"] = self.returns.copy()
+            self.returns[:] = 0
+            self.eat_count = 0
+        return obs, rewards[0], terminated, truncated, info
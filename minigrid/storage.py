@@ -1,46 +1,159 @@
 import torch
 import numpy as np
 import time
-from utils import get_state_tensor
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from utils import get_state_tensor, autocast
+from models import gumbel_noise
 
 MAX_PATIENCE = 1000
 
+
+def compute_gae(rewards, values, dones, next_value, next_done, gamma, gae_lambda):
+    """Generalised advantage estimates and returns of a (num_steps, num_envs) rollout."""
+    with torch.no_grad():
+        num_steps = rewards.shape[0]
+        advantages = torch.zeros_like(rewards)
+        lastgaelam = 0
+        for t in reversed(range(num_steps)):
+            if t == num_steps - 1:
+                nextnonterminal = 1.0 - next_done
+                nextvalues = next_value
+            else:
+                nextnonterminal = 1.0 - dones[t + 1]
+                nextvalues = values[t + 1]
+            delta = rewards[t] + gamma * nextvalues * nextnonterminal - values[t]
+            advantages[t] = lastgaelam = delta + gamma * gae_lambda * nextnonterminal * lastgaelam
+        returns = advantages + values
+    return advantages, returns
+
+def add_episode_stats(stats, episodes, final_timestep, is_boxes_env):
+    """Adds the per-episode arrays of the (global step, final info) `episodes` of a rollout to `stats`."""
+    infos = [info for _, info in episodes]
+    stats['episode_returns'] = np.array([info['episode']['r'].item() for info in infos])
+    stats['episode_lengths'] = np.array([info['episode']['l'].item() for info in infos])
+    stats['episode_timesteps'] = np.array([timestep for timestep, _ in episodes])
+    stats['final_timestep'] = final_timestep
+    if is_boxes_env:
+        stats['red_counts'] = np.array([info['red_count'] for info in infos])
+        stats['blue_counts'] = np.array([info['blue_count'] for info in infos])
+        stats['eat_counts'] = stats['red_counts']+stats['blue_counts']
+        stats['agent_distances'] = np.array([info['agent_distance'] for info in infos])
+        stats['consecutive_boxes'] = np.array([info['consecutive_boxes'] for info in infos])
+        stats['mix_rate'] = np.array([info['mix_rate'] for info in infos])
+    goal_counts = [info['goal_counts'] for info in infos if "goal_counts" in info]
+    if len(goal_counts) > 0:
+        stats['goal_counts'] = np.array(goal_counts)
+    return stats
+
+
+def chunk_size(agent, memory_cap_mb, training=False):
+    """
+    Observations per forward pass whose input, activations (and their gradients when
+    training) and sampling noise (one float per action) fit in the memory cap.
+    """
+    per_obs = agent.activation_bytes() * (2 if training else 1) + 4 * int(np.prod(agent.obs_dim)) + 4 * agent.actor[-1].out_features
+    return max(1, int(memory_cap_mb * 2**20 // per_obs))
+
+def host_obs_buffer(shape, memory_cap_mb, spill_dir=None):
+    """
+    uint8 rollout observations in host memory, or in a memory-mapped temporary file of
+    `spill_dir` when they do not fit in the memory cap.
+    """
+    if np.prod(shape) <= memory_cap_mb * 2**20:
+        return torch.zeros(shape, dtype=torch.uint8)
+    # the file is unlinked when closed, the mapping keeps its pages until the buffer is freed
+    with tempfile.NamedTemporaryFile(dir=spill_dir, prefix="rollout-obs-", suffix=".bin") as f:
+        return torch.from_numpy(np.memmap(f, dtype=np.uint8, mode="w+", shape=shape))
+
+
 class TrajectoryCollector:
-    def __init__(self, envs, obs_dim, agent, args, device, is_boxes_env=False):
+    def __init__(self, envs, obs_dim, agent, args, device, is_boxes_env=False, num_buffers=1):
         self.envs = envs
         self.agent = agent
         self.args = args
         self.device = device
         self.obs_dim = tuple(obs_dim)
         self.is_boxes_env = is_boxes_env
+        # the embedding encoder reads the planes as categories, they are stored as bytes
+        self.obs_dtype = torch.uint8 if args.encoder == "embedding" else torch.float32
+        # with a memory cap, observations stay on the host as bytes and inference runs in chunks of envs
+        self.memory_bounded = args.memory_cap_mb > 0
+        self.chunk_size = chunk_size(agent, args.memory_cap_mb) if self.memory_bounded else args.num_envs
 
-        self.obs = torch.zeros((self.args.num_steps, self.args.num_envs) + self.obs_dim).to(device)
-        self.actions = torch.zeros((self.args.num_steps, self.args.num_envs) + envs.single_action_space.shape).to(device)
-        self.logprobs = torch.zeros((self.args.num_steps, self.args.num_envs)).to(device)
-        self.rewards = torch.zeros((self.args.num_steps, self.args.num_envs)).to(device)
-        self.dones = torch.zeros((self.args.num_steps, self.args.num_envs)).to(device)
-        self.values = torch.zeros((self.args.num_steps, self.args.num_envs)).to(device)
+        # several buffers let a rollout be collected while the previous batch is still in use
+        self.buffers = [self._allocate_buffer() for _ in range(num_buffers)]
+        self.buffer_idx = 0
         self.global_step = 0
 
+    def _allocate_buffer(self):
+        if self.args.dedup_obs:
+            # observations are stored as rows of the unique observation table of the rollout
+            obs = {'obs_idx': torch.zeros((self.args.num_steps, self.args.num_envs), dtype=torch.long).to(self.device)}
+        elif self.memory_bounded:
+            obs = {'obs': host_obs_buffer((self.args.num_steps, self.args.num_envs) + self.obs_dim,
+                                          self.args.memory_cap_mb, self.args.spill_dir)}
+        else:
+            obs = {'obs': torch.zeros((self.args.num_steps, self.args.num_envs) + self.obs_dim, dtype=self.obs_dtype).to(self.device)}
+        return {
+            **obs,
+            'actions': torch.zeros((self.args.num_steps, self.args.num_envs) + self.envs.single_action_space.shape).to(self.device),
+            'logprobs': torch.zeros((self.args.num_steps, self.args.num_envs)).to(self.device),
+            'rewards': torch.zeros((self.args.num_steps, self.args.num_envs)).to(self.device),
+            'dones': torch.zeros((self.args.num_steps, self.args.num_envs)).to(self.device),
+            'values': torch.zeros((self.args.num_steps, self.args.num_envs)).to(self.device),
+        }
+
+    def _next_buffer(self):
+        """Points self.obs, self.actions, ... to the next buffer."""
+        for name, tensor in self.buffers[self.buffer_idx].items():
+            setattr(self, name, tensor)
+        self.buffer_idx = (self.buffer_idx + 1) % len(self.buffers)
+
+    def _index_obs(self, obs):
+        """Rows of the (cpu) observations `obs` in the unique observation table, adding the new ones."""
+        keys = obs.to(torch.uint8).numpy().reshape(len(obs), -1) # observations are small integers
+        indices = []
+        for i, key in enumerate(keys):
+            key = key.tobytes()
+            if key not in self.obs_keys:
+                self.obs_keys[key] = len(self.obs_table)
+                self.obs_table.append(obs[i])
+            indices.append(self.obs_keys[key])
+        return torch.tensor(indices)
+
+    def _store_obs(self, step, obs):
+        """Stores the cpu observations `obs` of `step` and returns them on the device (on the host if memory-bounded)."""
+        if self.args.dedup_obs:
+            self.obs_idx[step] = self._index_obs(obs).to(self.device)
+            return obs.to(self.device)
+        if self.memory_bounded:
+            self.obs[step] = obs
+            return obs
+        obs = obs.to(self.device)
+        self.obs[step] = obs
+        return obs
+
     def collect_trajectories(self):
         
+        self._next_buffer()
         stats = {'initial_timestep': self.global_step}
-        episode_returns, episode_lengths, episode_timesteps = [], [], []
-        if self.is_boxes_env: 
-            red_counts, blue_counts, agent_distances, consecutive_boxes, mix_rates = [], [], [], [], []
-        goal_counts = []
+        episodes = [] # (global step, final info) of the finished episodes
+        self.obs_keys, self.obs_table = {}, []
         state = self.envs.reset()[0]
-        next_obs = get_state_tensor(state).to(self.device)
+        next_obs = get_state_tensor(state)
         next_done = torch.zeros(self.args.num_envs).to(self.device)
+        gumbel = None
+        if self.args.gumbel_sampling and not self.memory_bounded:
+            # noise of the whole rollout, drawn from the global (seeded) torch rng
+            gumbel = gumbel_noise((self.args.num_steps, self.args.num_envs, self.envs.single_action_space.n), self.device)
 
         for step in range(0, self.args.num_steps):
-            self.global_step += 1 * self.args.num_envs
-            self.obs[step] = next_obs
+            self.global_step += 1 * self.args.num_envs * self.args.num_ranks
+            next_obs = self._store_obs(step, next_obs)
             self.dones[step] = next_done
 
-            with torch.no_grad():
-                action, logprob, _, value = self.agent.get_action_and_value(next_obs)
-                self.values[step] = value.flatten()
+            action, logprob, self.values[step] = self._act(next_obs, gumbel[step] if gumbel is not None else None)
             self.actions[step] = action
             self.logprobs[step] = logprob
 
@@ -48,7 +161,6 @@ class TrajectoryCollector:
             next_obs = get_state_tensor(next_state)
             done = truncated | terminated
             self.rewards[step] = torch.tensor(reward).to(self.device).view(-1)
-            next_obs = next_obs.to(self.device)
             next_done = torch.Tensor(done).to(self.device)
 
             # info is a dict with final_info and final_observation for the envs which reached a terminal state
@@ -56,53 +168,185 @@ class TrajectoryCollector:
             if 'final_info' in info:
                 for env_final_info in info['final_info']:
                     if env_final_info is not None:
-                        if self.is_boxes_env: 
-                            red_counts.append(env_final_info['red_count'])
-                            blue_counts.append(env_final_info['blue_count'])
-                            agent_distances.append(env_final_info['agent_distance'])
-                            consecutive_boxes.append(env_final_info['consecutive_boxes'])
-                            mix_rates.append(env_final_info['mix_rate'])
-
-                        episode_returns.append(env_final_info['episode']['r'].item())
-                        episode_lengths.append(env_final_info['episode']['l'].item())
-                        episode_timesteps.append(self.global_step)
-                        if "goal_counts" in env_final_info:
-                            goal_counts.append(env_final_info['goal_counts'])
-
-        with torch.no_grad():
-            next_value = self.agent.get_value(next_obs).reshape(1, -1)
-            advantages = torch.zeros_like(self.rewards).to(self.device)
-            lastgaelam = 0
-            for t in reversed(range(self.args.num_steps)):
-                if t == self.args.num_steps - 1:
-                    nextnonterminal = 1.0 - next_done
-                    nextvalues = next_value
+                        episodes.append((self.global_step, env_final_info))
+
+        with torch.no_grad(), autocast(self.args, self.device):
+            next_value = torch.cat([self.agent.get_value(next_obs[start:start + self.chunk_size].to(self.device))
+                                    for start in range(0, self.args.num_envs, self.chunk_size)]).reshape(1, -1)
+        if self.args.dedup_obs:
+            stats['unique_obs'] = len(self.obs_table)
+        return self._batch(next_value, next_done), add_episode_stats(stats, episodes, self.global_step, self.is_boxes_env)
+
+    def _act(self, obs, gumbel=None):
+        """
+        Actions, log probs and values of the observations, in forward passes of at most
+        self.chunk_size envs. With --gumbel-sampling, `gumbel` is the noise of the step, or
+        None in a memory-bounded rollout, whose noise is drawn chunk by chunk.
+        """
+        outputs = []
+        for start in range(0, len(obs), self.chunk_size):
+            chunk = obs[start:start + self.chunk_size].to(self.device)
+            with torch.no_grad(), autocast(self.args, self.device):
+                if self.args.gumbel_sampling:
+                    noise = gumbel[start:start + self.chunk_size] if gumbel is not None else \
+                        gumbel_noise((len(chunk), self.envs.single_action_space.n), self.device)
+                    action, logprob, value = self.agent.sample_action_and_value(chunk, noise)
                 else:
-                    nextnonterminal = 1.0 - self.dones[t + 1]
-                    nextvalues = self.values[t + 1]
-                delta = self.rewards[t] + self.args.gamma * nextvalues * nextnonterminal - self.values[t]
-                advantages[t] = lastgaelam = delta + self.args.gamma * self.args.gae_lambda * nextnonterminal * lastgaelam
-            returns = advantages + self.values
-
-        batch = {'obs': self.obs.reshape((-1,) + self.obs_dim),
-                    'log_probs': self.logprobs.reshape(-1),
-                    'actions': self.actions.reshape((-1,) + self.envs.single_action_space.shape),
-                    'advantages': advantages.reshape(-1),
-                    'returns': returns.reshape(-1),
-                    'values': self.values.reshape(-1)}
-        
-        stats['episode_returns'] = np.array(episode_returns)
-        stats['episode_lengths'] = np.array(episode_lengths)
-        stats['episode_timesteps'] = np.array(episode_timesteps)
-        stats['final_timestep'] = self.global_step
-        if self.is_boxes_env: 
-            stats['red_counts'] = np.array(red_counts)
-            stats['blue_counts'] = np.array(blue_counts)
-            stats['eat_counts'] = stats['red_counts']+stats['blue_counts']
-            stats['agent_distances'] = np.array(agent_distances)
-            stats['consecutive_boxes'] = np.array(consecutive_boxes)
-            stats['mix_rate'] = np.array(mix_rates)
-        if len(goal_counts) > 0:
-            stats['goal_counts'] = np.array(goal_counts)
-        
-        return batch, stats
\ No newline at end of file
+                    action, logprob, _, value = self.agent.get_action_and_value(chunk)
+            outputs.append((action, logprob, value.flatten()))
+        return [torch.cat(tensors) for tensors in zip(*outputs)]
+
+    def _batch(self, next_value, next_done):
+        """Flattened rollout of the current buffer with its GAE advantages and returns."""
+        advantages, returns = compute_gae(self.rewards, self.values, self.dones, next_value, next_done,
+                                          self.args.gamma, self.args.gae_lambda)
+        if self.args.dedup_obs:
+            obs = {'obs_table': torch.stack(self.obs_table).to(self.device, self.obs_dtype), 'obs_idx': self.obs_idx.reshape(-1)}
+        else:
+            # host observations of a memory-bounded rollout are streamed to the device by the PPO update
+            obs = {'obs': self.obs.reshape((-1,) + self.obs_dim)}
+        return {**obs,
+                'log_probs': self.logprobs.reshape(-1),
+                'actions': self.actions.reshape((-1,) + self.envs.single_action_space.shape),
+                'advantages': advantages.reshape(-1),
+                'returns': returns.reshape(-1),
+                'values': self.values.reshape(-1)}
+
+
+class PipelinedCollector:
+    """
+    Overlaps collection and learning: while the learner updates on rollout k,
+    rollout k+1 is collected in a background thread with a frozen copy of the policy.
+    The frozen copy is refreshed from the learner whenever a rollout would otherwise
+    be more than `max_policy_lag` updates behind the policy that trains on it.
+    The off-policyness is handled by the PPO ratio clipping.
+    """
+
+    def __init__(self, storage, agent, max_policy_lag=1):
+        """
+        Args:
+            storage: TrajectoryCollector with 2 buffers, acting with a copy of `agent`
+            agent: the agent updated by the learner
+            max_policy_lag: maximum number of updates between the acting and the learning policy
+        """
+        assert len(storage.buffers) >= 2, "the pipelined collector needs a double-buffered storage"
+        assert max_policy_lag >= 1, "collection and learning can only overlap with a policy lag of at least 1"
+        self.storage = storage
+        self.agent = agent
+        self.actor = storage.agent
+        self.max_policy_lag = max_policy_lag
+        self.is_boxes_env = storage.is_boxes_env
+
+        self.actor_version = 0 # learner update the actor weights come from
+        self.num_rollouts = 0 # rollouts handed to the learner, i.e. its number of updates on the next call
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        # the storage step counter runs ahead while the next rollout is collected
+        self.consumed_step = storage.global_step
+
+    @property
+    def global_step(self):
+        """Final timestep of the last rollout handed to the learner."""
+        return self.consumed_step
+
+    @global_step.setter
+    def global_step(self, value):
+        self.storage.global_step = self.consumed_step = value
+
+    def _collect(self, policy_version):
+        start = time.time()
+        batch, stats = self.storage.collect_trajectories()
+        stats['collect_time'] = time.time() - start
+        stats['policy_version'] = policy_version
+        return batch, stats
+
+    def collect_trajectories(self):
+        """Returns the rollout collected in the background and starts collecting the next one."""
+        if self.future is None:
+            # the learner weights may have been restored from a checkpoint after construction
+            self.actor.load_state_dict(self.agent.state_dict())
+            self.future = self.executor.submit(self._collect, self.actor_version)
+
+        wait_start = time.time()
+        batch, stats = self.future.result()
+        stats['wait_time'] = time.time() - wait_start
+        stats['policy_lag'] = self.num_rollouts - stats['policy_version']
+        self.num_rollouts += 1
+        self.consumed_step = stats['final_timestep']
+
+        # the next rollout is trained on after one more update, refresh the actor if it would be too stale
+        if self.num_rollouts - self.actor_version > self.max_policy_lag:
+            self.actor.load_state_dict(self.agent.state_dict())
+            self.actor_version = self.num_rollouts - 1
+        self.future = self.executor.submit(self._collect, self.actor_version)
+
+        return batch, stats
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class ServedCollector(TrajectoryCollector):
+    """
+    Collects the rollouts of envs stepped in worker processes, acting on the dynamic
+    batches of an InferenceServer (see inference_server.py). Every env still fills
+    num_steps steps of the buffers, but envs progress at their own pace.
+    """
+
+    def __init__(self, server, envs, obs_dim, agent, args, device, is_boxes_env=False):
+        """`envs` is only used for the observation and action spaces."""
+        super().__init__(envs, obs_dim, agent, args, device, is_boxes_env=is_boxes_env)
+        self.server = server
+
+    def collect_trajectories(self):
+        self._next_buffer()
+        stats = {'initial_timestep': self.global_step}
+        episodes = []
+        server, k = self.server, self.server.envs_per_worker
+        worker_steps = np.zeros(server.num_workers, dtype=int)
+        next_value = torch.zeros(self.args.num_envs).to(self.device)
+        next_done = torch.zeros(self.args.num_envs).to(self.device)
+        snapshot = server.snapshot()
+        deferred = [] # requests of the next rollout (workers that already finished this one)
+
+        while (worker_steps > self.args.num_steps).sum() < server.num_workers:
+            requests = server.next_batch()
+            deferred += [r for r in requests if worker_steps[r[0]] > self.args.num_steps]
+            requests = [r for r in requests if worker_steps[r[0]] <= self.args.num_steps]
+            if not requests:
+                continue
+            workers = [w for w, _ in requests]
+            rows = server.rows(workers)
+            obs = server.observations(rows).to(self.device)
+            with torch.no_grad(), autocast(self.args, self.device):
+                action, logprob, _, value = self.agent.get_action_and_value(obs)
+                value = value.flatten()
+
+            for i, (w, worker_episodes) in enumerate(requests):
+                batch_rows, env_rows, step = slice(i * k, (i + 1) * k), slice(w * k, (w + 1) * k), worker_steps[w]
+                for env_idx, final_info in worker_episodes:
+                    episodes.append((self.global_step, final_info))
+                done = server.shared['done'][env_rows].float().to(self.device)
+                if step > 0:
+                    self.rewards[step - 1, env_rows] = server.shared['reward'][env_rows].float().to(self.device)
+                if step == self.args.num_steps:
+                    # bootstrap request, its action is ignored by the worker
+                    next_value[env_rows] = value[batch_rows]
+                    next_done[env_rows] = done
+                else:
+                    self.global_step += k * self.args.num_ranks
+                    self.obs[step, env_rows] = obs[batch_rows]
+                    self.dones[step, env_rows] = done
+                    self.values[step, env_rows] = value[batch_rows]
+                    self.actions[step, env_rows] = action[batch_rows].to(self.actions.dtype)
+                    self.logprobs[step, env_rows] = logprob[batch_rows]
+                worker_steps[w] += 1
+            server.respond(workers, rows, action)
+        server.pending += deferred
+
+        stats.update(server.metrics(since=snapshot))
+        return self._batch(next_value.reshape(1, -1), next_done), \
+               add_episode_stats(stats, episodes, self.global_step, self.is_boxes_env)
+
+    def close(self):
+        self.server.close()
@@ -0,0 +1,316 @@
+"""
+Exact solutions of the EnergyBoxes MDPs, as a reference for trained agents.
+
+The state of an EnergyBoxes env is small: agent position and direction, the two box
+states, the energy, and for EnergyBoxesHard the last box opened. EnergyBoxesMDP
+enumerates it and builds the transitions from the env parameters (refill_prob,
+box_energy_refuel, initial_energy, ...) as EnergyBoxesEnv.step applies them, then
+value iteration gives the optimal values and policy of a time_bonus/box_reward
+configuration in seconds.
+
+Agents only see the 7x7 observation, which shows the boxes as they were before the
+previous step (the observation is generated before the box is eaten and refilled), and not
+the energy. To evaluate an agent, the state is extended with these observed box states and
+its action probabilities are computed once for every observation. The regret of an agent is
+the optimal discounted return from the initial states minus its own.
+
+Episodes are treated as infinite-horizon discounted problems (the 512 steps truncation is
+ignored) and the energy is capped at `max_energy`.
+
+    python tabular.py --env-id EnergyBoxes --experiments experiments/exp-2.csv
+    python tabular.py --env-id EnergyBoxesHard --reward-configs "time_bonus=0.1,box_reward=0" --agents 1019_141439
+"""
+import os
+import time
+import argparse
+import warnings
+import numpy as np
+import torch
+from minigrid.core.constants import DIR_TO_VEC
+from customenvs import ENERGY_ENVS, EnergyBoxesHardEnv
+from rewards import parse_reward_config, reward_configs_from_csv, config_name
+from utils import get_state_tensor
+from weightstore import agent_paths
+
+NUM_ACTIONS = 7
+PICKUP = 3
+
+
+def make_env(env_id):
+    """The env as created by train.py (and behaviour.py)."""
+    return ENERGY_ENVS[env_id](agent_start_dir="random",
+                               agent_start_pos="random" if env_id == "EnergyBoxesDelay" else (1,1))
+
+
+class EnergyBoxesMDP:
+    """
+    Tabular model of an EnergyBoxes env. States are indexed as
+    (position, direction, boxes, observed boxes, last box opened, energy - 1), with bit k of
+    `boxes` set if box k is full, and an absorbing state (index `num_states`) after energy death.
+    """
+
+    def __init__(self, env, max_energy=None, observed=False):
+        """
+        Args:
+            env: EnergyBoxes env instance the parameters are read from
+            max_energy: energy cap (initial_energy + 4 box refuels by default)
+            observed: whether to track the box states shown in the agent observation
+        """
+        env = env.unwrapped
+        self.env = env
+        self.hard = isinstance(env, EnergyBoxesHardEnv)
+        self.initial_energy = env.initial_energy
+        self.max_energy = max_energy or env.initial_energy + 4 * env.box_energy_refuel
+        self.box_positions = [tuple(pos) for pos in env.box_positions]
+        self.positions = [(x, y) for y in range(1, env.height - 1) for x in range(1, env.width - 1)
+                          if (x, y) not in self.box_positions]
+        self.shape = (len(self.positions), 4, 4, 4 if observed else 1, 3 if self.hard else 1, self.max_energy)
+        self.num_states = int(np.prod(self.shape))
+
+        pos, direction, boxes, seen, last, energy = np.indices(self.shape).reshape(len(self.shape), -1)
+        energy = energy + 1
+        move, facing = self._move_tables()
+
+        # per action: outcomes of the two refill draws, next states, probabilities, boxes eaten and deaths
+        self.next_states = np.empty((NUM_ACTIONS, 4, self.num_states), dtype=np.int64)
+        self.probs = np.empty((NUM_ACTIONS, 4, self.num_states))
+        self.eaten = np.empty((NUM_ACTIONS, self.num_states))
+        self.death = np.empty((NUM_ACTIONS, self.num_states))
+        for action in range(NUM_ACTIONS):
+            next_pos, next_dir = move[action, pos, direction].T
+            box = facing[pos, direction]
+            eaten = (action == PICKUP) & (box >= 0) & (((boxes >> np.maximum(box, 0)) & 1) == 1)
+            next_boxes = np.where(eaten, boxes & ~(1 << np.maximum(box, 0)), boxes)
+            next_last = np.where(eaten, box + 1, last) if self.hard else last # 0: none, 1: blue (box 0), 2: red (box 1)
+            next_energy = np.minimum(energy + eaten * env.box_energy_refuel - env.time_energy_cost - env.action_energy_cost,
+                                     self.max_energy)
+            dead = next_energy <= 0
+            next_seen = boxes if observed else seen
+            for outcome in range(4): # bit k: box k refilled
+                prob = np.ones(self.num_states)
+                for k in range(2):
+                    empty = ((next_boxes >> k) & 1) == 0
+                    refilled = (outcome >> k) & 1
+                    prob *= np.where(empty, env.refill_prob if refilled else 1 - env.refill_prob, 1 - refilled)
+                outcome_boxes = next_boxes | outcome
+                if self.hard: # EnergyBoxesHardEnv.step refills the other box
+                    refill_red = ((outcome_boxes & 1) == 0) & (next_last == 1)
+                    refill_blue = ~refill_red & ((outcome_boxes & 2) == 0) & (next_last == 2)
+                    outcome_boxes = outcome_boxes | refill_red * 2 | refill_blue * 1
+                index = np.ravel_multi_index((next_pos, next_dir, outcome_boxes, next_seen, next_last,
+                                              np.clip(next_energy, 1, None) - 1), self.shape)
+                self.next_states[action, outcome] = np.where(dead, self.num_states, index)
+                self.probs[action, outcome] = prob
+            self.eaten[action], self.death[action] = eaten, dead
+
+        # sparse (actions * states, states + 1) transition matrix, most refill outcomes are impossible
+        rows = np.broadcast_to(np.arange(NUM_ACTIONS * self.num_states).reshape(NUM_ACTIONS, 1, -1), self.probs.shape)
+        nonzero = self.probs > 0
+        indices = torch.from_numpy(np.stack([rows[nonzero], self.next_states[nonzero]]))
+        transitions = torch.sparse_coo_tensor(indices, torch.from_numpy(self.probs[nonzero]),
+                                              (NUM_ACTIONS * self.num_states, self.num_states + 1), check_invariants=True)
+        with warnings.catch_warnings(): # CSR tensors are "beta", but much faster than COO for the products
+            warnings.simplefilter("ignore", UserWarning)
+            self.transitions = transitions.coalesce().to_sparse_csr()
+
+        self.initial_distribution = self._initial_distribution()
+
+    def _move_tables(self):
+        """Next (position, direction) of every action and the box faced (-1 for none) per (position, direction)."""
+        index = {pos: i for i, pos in enumerate(self.positions)}
+        move = np.empty((NUM_ACTIONS, len(self.positions), 4, 2), dtype=np.int64)
+        facing = np.full((len(self.positions), 4), -1)
+        for p, pos in enumerate(self.positions):
+            for d in range(4):
+                move[:, p, d] = p, d
+                move[0, p, d, 1], move[1, p, d, 1] = (d - 1) % 4, (d + 1) % 4
+                front = tuple(np.array(pos) + DIR_TO_VEC[d])
+                if front in index: # walls and boxes cannot be walked on
+                    move[2, p, d, 0] = index[front]
+                if front in self.box_positions:
+                    facing[p, d] = self.box_positions.index(front)
+        return move, facing
+
+    def _initial_distribution(self):
+        """EnergyBoxesEnv.reset: start position and direction, one full box at random (both in EnergyBoxesHard)."""
+        env = self.env
+        starts = [(1, 1), (env.width - 2, env.height - 2)] if env.start_pos_random else [tuple(env.agent_start_pos)]
+        directions = range(4) if env.start_dir_random else [env.agent_start_dir]
+        box_states = [3] if self.hard else [1, 2]
+        observed = self.shape[3] > 1
+        distribution = np.zeros(self.num_states + 1)
+        for start in starts:
+            for d in directions:
+                for boxes in box_states:
+                    index = np.ravel_multi_index((self.positions.index(start), d, boxes, boxes if observed else 0, 0,
+                                                  min(self.initial_energy, self.max_energy) - 1), self.shape)
+                    distribution[index] += 1 / (len(starts) * len(directions) * len(box_states))
+        return distribution
+
+    def rewards(self, config):
+        """(actions, states) expected rewards of a time_bonus/box_reward configuration."""
+        time_bonus = config.get("time_bonus", 0.1)
+        return config.get("box_reward", 0.) * self.eaten + time_bonus * (1 - self.death * self.initial_energy)
+
+    def q_values(self, rewards, values, gamma):
+        """(..., actions, states) Q values of (..., states + 1) values, the absorbing state being the last one."""
+        batch_shape = values.shape[:-1]
+        expected = (self.transitions @ torch.from_numpy(values.reshape(-1, self.num_states + 1).T)).numpy()
+        return rewards + gamma * expected.T.reshape(batch_shape + (NUM_ACTIONS, self.num_states))
+
+    def value_iteration(self, config, gamma=0.99, tol=1e-6, max_iterations=100000):
+        """Optimal state values (with the absorbing state), greedy policy and number of iterations."""
+        rewards = self.rewards(config)
+        values = np.zeros(self.num_states + 1)
+        for iteration in range(1, max_iterations + 1):
+            q = self.q_values(rewards, values, gamma)
+            new_values = q.max(axis=0)
+            delta = np.abs(new_values - values[:-1]).max()
+            values[:-1] = new_values
+            if delta < tol:
+                break
+        return values, q.argmax(axis=0), iteration
+
+    def policy_evaluation(self, config, policies, gamma=0.99, tol=1e-6, max_iterations=100000):
+        """
+        State values of a batch of stochastic `policies`, (policies, actions, states) action
+        probabilities, returned as (policies, states + 1).
+        """
+        rewards = self.rewards(config)
+        values = np.zeros((len(policies), self.num_states + 1))
+        for _ in range(max_iterations):
+            new_values = (policies * self.q_values(rewards, values, gamma)).sum(axis=1)
+            delta = np.abs(new_values - values[:, :-1]).max()
+            values[:, :-1] = new_values
+            if delta < tol:
+                break
+        return values
+
+    def observations(self):
+        """Agent observations of every (position, direction, observed boxes), as a (P * 4 * 4, 4, 7, 7) tensor."""
+        env = self.env
+        env.reset()
+        images, directions = [], []
+        for pos in self.positions:
+            for d in range(4):
+                for boxes in range(4):
+                    for k, box_pos in enumerate(self.box_positions):
+                        env.grid.get(*box_pos).state = (boxes >> k) & 1
+                    env.agent_pos, env.agent_dir = pos, d
+                    obs = env.gen_obs()
+                    images.append(obs['image'])
+                    directions.append(obs['direction'])
+        return get_state_tensor({'image': np.array(images), 'direction': np.array(directions)})
+
+    def agent_policies(self, agents, greedy=False):
+        """(agents, actions, states) action probabilities of agents acting on their observations."""
+        assert self.shape[3] > 1, "the observed box states are needed to evaluate agents"
+        obs = self.observations()
+        policies = []
+        for agent in agents:
+            with torch.inference_mode():
+                logits = agent(obs)[0].float()
+            probs = torch.nn.functional.one_hot(logits.argmax(-1), NUM_ACTIONS).double() if greedy \
+                else torch.softmax(logits.double(), dim=-1)
+            # (position, direction, observed boxes, actions) broadcast over the box states, last box and energy
+            probs = probs.numpy().reshape(self.shape[0], 4, 1, 4, 1, 1, NUM_ACTIONS)
+            policies.append(np.broadcast_to(probs, self.shape + (NUM_ACTIONS,)).reshape(-1, NUM_ACTIONS).T)
+        return np.stack(policies)
+
+    def initial_value(self, values):
+        return values @ self.initial_distribution
+
+    def state_index(self, env):
+        """Index of the current state of a (non observed) env, to act with the optimal policy."""
+        env = env.unwrapped
+        last = {None: 0, "blue": 1, "red": 2}[env.last_box_opened] if self.hard else 0
+        boxes = sum(env.grid.get(*pos).state << k for k, pos in enumerate(self.box_positions))
+        return np.ravel_multi_index((self.positions.index(tuple(env.agent_pos)), env.agent_dir, boxes, 0, last,
+                                     min(env.energy, self.max_energy) - 1), self.shape)
+
+
+def check_optimal_policy(env_id, config, mdp, policy, gamma, num_episodes, seed):
+    """
+    Mean discounted return of the optimal policy in the env, to check the model against the
+    env dynamics (up to the truncation of the episodes, a factor 1 - gamma**512 at most).
+    """
+    env = ENERGY_ENVS[env_id](agent_start_dir="random",
+                              agent_start_pos="random" if env_id == "EnergyBoxesDelay" else (1,1),
+                              time_bonus=config.get("time_bonus", 0.1), box_open_reward=config.get("box_reward", 0),
+                              seed=seed)
+    returns = []
+    for episode in range(num_episodes):
+        env.reset(seed=seed + episode)
+        env.last_box_opened = None
+        discounted_return, discount = 0., 1.
+        while True:
+            _, reward, terminated, truncated, _ = env.step(policy[mdp.state_index(env)])
+            discounted_return += discount * reward
+            discount *= gamma
+            if terminated or truncated:
+                break
+        returns.append(discounted_return)
+    return np.mean(returns), np.std(returns) / np.sqrt(num_episodes)
+
+def find_agents(args):
+    """Paths of the selected checkpoints in trained-models/<env-id> ("all" for every agent of the env)."""
+    if args.agent_path:
+        return args.agent_path
+    if args.agents is None:
+        return []
+    return agent_paths(os.path.join('trained-models', args.env_id), None if args.agents == ["all"] else args.agents)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Optimal values of the EnergyBoxes envs and regret of trained agents')
+    parser.add_argument("--env-id", type=str, default="EnergyBoxes", choices=list(ENERGY_ENVS))
+    parser.add_argument("--reward-configs", type=str, nargs="+", default=[],
+                        help="time_bonus/box_reward configurations, e.g. 'time_bonus=0.1,box_reward=0' (the env default if none)")
+    parser.add_argument("--experiments", type=str, default=None,
+                        help="experiment csv whose reward configurations for --env-id are added to --reward-configs")
+    parser.add_argument("--gamma", type=float, default=0.99)
+    parser.add_argument("--max-energy", type=int, default=None,
+                        help="energy cap of the model, initial energy + 4 box refuels by default")
+    parser.add_argument("--tol", type=float, default=1e-6)
+    parser.add_argument("--agents", type=str, nargs="+", default=None,
+                        help="agent names (actor_<name>.pth or .json) to compute the regret of, 'all' for every agent of the env")
+    parser.add_argument("--agent-path", type=str, nargs="+", default=None,
+                        help="agent checkpoints (.pth) or exported policies used instead of the agent names")
+    parser.add_argument("--greedy", default=False, action='store_true',
+                        help="evaluate the greedy policies of the agents instead of their stochastic policies")
+    parser.add_argument("--check-episodes", type=int, default=0,
+                        help="if positive, run the optimal policy in the env for this many episodes to check the model")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    configs = [parse_reward_config(spec) for spec in args.reward_configs]
+    if args.experiments:
+        configs += reward_configs_from_csv(args.experiments, args.env_id)
+    configs = configs or [{}]
+
+    start = time.perf_counter()
+    mdp = EnergyBoxesMDP(make_env(args.env_id), args.max_energy)
+    print(f"{args.env_id}: {mdp.num_states} states, energy capped at {mdp.max_energy} "
+          f"(model built in {time.perf_counter() - start:.2f} s)")
+
+    paths = find_agents(args)
+    if paths:
+        from export import load_policy
+        observed_mdp = EnergyBoxesMDP(make_env(args.env_id), args.max_energy, observed=True)
+        policies = observed_mdp.agent_policies([load_policy(path).eval() for path in paths], greedy=args.greedy)
+
+    for config in configs:
+        start = time.perf_counter()
+        values, policy, iterations = mdp.value_iteration(config, args.gamma, args.tol)
+        optimal = mdp.initial_value(values)
+        print(f"\n{config_name(config)}: optimal value {optimal:.3f} ({iterations} iterations, "
+              f"{time.perf_counter() - start:.2f} s)")
+        if args.check_episodes:
+            mean, stderr = check_optimal_policy(args.env_id, config, mdp, policy, args.gamma, args.check_episodes, args.seed)
+            print(f"optimal policy in the env: {mean:.3f} +- {stderr:.3f} over {args.check_episodes} episodes")
+        if paths:
+            start = time.perf_counter()
+            agent_values = observed_mdp.initial_value(observed_mdp.policy_evaluation(config, policies, args.gamma, args.tol))
+            print(f"{'agent':<40}{'value':>10}{'regret':>10}  ({time.perf_counter() - start:.2f} s)")
+            for path, value in zip(paths, agent_values):
+                print(f"{os.path.basename(path):<40}{value:>10.3f}{optimal - value:>10.3f}")
@@ -0,0 +1,162 @@
+"""
+Memory and CPU telemetry of a training process, per training phase.
+
+A background thread samples the resident memory (RSS) and thread count of the process
+every `interval` seconds and attributes the samples to the phase the training loop is
+in (`with sampler.phase("collect"): ...`). CPU utilisation of a phase is its process CPU
+time over its wall time (100% per busy core). Only the current process is measured, env
+worker processes (--inference-server) are not included.
+"""
+import os
+import math
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+MB = 1024 ** 2
+
+
+def read_process():
+    """(rss, peak rss) in bytes and number of threads of the current process."""
+    try:
+        values = {}
+        with open('/proc/self/status') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'VmHWM', 'Threads'):
+                    values[key] = int(value.split()[0])
+        return values['VmRSS'] * 1024, values['VmHWM'] * 1024, values['Threads']
+    except (OSError, KeyError): # no procfs (macOS), ru_maxrss is in bytes there
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak, peak, threading.active_count()
+
+def cpu_time():
+    times = os.times()
+    return times.user + times.system
+
+def tensor_bytes(tensors):
+    return sum(t.element_size() * t.nelement() for t in tensors)
+
+def storage_bytes(storage):
+    """Bytes of the rollout buffers of a TrajectoryCollector (or of the one wrapped by a PipelinedCollector)."""
+    storage = getattr(storage, 'storage', storage)
+    return tensor_bytes([t for buffer in storage.buffers for t in buffer.values()])
+
+
+class PhaseStats:
+    def __init__(self):
+        self.wall, self.cpu, self.samples, self.rss_sum, self.peak_rss, self.max_threads = 0., 0., 0, 0, 0, 0
+
+    def add_sample(self, rss, threads):
+        self.samples += 1
+        self.rss_sum += rss
+        self.peak_rss = max(self.peak_rss, rss)
+        self.max_threads = max(self.max_threads, threads)
+
+    def as_dict(self):
+        return {"time": self.wall,
+                "cpu_percent": 100 * self.cpu / self.wall if self.wall > 0 else 0.,
+                "mean_rss_mb": self.rss_sum / max(1, self.samples) / MB,
+                "peak_rss_mb": self.peak_rss / MB,
+                "threads": self.max_threads}
+
+
+class ResourceSampler:
+    """
+    Background sampler of RSS, CPU utilisation and thread count per training phase.
+    `metrics()` returns the stats since its previous call (logged with the training
+    metrics), `summary()` those of the whole run.
+    """
+
+    def __init__(self, interval=0.5, enabled=True):
+        self.interval = interval
+        self.enabled = enabled
+        self.current = "other" # samples outside of any phase
+        self.window, self.total = {}, {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.start_time, self.start_cpu = time.perf_counter(), cpu_time()
+        self.buffer_bytes = 0
+
+    def start(self):
+        if self.enabled:
+            self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread.is_alive():
+            self.stop_event.set()
+            self.thread.join()
+
+    def _stats(self, phase):
+        return [stats.setdefault(phase, PhaseStats()) for stats in (self.window, self.total)]
+
+    def sample(self):
+        rss, _, threads = read_process()
+        with self.lock:
+            for stats in self._stats(self.current):
+                stats.add_sample(rss, threads)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start_wall, start_cpu = time.perf_counter(), cpu_time()
+        with self.lock:
+            self.current = name
+        self.sample()
+        try:
+            yield
+        finally:
+            self.sample() # short phases get at least two samples
+            wall, cpu = time.perf_counter() - start_wall, cpu_time() - start_cpu
+            with self.lock:
+                for stats in self._stats(name):
+                    stats.wall += wall
+                    stats.cpu += cpu
+                self.current = "other"
+
+    def metrics(self):
+        """Per-phase metrics since the previous call, with the process peak RSS and rollout buffer size."""
+        with self.lock:
+            window, self.window = self.window, {}
+        metrics = {}
+        for phase, stats in window.items():
+            for key, value in stats.as_dict().items():
+                if key != "time" and not (phase == "other" and key == "cpu_percent"):
+                    metrics[f"{phase}_{key}"] = value
+        metrics["peak_rss_mb"] = read_process()[1] / MB
+        metrics["buffer_mb"] = self.buffer_bytes / MB
+        return metrics
+
+    def summary(self):
+        with self.lock:
+            if "other" in self.total: # whatever time and CPU is not spent in a phase
+                other = self.total["other"]
+                other.wall = other.cpu = 0
+                other.wall = time.perf_counter() - self.start_time - sum(stats.wall for stats in self.total.values())
+                other.cpu = cpu_time() - self.start_cpu - sum(stats.cpu for stats in self.total.values())
+            phases = {phase: stats.as_dict() for phase, stats in self.total.items()}
+        peak = read_process()[1]
+        return {"peak_rss_mb": peak / MB,
+                "buffer_mb": self.buffer_bytes / MB,
+                # reservation rounded up to the next GB with 20% headroom, as tmem in run-task.sh
+                "suggested_tmem_gb": math.ceil(1.2 * peak / 1024 ** 3),
+                "wall_time": time.perf_counter() - self.start_time,
+                "phases": phases}
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"\nResources: peak RSS {summary['peak_rss_mb']:.0f} MB, rollout buffers {summary['buffer_mb']:.1f} MB, "
+              f"suggested tmem={summary['suggested_tmem_gb']}G")
+        print(f"{'phase':<10}{'time (s)':>10}{'CPU %':>8}{'mean RSS (MB)':>15}{'peak RSS (MB)':>15}{'threads':>9}")
+        for phase, stats in summary["phases"].items():
+            print(f"{phase:<10}{stats['time']:>10.1f}{stats['cpu_percent']:>8.0f}{stats['mean_rss_mb']:>15.0f}"
+                  f"{stats['peak_rss_mb']:>15.0f}{stats['threads']:>9}")
@@ -4,10 +4,9 @@ import time
 import os
 import argparse
 import random
+import copy
+import json
 from datetime import datetime
-from minigrid.wrappers import FullyObsWrapper, ReseedWrapper
-from distutils.util import strtobool
-import wandb
 
 import numpy as np
 import torch
@@ -15,12 +14,18 @@ import torch.optim as optim
 #from torch.utils.tensorboard import SummaryWriter
 
 from models import MiniGridAgent
-from storage import TrajectoryCollector
+from storage import TrajectoryCollector, PipelinedCollector, ServedCollector
 from ppo import PPO
+from distributed import init_process, is_distributed, get_rank, get_world_size, broadcast_parameters, gather_stats, gather_objects, find_free_port
+from telemetry import ResourceSampler, storage_bytes, read_process
+from recording import TrajectoryRecorder, write_config
 from utils import *
 from customenvs import *
 
-def parse_args():
+# extra gym.make kwargs of the standard MiniGrid envs
+ENV_KWARGS = {"MiniGrid-FourRooms-v0": {"max_steps": 1024}}
+
+def parse_args(argv=None):
     # fmt: off
     parser = argparse.ArgumentParser()
     parser.add_argument("--exp-name", type=str, default="",
@@ -39,12 +44,30 @@ def parse_args():
         help="whether to use wandb to log metrics")
     parser.add_argument("--wandb-project", type=str, default="experiments-test")
 
+    # CPU performance arguments
+    parser.add_argument("--torch-threads", type=int, default=0,
+        help="number of intra-op threads used by torch (0 keeps the torch default)")
+    parser.add_argument("--torch-interop-threads", type=int, default=0,
+        help="number of inter-op threads used by torch (0 keeps the torch default)")
+    parser.add_argument("--bf16", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="whether to run rollout inference and the PPO forward/backward under bfloat16 autocast")
+    parser.add_argument("--channels-last", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="whether to use the channels_last memory format for the conv trunk")
+
 
     # Algorithm specific arguments
     parser.add_argument("--env-id", type=str, default=f'MiniGrid-Empty-6x6-v0',
         help="the id of the environment")
     parser.add_argument("--fully-obs", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
         help="whether to use the fully observable wrapper")
+    parser.add_argument("--rng-block-size", type=int, default=0,
+        help="if > 0, the EnergyBoxes envs draw their random numbers in blocks of this size (0 draws them one at a time)")
+    parser.add_argument("--num-layouts", type=int, default=0,
+        help="if > 0, cycle the resets through this many seeded layouts and restore them from a cache instead of regenerating them (standard MiniGrid envs)")
+    parser.add_argument("--layout-pool-size", type=int, default=0,
+        help="maximum number of cached layouts per process, once full the other layouts are regenerated (0 for num-layouts)")
+    parser.add_argument("--batched-engine", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="whether to step the envs with the array-backed batched engine (Empty, DoorKey, Crossing and FourRooms only)")
     parser.add_argument("--time-cost", type=float, default=0,
         help="value of the time cost")
     parser.add_argument("--action-cost", type=float, default=0,
@@ -93,9 +116,80 @@ def parse_args():
         help="the maximum norm for the gradient clipping")
     parser.add_argument("--target-kl", type=float, default=None,
         help="the target KL divergence threshold")
-    args = parser.parse_args()
+    parser.add_argument("--pipeline", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the next rollout is collected with a frozen copy of the policy while PPO updates on the current one")
+    parser.add_argument("--max-policy-lag", type=int, default=1,
+        help="maximum number of updates between the acting and the learning policy in pipelined mode")
+    parser.add_argument("--checkpoint-path", type=str, default="",
+        help="if set, a resumable checkpoint (weights, optimizer, timestep, rng) is saved there at the end of training")
+    parser.add_argument("--resume", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled and the checkpoint exists, training continues from it up to --total-timesteps")
+    parser.add_argument("--summary-path", type=str, default="",
+        help="if set, the final metrics (averaged over --summary-window updates) are written there as json")
+    parser.add_argument("--summary-window", type=int, default=10,
+        help="number of final updates the summary metrics are averaged over")
+    parser.add_argument("--num-ranks", type=int, default=1,
+        help="number of data-parallel learner processes (gloo backend), each owning num_envs/num_ranks envs")
+    parser.add_argument("--gumbel-sampling", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="whether to sample rollout actions by Gumbel-max with noise drawn once per rollout instead of a Categorical per step")
+    parser.add_argument("--dedup-obs", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="whether to store rollout observations as indices into a table of distinct observations and run the PPO forward pass once per distinct observation")
+    parser.add_argument("--memory-cap-mb", type=float, default=0,
+        help="if positive, rollout observations are kept as bytes on the host (in a memory-mapped file of --spill-dir when they exceed the cap) and every forward pass (chunked inference, PPO micro-batches with gradient accumulation) stays under this many MB of activations")
+    parser.add_argument("--spill-dir", type=str, default=None,
+        help="directory of the memory-mapped rollout observations with --memory-cap-mb (system temp dir by default)")
+    parser.add_argument("--record-dir", type=str, default=None,
+        help="if set, the reset seed and actions of every episode are recorded in <record-dir>/<run name> (see replay.py)")
+    parser.add_argument("--eval-interval", type=int, default=0,
+        help="if positive, the agent is evaluated greedily in a background process every this many updates")
+    parser.add_argument("--eval-episodes", type=int, default=32,
+        help="number of episodes of each background evaluation")
+    parser.add_argument("--eval-envs", type=int, default=8,
+        help="number of envs the background evaluation runs its episodes on")
+    parser.add_argument("--eval-seed", type=int, default=0,
+        help="reset seed of the first env of the background evaluation, the episodes are the same for every snapshot")
+    parser.add_argument("--eval-niceness", type=int, default=19,
+        help="niceness (CPU priority) of the background evaluation process")
+    parser.add_argument("--weight-store", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the final agent is also saved as a memory-mapped checkpoint actor_<run name>.json (see weightstore.py)")
+    parser.add_argument("--catalogue", type=str, default="",
+        help="if set, the run is registered in this SQLite run catalogue with its config, git commit, final metrics and artifacts (see catalogue.py)")
+    parser.add_argument("--encoder", type=str, default="conv", choices=["conv", "embedding"],
+        help="input layer of the agent: conv over the raw planes, or embeddings of the categorical planes (uint8 rollout observations)")
+    parser.add_argument("--telemetry", type=lambda x: bool(strtobool(x)), default=True, nargs="?", const=True,
+        help="whether to sample memory, CPU and thread usage per training phase (logged with the metrics, summarised at exit)")
+    parser.add_argument("--telemetry-interval", type=float, default=0.5,
+        help="seconds between two resource samples")
+    parser.add_argument("--inference-server", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the envs are stepped in worker processes and acted on in dynamic batches by an inference server")
+    parser.add_argument("--num-workers", type=int, default=4,
+        help="number of env worker processes with --inference-server")
+    parser.add_argument("--max-batch-size", type=int, default=0,
+        help="maximum number of envs per inference batch (0 for all envs)")
+    parser.add_argument("--max-latency-ms", type=float, default=2.0,
+        help="maximum time an inference batch waits for more requests after its first one")
+    args = parser.parse_args(argv)
     args.batch_size = int(args.num_envs * args.num_steps)
     args.minibatch_size = int(args.batch_size // args.num_minibatches)
+    if args.num_ranks > 1:
+        assert args.num_envs % args.num_ranks == 0, "num_envs must be divisible by num_ranks"
+        assert args.minibatch_size % args.num_ranks == 0, "minibatch_size must be divisible by num_ranks"
+    if args.inference_server:
+        assert args.num_envs % args.num_workers == 0, "num_envs must be divisible by num_workers"
+        assert not (args.pipeline or args.batched_engine or args.num_ranks > 1), \
+            "the inference server cannot be combined with --pipeline, --batched-engine or --num-ranks"
+    if args.num_layouts > 0:
+        assert not (args.batched_engine or args.cont_energy_wrapper or "Energy" in args.env_id), \
+            "the layout pool only supports the standard MiniGrid envs without --batched-engine"
+    if args.gumbel_sampling or args.dedup_obs:
+        assert not args.inference_server, "--gumbel-sampling and --dedup-obs are only supported by the in-process collectors"
+    if args.memory_cap_mb > 0:
+        assert not (args.dedup_obs or args.inference_server), "--memory-cap-mb is not supported with --dedup-obs or --inference-server"
+    if args.record_dir:
+        assert not args.batched_engine, "episodes of the batched engine cannot be recorded"
+    if args.batched_engine:
+        assert not (args.fully_obs or args.cont_energy_wrapper or "Energy" in args.env_id), \
+            "the batched engine only supports the partially observable standard MiniGrid envs"
     # fmt: on
     return args
 
@@ -113,33 +207,43 @@ def make_env(args, idx, run_name):
                                     goal_reward=args.box_reward)
             env = gym.wrappers.RecordEpisodeStatistics(env)
             #env = ReseedWrapper(env,  seeds=list(range(100000)), seed_idx=env_seed)
+            if args.record_dir:
+                env = TrajectoryRecorder(env, os.path.join(args.record_dir, run_name), idx, seed=env_seed)
             return env
 
 
-        if args.env_id == "MiniGrid-FourRooms-v0":
-            env = gym.make(args.env_id, max_steps=1024)
-        elif args.env_id == "EnergyBoxes":
+        if args.env_id == "EnergyBoxes":
             env = EnergyBoxesEnv(agent_start_dir="random",
                                 agent_start_pos=(1,1),
                                 time_bonus=args.time_bonus, 
                                 box_open_reward=args.box_reward,
-                                seed=env_seed)
+                                seed=env_seed,
+                                rng_block_size=args.rng_block_size)
         elif args.env_id == "EnergyBoxesHard":
             env = EnergyBoxesHardEnv(agent_start_dir="random",
                                 agent_start_pos=(1,1),
                                 time_bonus=args.time_bonus, 
                                 box_open_reward=args.box_reward,
-                                seed=env_seed)
+                                seed=env_seed,
+                                rng_block_size=args.rng_block_size)
         elif args.env_id == "EnergyBoxesDelay":
             env = EnergyBoxesDelayEnv(agent_start_dir="random",
                                 agent_start_pos="random",
                                 time_bonus=args.time_bonus, 
                                 box_open_reward=args.box_reward,
-                                seed=env_seed)
+                                seed=env_seed,
+                                rng_block_size=args.rng_block_size)
         else:
-            env = gym.make(args.env_id)
+            env = gym.make(args.env_id, **ENV_KWARGS.get(args.env_id, {}))
+            if args.num_layouts > 0:
+                # the envs are reset together, spread their offsets over the cycle so they start on distinct layouts
+                # (num_envs is per rank here, idx counts the envs of all ranks)
+                layout_stride = max(1, args.num_layouts // (args.num_envs * args.num_ranks))
+                env = LayoutPoolWrapper(env, args.num_layouts, seed_offset=args.seed + idx * layout_stride,
+                                        pool=shared_layout_pool(args.layout_pool_size or args.num_layouts))
         # get env max steps
-        if args.fully_obs: env = FullyObsWrapper(env)
+        if args.fully_obs:
+            env = IncrementalFullyObsWrapper(env)
         if "Energy" not in args.env_id:
             env = TimeCostWrapper(env, 
                                 time_cost=args.time_cost, 
@@ -148,116 +252,300 @@ def make_env(args, idx, run_name):
                                 noops_actions=[4,6])
         env = gym.wrappers.RecordEpisodeStatistics(env)
         #env = ReseedWrapper(env, seeds=list(range(100000)),seed_idx=env_seed)
+        if args.record_dir:
+            env = TrajectoryRecorder(env, os.path.join(args.record_dir, run_name), idx, seed=env_seed)
         return env
     return thunk
 
-args = parse_args()
-
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
-timestamp = datetime.now().strftime("%m%d_%H%M%S")
-if args.exp_name == "": run_name = timestamp
-else: run_name = args.exp_name
-
-num_updates = args.total_timesteps // args.batch_size
-
-# Set up vectorised environments
-print(args)
-envs = gym.vector.SyncVectorEnv(
-    [make_env(args, idx, run_name) for idx in range(args.num_envs)]
-)
-
-# Set seeds for reproducibility
-random.seed(args.seed)
-np.random.seed(args.seed)
-torch.manual_seed(args.seed)
-if args.cuda and torch.cuda.is_available():
-    torch.cuda.manual_seed(args.seed)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
-
-# Get dimension of a single transformed observation
-obs_dim = get_state_tensor(envs.reset()[0])[0].shape
-
-# Define agent
-agent = MiniGridAgent(obs_dim, envs.single_action_space.n, n_channels=4).to(device)
-
-# Define storage and ppo objects
-is_boxes_env = args.env_id in ["EnergyBoxes", "EnergyBoxesHard", "EnergyBoxesDelay"]
-storage = TrajectoryCollector(envs, obs_dim, agent, args, device, is_boxes_env=is_boxes_env)
-ppo = PPO(agent, args, device)
+def setup_torch(args):
+    """Set the torch thread pools before any parallel work is started."""
+    if args.torch_threads > 0:
+        torch.set_num_threads(args.torch_threads)
+    if args.torch_interop_threads > 0:
+        torch.set_num_interop_threads(args.torch_interop_threads)
+
+def build_training(args, run_name, rank=0):
+    """Create the vectorised environments, agent, storage and ppo objects.
+
+    In data-parallel mode `args` holds the per-rank num_envs and batch sizes
+    and rank r owns the envs r*num_envs, ..., (r+1)*num_envs-1.
+    """
+
+    device = torch.device('cuda' if args.cuda and torch.cuda.is_available() else 'cpu')
+    if args.record_dir and rank == 0:
+        write_config(os.path.join(args.record_dir, run_name), "train", args)
+
+    # Set up vectorised environments
+    if args.batched_engine:
+        from batchgrid import BatchedGridEnv
+        envs = BatchedGridEnv(args.env_id, args.num_envs,
+                              env_kwargs=ENV_KWARGS.get(args.env_id, {}),
+                              time_cost=args.time_cost,
+                              action_cost=args.action_cost,
+                              final_reward_penalty=args.final_reward_penalty,
+                              noops_actions=[4,6])
+    elif args.inference_server:
+        # the envs live in the worker processes, this one only provides the spaces
+        envs = gym.vector.SyncVectorEnv([make_env(args, 0, run_name)])
+    else:
+        envs = gym.vector.SyncVectorEnv(
+            [make_env(args, idx, run_name) for idx in range(rank * args.num_envs, (rank + 1) * args.num_envs)]
+        )
+
+    # Set seeds for reproducibility
+    random.seed(args.seed + rank)
+    np.random.seed(args.seed + rank)
+    torch.manual_seed(args.seed + rank)
+    if args.cuda and torch.cuda.is_available():
+        torch.cuda.manual_seed(args.seed + rank)
+        torch.backends.cudnn.deterministic = True
+        torch.backends.cudnn.benchmark = False
+
+    # Get dimension of a single transformed observation
+    obs_dim = get_state_tensor(envs.reset()[0])[0].shape
+
+    # Define agent
+    agent = MiniGridAgent(obs_dim, envs.single_action_space.n, n_channels=4, encoder=args.encoder).to(device)
+    if args.channels_last:
+        agent.conv.to_channels_last()
+    if is_distributed():
+        # every rank starts from the weights of rank 0
+        broadcast_parameters(agent)
+
+    # Define storage and ppo objects
+    is_boxes_env = args.env_id in ["EnergyBoxes", "EnergyBoxesHard", "EnergyBoxesDelay"]
+    if args.pipeline:
+        # collection acts with a frozen copy of the agent into a double buffer
+        storage = TrajectoryCollector(envs, obs_dim, copy.deepcopy(agent), args, device,
+                                      is_boxes_env=is_boxes_env, num_buffers=2)
+        storage = PipelinedCollector(storage, agent, max_policy_lag=args.max_policy_lag)
+    elif args.inference_server:
+        from inference_server import InferenceServer
+        server = InferenceServer([make_env(args, idx, run_name) for idx in range(args.num_envs)],
+                                 envs_per_worker=args.num_envs // args.num_workers,
+                                 max_batch_size=args.max_batch_size,
+                                 max_latency=args.max_latency_ms / 1000,
+                                 rollout_steps=args.num_steps)
+        storage = ServedCollector(server, envs, obs_dim, agent, args, device, is_boxes_env=is_boxes_env)
+    else:
+        storage = TrajectoryCollector(envs, obs_dim, agent, args, device, is_boxes_env=is_boxes_env)
+    ppo = PPO(agent, args, device)
+
+    return envs, agent, storage, ppo
+
+def rng_state():
+    return {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+
+def save_checkpoint(path, agent, ppo, storage, update):
+    """Saves everything needed to resume training after `update` updates (called on all ranks, rank 0 writes)."""
+    # every rank resumes its own sampling streams
+    rng = gather_objects(rng_state()) if is_distributed() else [rng_state()]
+    if get_rank() != 0:
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    torch.save({
+        'agent': agent.state_dict(),
+        'optimizer': ppo.optimizer.state_dict(),
+        'global_step': storage.global_step,
+        'update': update,
+        'rng': rng,
+    }, path)
+
+def load_checkpoint(path, agent, ppo, storage):
+    """Restores a checkpoint written by `save_checkpoint` and returns its update number."""
+    checkpoint = torch.load(path, map_location=next(agent.parameters()).device, weights_only=False) # holds the numpy rng state
+    agent.load_state_dict(checkpoint['agent'])
+    ppo.optimizer.load_state_dict(checkpoint['optimizer'])
+    storage.global_step = checkpoint['global_step']
+    rng = checkpoint['rng']
+    if isinstance(rng, list):
+        assert len(rng) == get_world_size(), f"the checkpoint was written by {len(rng)} ranks, resume with the same --num-ranks"
+        rng = rng[get_rank()]
+    # older checkpoints only hold the state of rank 0
+    random.setstate(rng['python'])
+    np.random.set_state(rng['numpy'])
+    torch.set_rng_state(rng['torch'])
+    return checkpoint['update']
+
+def print_eval_result(result):
+    print(f"Greedy evaluation of update {int(result['eval_update'])}: return {result['eval_return']:.3f}±{result['eval_return_std']:.3f}, "
+          f"length {result['eval_length']:.1f} ({result['eval_time']:.1f}s)")
+
+def summarise_metrics(metrics_history, window):
+    """Metrics averaged over the last `window` updates."""
+    last = metrics_history[-window:]
+    # evaluation metrics are only in the updates an evaluation result came in
+    keys = dict.fromkeys(key for m in last for key in m)
+    summary = {key: float(np.mean([m[key] for m in last if key in m])) for key in keys}
+    if last: summary["timestep"] = int(last[-1]["timestep"])
+    return summary
+
+def write_summary(path, metrics_history, window, resources=None):
+    """Writes the metrics averaged over the last `window` updates (and the run's resource usage) as json."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    summary = summarise_metrics(metrics_history, window)
+    if resources is not None: summary["resources"] = resources
+    with open(path, "w") as f:
+        json.dump(summary, f, indent=2)
+
+def run_artifacts(args, run_name):
+    """Paths of the files a run writes, recorded in the run catalogue."""
+    artifacts = {"actor": f'trained-models/{args.env_id}/actor_{run_name}.pth'}
+    if args.plot: artifacts["figure"] = f'figs/{args.env_id}/ppo_{args.env_id}_{run_name}.png'
+    if args.weight_store: artifacts["weights"] = f'trained-models/{args.env_id}/actor_{run_name}.json'
+    if args.checkpoint_path: artifacts["checkpoint"] = args.checkpoint_path
+    if args.summary_path: artifacts["summary"] = args.summary_path
+    if args.record_dir: artifacts["trajectories"] = os.path.join(args.record_dir, run_name)
+    return artifacts
+
+def run(rank, args, run_name, port=None):
+    """Training loop of a single process, rank 0 handles metrics and checkpoints."""
+
+    num_updates = args.total_timesteps // args.batch_size
+
+    if args.num_ranks > 1:
+        init_process(rank, args.num_ranks, port)
+        # each rank owns a slice of the envs and of every (mini)batch
+        args = copy.copy(args)
+        args.num_envs //= args.num_ranks
+        args.batch_size //= args.num_ranks
+        args.minibatch_size //= args.num_ranks
+        if args.torch_threads == 0:
+            args.torch_threads = max(1, os.cpu_count() // args.num_ranks)
+        if rank > 0:
+            args.verbose, args.plot, args.wandb = False, False, False
+    setup_torch(args)
+
+    if rank == 0: print(args)
+    envs, agent, storage, ppo = build_training(args, run_name, rank=rank)
+    is_boxes_env = storage.is_boxes_env
+
+    os.makedirs(f'trained-models/{args.env_id}', exist_ok=True)
+    os.makedirs(f'figs/{args.env_id}', exist_ok=True)
 
-os.makedirs(f'trained-models/{args.env_id}', exist_ok=True)
-os.makedirs(f'figs/{args.env_id}', exist_ok=True)
+    if args.wandb:
+        import wandb # imported lazily, only needed with --wandb
+        if is_boxes_env: 
+            env_type = "Boxes"
+        else:
+            env_type = args.env_id.split('-')[1]
+        if args.resume:
+            # continue the wandb run of the checkpoint, total_timesteps differs between budgets
+            wandb.init(project=args.wandb_project, entity="nauqs", name=run_name, id=run_name, resume="allow")
+            wandb.config.update(args, allow_val_change=True)
+        else:
+            wandb.init(project=args.wandb_project, 
+                       entity="nauqs",
+                       name=run_name, 
+                       config=args)
+        wandb.config.update({"env_type": env_type})
 
-if args.wandb:
+    timestep_history, return_history, length_history = [], [], []
     if is_boxes_env: 
-        env_type = "Boxes"
-    else:
-        env_type = args.env_id.split('-')[1]
-    wandb.init(project=args.wandb_project, 
-               entity="nauqs",
-               name=run_name, 
-               config=args)
-    wandb.config.update({"env_type": env_type})
-
-timestep_history, return_history, length_history = [], [], []
-if is_boxes_env: 
-    cumulative_eat_counts = 0
-    cumulative_red_counts = 0
-    cumulative_blue_counts = 0
-    cumulative_agent_distances = 0
-
-# Run training algorithm
-print("Start training...")
-for update in range(1, num_updates+1):
-
-    # Collect trajectories
-    batch, stats = storage.collect_trajectories()
-
-    # Update PPO agents (actor and critic)
-    # TODO: return info (actor/critic loss, KL...)
-    # TODO: lr annealing / schedule?
-    ppo.update_ppo_agent(batch, save_path=f'trained-models/{args.env_id}/actor_{run_name}.pth')
-
-    # Unifinished episodes
-    if not is_boxes_env:
-        if len(stats['episode_returns'])==0: 
-            stats['episode_returns'] = np.array([0])
-        if len(stats['episode_lengths'])==0:
-            stats['episode_lengths'] = np.array([args.num_steps])
-        if len(stats['episode_timesteps'])==0:
-            stats['episode_timesteps'] = np.array([stats['initial_timestep']])
-        
-    # Print stats
-    if args.verbose:
-        print(f"\nTimestep: {stats['initial_timestep']}")
-        if len(stats['episode_returns'])>0:
-            # print stats with mean and std and 3 decimals
-            print(f"Episodic return: {stats['episode_returns'].mean():.3f}±{stats['episode_returns'].std():.3f}")
-            print(f"Episodic length: {stats['episode_lengths'].mean():.3f}±{stats['episode_lengths'].std():.3f}")
-            if is_boxes_env: 
-                print(f"Eat counts: {stats['eat_counts'].mean():.3f}±{stats['eat_counts'].std():.3f} "
-                    f"(R {stats['red_counts'].mean():.2f} "
-                    f"B {stats['blue_counts'].mean():.2f})")
-                print(f"Agent distances: {stats['agent_distances'].mean():.3f}±{stats['agent_distances'].std():.3f}")
-                #print(f"Consecutive boxes: {stats['consecutive_boxes'].mean():.3f}±{stats['consecutive_boxes'].std():.3f}")
-                print(f"Mix rate: {stats['mix_rate'].mean():.3f}±{stats['mix_rate'].std():.3f}")
-
-    # Plot stats
-    if args.plot:
-
-        timestep_history.append(stats['initial_timestep'])
-        return_history.append((stats['episode_returns'].mean(), stats['episode_returns'].std()))
-        length_history.append((stats['episode_lengths'].mean(), stats['episode_lengths'].std()))
-
-        plot_logs(timestep_history, return_history, length_history, update,
-            smooth=True,
-            title=f'{args.env_id}',
-            save_path=f'figs/{args.env_id}/ppo_{args.env_id}_{run_name}.png')
-        
-    # Log metrics to wandb
-    if args.wandb:
+        cumulative_eat_counts = 0
+        cumulative_red_counts = 0
+        cumulative_blue_counts = 0
+        cumulative_agent_distances = 0
+
+    # Resume from a previous (shorter) run of the same configuration
+    start_update = 1
+    if args.resume and args.checkpoint_path and os.path.exists(args.checkpoint_path):
+        start_update = load_checkpoint(args.checkpoint_path, agent, ppo, storage) + 1
+        if rank == 0: print(f"Resuming from {args.checkpoint_path} at timestep {storage.global_step}")
+    update = start_update - 1
+
+    evaluator = None
+    if args.eval_interval > 0 and rank == 0:
+        from async_eval import AsyncEvaluator
+        evaluator = AsyncEvaluator(args, run_name, agent.obs_dim, envs.single_action_space.n)
+
+    sampler = ResourceSampler(args.telemetry_interval, enabled=args.telemetry).start()
+    sampler.buffer_bytes = storage_bytes(storage)
+
+    # Run training algorithm
+    if rank == 0: print("Start training...")
+    start_time = time.time()
+    start_step = storage.global_step
+    policy_lags, metrics_history = [], []
+    for update in range(start_update, num_updates+1):
+
+        # Collect trajectories
+        with sampler.phase("collect"):
+            batch, stats = storage.collect_trajectories()
+
+        # Update PPO agents (actor and critic)
+        # TODO: return info (actor/critic loss, KL...)
+        # TODO: lr annealing / schedule?
+        with sampler.phase("update"):
+            ppo.update_ppo_agent(batch, save_path=f'trained-models/{args.env_id}/actor_{run_name}.pth')
+        if args.num_ranks > 1:
+            stats = gather_stats(stats)
+        sps = int((stats['final_timestep'] - start_step) / (time.time() - start_time))
+        if args.pipeline: policy_lags.append(stats['policy_lag'])
+        if evaluator is not None and update % args.eval_interval == 0:
+            evaluator.submit(update, storage.global_step, agent)
+        eval_results = evaluator.poll() if evaluator is not None else []
+
+        # Unifinished episodes
+        if not is_boxes_env:
+            if len(stats['episode_returns'])==0: 
+                stats['episode_returns'] = np.array([0])
+            if len(stats['episode_lengths'])==0:
+                stats['episode_lengths'] = np.array([args.num_steps])
+            if len(stats['episode_timesteps'])==0:
+                stats['episode_timesteps'] = np.array([stats['initial_timestep']])
+            
+        # Print stats
+        if args.verbose:
+            print(f"\nTimestep: {stats['initial_timestep']} (SPS: {sps})")
+            if args.pipeline:
+                print(f"Policy lag: {stats['policy_lag']}, collect time: {stats['collect_time']:.2f}s, "
+                      f"learner wait: {stats['wait_time']:.2f}s")
+            if args.telemetry:
+                print(f"Peak RSS: {read_process()[1] / 2**20:.0f} MB, rollout buffers: {sampler.buffer_bytes / 2**20:.1f} MB")
+            if args.dedup_obs:
+                print(f"Distinct observations: {stats['unique_obs']} of {args.num_steps * args.num_envs}")
+            for result in eval_results:
+                print_eval_result(result)
+            if args.inference_server:
+                print(f"Inference batch size: {stats['inference_batch_size']:.1f} envs, "
+                      f"queue depth: {stats['inference_queue_depth']:.1f}")
+            if len(stats['episode_returns'])>0:
+                # print stats with mean and std and 3 decimals
+                print(f"Episodic return: {stats['episode_returns'].mean():.3f}±{stats['episode_returns'].std():.3f}")
+                print(f"Episodic length: {stats['episode_lengths'].mean():.3f}±{stats['episode_lengths'].std():.3f}")
+                if is_boxes_env: 
+                    print(f"Eat counts: {stats['eat_counts'].mean():.3f}±{stats['eat_counts'].std():.3f} "
+                        f"(R {stats['red_counts'].mean():.2f} "
+                        f"B {stats['blue_counts'].mean():.2f})")
+                    print(f"Agent distances: {stats['agent_distances'].mean():.3f}±{stats['agent_distances'].std():.3f}")
+                    #print(f"Consecutive boxes: {stats['consecutive_boxes'].mean():.3f}±{stats['consecutive_boxes'].std():.3f}")
+                    print(f"Mix rate: {stats['mix_rate'].mean():.3f}±{stats['mix_rate'].std():.3f}")
+
+        # Plot stats
+        if args.plot:
+
+            timestep_history.append(stats['initial_timestep'])
+            return_history.append((stats['episode_returns'].mean(), stats['episode_returns'].std()))
+            length_history.append((stats['episode_lengths'].mean(), stats['episode_lengths'].std()))
+
+            plot_logs(timestep_history, return_history, length_history, update,
+                smooth=True,
+                title=f'{args.env_id}',
+                save_path=f'figs/{args.env_id}/ppo_{args.env_id}_{run_name}.png')
+            
+        # Collect metrics
+        pipeline_metrics = {}
+        if args.pipeline:
+            pipeline_metrics = {"policy_lag": stats['policy_lag'],
+                                "collect_time": stats['collect_time'],
+                                "learner_wait_time": stats['wait_time']}
+        if args.inference_server:
+            pipeline_metrics = {"inference_batch_size": stats['inference_batch_size'],
+                                "inference_queue_depth": stats['inference_queue_depth']}
+        if args.dedup_obs:
+            pipeline_metrics["unique_obs"] = stats['unique_obs']
+        resource_metrics = sampler.metrics() if args.telemetry else {}
         if is_boxes_env:
             cumulative_eat_counts += stats['eat_counts'].sum()
             cumulative_red_counts += stats['red_counts'].sum()
@@ -265,7 +553,7 @@ for update in range(1, num_updates+1):
             cumulative_agent_distances += stats['agent_distances'].sum()
             cumulative_consecutive_boxes = stats['consecutive_boxes'].sum()
 
-            wandb.log({
+            metrics = {
                 "average_return": stats['episode_returns'].mean(),
                 "average_length": stats['episode_lengths'].mean(),
                 "average_eat_count": stats['eat_counts'].mean(),
@@ -280,24 +568,97 @@ for update in range(1, num_updates+1):
                 "cumulative_consecutive_boxes": cumulative_consecutive_boxes,
                 "average_mix_rate": stats['mix_rate'].mean(),
                 "timestep": stats['initial_timestep'],
-            })
+                "sps": sps,
+                **pipeline_metrics,
+                **resource_metrics
+            }
         else:
             extra_metrics = {}
             if args.cont_energy_wrapper:
                 extra_metrics["goal_counts"] = stats['goal_counts'].mean()
                 extra_metrics["subepisode_length"] = (stats['goal_counts'] / stats['episode_lengths']).mean()
-            wandb.log({
+            metrics = {
                 "average_return": stats['episode_returns'].mean(),
                 "average_length": stats['episode_lengths'].mean(),
                 "success_rate": (stats['episode_returns'] > 0).astype(int).mean(),
                 "timestep": stats['initial_timestep'],
+                "sps": sps,
+                **pipeline_metrics,
+                **resource_metrics,
                 **extra_metrics
-            })
-        for i in range(len(stats['episode_returns'])):
-            wandb.log({
-                "episode_timestep": stats['episode_timesteps'][i],
-                "episode_return": stats['episode_returns'][i],
-                "episode_length": stats['episode_lengths'][i],
-            })
-
+            }
+        if eval_results: # the results of older snapshots, if any, are logged on their own
+            metrics.update(eval_results[-1])
+        metrics_history.append(metrics)
+
+        # Log metrics to wandb
+        if args.wandb:
+            for result in eval_results[:-1]:
+                wandb.log(result)
+            wandb.log(metrics)
+            for i in range(len(stats['episode_returns'])):
+                wandb.log({
+                    "episode_timestep": stats['episode_timesteps'][i],
+                    "episode_return": stats['episode_returns'][i],
+                    "episode_length": stats['episode_lengths'][i],
+                })
+
+    if args.pipeline:
+        # wait for the rollout collected in the background, it must not run during checkpointing
+        storage.close()
+    if evaluator is not None:
+        # results of the snapshots still queued, the last one evaluates the final agent
+        if update % args.eval_interval != 0:
+            evaluator.submit(update, storage.global_step, agent)
+        for result in evaluator.close():
+            if args.verbose: print_eval_result(result)
+            if args.wandb: wandb.log(result)
+            if metrics_history: metrics_history[-1].update(result)
+        if args.verbose: print(f"Background evaluations: {evaluator.submitted} snapshots, {evaluator.dropped} dropped while busy")
+    sampler.stop()
+    if args.telemetry and rank == 0:
+        sampler.print_summary()
+    if args.checkpoint_path:
+        save_checkpoint(args.checkpoint_path, agent, ppo, storage, update)
+    if args.weight_store and rank == 0:
+        from weightstore import save_weights
+        save_weights(agent, f'trained-models/{args.env_id}/actor_{run_name}.json', config=vars(args))
+    if args.summary_path and rank == 0 and metrics_history:
+        write_summary(args.summary_path, metrics_history, args.summary_window,
+                      resources=sampler.summary() if args.telemetry else None)
+    if args.catalogue and rank == 0:
+        from catalogue import update_catalogue
+        update_catalogue(args.catalogue, "finish_run", run_name, summarise_metrics(metrics_history, args.summary_window))
+
+    if args.pipeline:
+        if rank == 0:
+            print(f"\nPipelined training: {sps} SPS, policy lag {np.mean(policy_lags):.2f} (max {np.max(policy_lags)})")
+    if args.inference_server:
+        storage.close()
+        print()
+        storage.server.print_histograms()
+    if args.num_ranks > 1:
+        torch.distributed.destroy_process_group()
+
+def main():
+    args = parse_args()
+
+    timestamp = datetime.now().strftime("%m%d_%H%M%S")
+    if args.exp_name == "": run_name = timestamp
+    else: run_name = args.exp_name
+
+    if args.catalogue:
+        from catalogue import update_catalogue
+        update_catalogue(args.catalogue, "register_run", run_name, args, artifacts=run_artifacts(args, run_name))
+
+    try:
+        if args.num_ranks > 1:
+            torch.multiprocessing.spawn(run, args=(args, run_name, find_free_port()), nprocs=args.num_ranks)
+        else:
+            run(0, args, run_name)
+    except BaseException:
+        if args.catalogue: update_catalogue(args.catalogue, "finish_run", run_name, status="failed")
+        raise
 
+if __name__ == "__main__":
+    main()
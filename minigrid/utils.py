@@ -1,8 +1,20 @@
 import numpy as np
 import torch
-import matplotlib.pyplot as plt
 import gymnasium as gym
 import time
+import copy
+
+def strtobool(val):
+    """Convert a string representation of truth to True or False.
+
+    Drop-in for the deprecated `distutils.util.strtobool`, which is slow to import.
+    """
+    val = val.lower()
+    if val in ('y', 'yes', 't', 'true', 'on', '1'):
+        return True
+    elif val in ('n', 'no', 'f', 'false', 'off', '0'):
+        return False
+    raise ValueError(f"invalid truth value {val!r}")
 
 def get_state_tensor(state, cnn=True):
     if cnn:
@@ -16,7 +28,12 @@ def get_state_tensor(state, cnn=True):
     else:
         return torch.tensor(state['image'], dtype=torch.float32)
 
+def autocast(args, device):
+    """bfloat16 autocast context for agent forward passes, a no-op unless --bf16 is set."""
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=args.bf16)
+
 def plot_logs(timesteps, rewards, episode_lengths, step, smooth=True, title="ppo", save_path="ppo.png"):
+    import matplotlib.pyplot as plt # imported lazily, only needed with --plot
     # plot both rewards and episode lengths in same figure, but different scales
     alpha_non_smoothed, n_smooth = 1, 5
     rewards, rewards_std = np.array(rewards).T
@@ -130,3 +147,161 @@ class ContEnergyWrapper(gym.Wrapper):
         reward += self.time_bonus
 
         return obs, reward, terminated, truncated, info
+
+
+class IncrementalFullyObsWrapper(gym.ObservationWrapper):
+    """
+    Same observations as minigrid's FullyObsWrapper, but the encoded grid is kept
+    between steps and only the cells a step can change are re-encoded: the previous
+    and new agent cells, the cell in front of the agent before the step (pickup, drop,
+    toggle), the previous and new cells of the movable objects (e.g. the obstacles of
+    DynamicObstacles, which move on their own) and the boxes of the EnergyBoxes envs
+    (`box_positions`). The whole grid is re-encoded when the env creates a new one (reset).
+    """
+
+    MOVABLE = ("ball", "box", "key")
+
+    def __init__(self, env):
+        super().__init__(env)
+        from minigrid.core.constants import OBJECT_TO_IDX, COLOR_TO_IDX # imported lazily, as minigrid.wrappers was
+        self.empty = np.array([OBJECT_TO_IDX["empty"], 0, 0], dtype=np.uint8)
+        self.agent = np.array([OBJECT_TO_IDX["agent"], COLOR_TO_IDX["red"], 0], dtype=np.uint8)
+
+        new_image_space = gym.spaces.Box(
+            low=0,
+            high=255,
+            shape=(self.env.unwrapped.width, self.env.unwrapped.height, 3),
+            dtype="uint8",
+        )
+        self.observation_space = gym.spaces.Dict(
+            {**self.observation_space.spaces, "image": new_image_space}
+        )
+        self.grid, self.full_grid, self.agent_pos, self.dirty = None, None, None, []
+        self.movables, self.movable_pos = [], []
+
+    def reset(self, **kwargs):
+        self.grid = None
+        return super().reset(**kwargs)
+
+    def step(self, action):
+        # the action can only change the cell in front of the agent
+        self.dirty = [tuple(self.env.unwrapped.front_pos)]
+        return super().step(action)
+
+    def encode_cell(self, x, y):
+        grid = self.unwrapped.grid
+        if 0 <= x < grid.width and 0 <= y < grid.height:
+            cell = grid.get(x, y)
+            self.full_grid[x, y] = self.empty if cell is None else cell.encode()
+
+    def observation(self, obs):
+        env = self.unwrapped
+        if env.grid is not self.grid:
+            self.grid = env.grid
+            self.full_grid = env.grid.encode()
+            self.movables = [obj for obj in env.grid.grid if obj is not None and obj.type in self.MOVABLE]
+        else:
+            for pos in [self.agent_pos] + self.dirty + self.movable_pos + list(getattr(env, 'box_positions', [])):
+                self.encode_cell(*pos)
+        self.dirty = []
+        # objects are moved with place_obj/put_obj, which update their cur_pos
+        self.movable_pos = [tuple(obj.cur_pos) for obj in self.movables if obj.cur_pos is not None]
+        for pos in self.movable_pos:
+            self.encode_cell(*pos)
+
+        self.agent_pos = tuple(env.agent_pos)
+        self.full_grid[self.agent_pos] = self.agent
+        self.full_grid[self.agent_pos + (2,)] = env.agent_dir
+
+        return {**obs, "image": self.full_grid.copy()}
+
+
+class LayoutPool:
+    """
+    Cache of generated layouts keyed by (env id, seed), shared by the envs of a process.
+    The resets cycle through the seeds, so an LRU cache smaller than the cycle would
+    evict every layout before its next use: once full, the pool keeps the layouts it
+    holds and the others are regenerated on every reset.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.layouts = {}
+        self.hits, self.misses = 0, 0
+
+    def get(self, key):
+        layout = self.layouts.get(key)
+        if layout is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return layout
+
+    def put(self, key, layout):
+        if len(self.layouts) < self.max_size:
+            self.layouts[key] = layout
+
+_layout_pools = {}
+
+def shared_layout_pool(max_size):
+    """The LayoutPool of this process with the given size (one per process, env worker processes have their own)."""
+    if max_size not in _layout_pools:
+        _layout_pools[max_size] = LayoutPool(max_size)
+    return _layout_pools[max_size]
+
+
+class LayoutPoolWrapper(gym.Wrapper):
+    """
+    Cycles the resets through the seeds 0..num_layouts-1 (starting at `seed_offset`,
+    as minigrid's ReseedWrapper) and caches the layout `_gen_grid` generates for each
+    seed. A cached layout is restored by copying the grid cell list, the agent start
+    state and the rng state right after generation (the env is not reseeded), so
+    episodes are the same as with a regenerated grid. Only the objects an episode can
+    change (doors, keys, balls, boxes) are copied, walls, goals and lava are shared
+    between the restored grids.
+    """
+
+    MUTABLE = ("door", "key", "ball", "box")
+
+    def __init__(self, env, num_layouts, seed_offset=0, pool=None):
+        super().__init__(env)
+        self.seeds = range(num_layouts)
+        self.seed_idx = seed_offset % num_layouts
+        self.pool = pool if pool is not None else LayoutPool(num_layouts)
+        self.env_id = self.unwrapped.spec.id if self.unwrapped.spec is not None else type(self.unwrapped).__name__
+        self.key, self.layout = None, None
+        self.generate = self.unwrapped._gen_grid
+        # MiniGridEnv.reset calls self._gen_grid, the instance attribute takes precedence over the method
+        self.unwrapped._gen_grid = self._gen_grid
+
+    def next_seed(self):
+        """Seed of the next layout of the cycle, used by the resets without a seed."""
+        seed = self.seeds[self.seed_idx]
+        self.seed_idx = (self.seed_idx + 1) % len(self.seeds)
+        return seed
+
+    def reset(self, *, seed=None, options=None):
+        if seed is None:
+            seed = self.next_seed()
+        self.key = (self.env_id, seed)
+        self.layout = self.pool.get(self.key)
+        # seeding is only needed to generate a new layout, a restored one sets the rng state
+        return self.env.reset(seed=seed if self.layout is None else None, options=options)
+
+    def _gen_grid(self, width, height):
+        env = self.unwrapped
+        if self.layout is None:
+            self.generate(width, height)
+            mutable = [(i, obj) for i, obj in enumerate(env.grid.grid) if obj is not None and obj.type in self.MUTABLE]
+            self.layout = (env.grid, mutable, copy.copy(env.agent_pos), env.agent_dir, env.mission,
+                           env.np_random.bit_generator.state)
+            self.pool.put(self.key, self.layout)
+        # the episode plays on a copy of the stored grid
+        grid, mutable, agent_pos, agent_dir, mission, rng_state = self.layout
+        env.grid = copy.copy(grid)
+        env.grid.grid = grid.grid.copy()
+        for i, obj in mutable:
+            # boxes hold their contents
+            env.grid.grid[i] = copy.deepcopy(obj) if obj.type == "box" else copy.copy(obj)
+        env.agent_pos, env.agent_dir, env.mission = copy.copy(agent_pos), agent_dir, mission
+        env.np_random.bit_generator.state = rng_state
@@ -0,0 +1,173 @@
+"""
+Memory-mapped checkpoints of trained agents.
+
+A checkpoint is a small JSON header next to the usual pickled agent,
+`trained-models/<env-id>/actor_<name>.json`, with the agent architecture, the run config
+and the name, dtype, shape and offset of every tensor of its state dict. The tensors are
+stored back to back in a flat blob named after the sha256 of its content,
+`trained-models/blobs/<sha256>.bin`, so identical weights are only stored once.
+
+Loading a checkpoint reads the header and memory-maps the blob: nothing is unpickled and
+the weights are only read from disk when used. Existing `.pth` agents are converted with
+
+    python weightstore.py convert trained-models/*/actor_*.pth
+    python weightstore.py info trained-models/EnergyBoxes/actor_<name>.json
+    python weightstore.py gc    # removes the blobs no header refers to
+"""
+import os
+import glob
+import json
+import hashlib
+import argparse
+import numpy as np
+import torch
+
+FORMAT_VERSION = 1
+ALIGNMENT = 64 # byte alignment of the tensors in a blob
+
+
+def blob_dir(header_path):
+    """trained-models/blobs, for a header in trained-models/<env-id>/."""
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(header_path))), "blobs")
+
+def agent_architecture(agent):
+    """MiniGridAgent constructor arguments of `agent` (older pickled agents have no obs_dim attribute)."""
+    from models import EmbeddingConvBase
+    embedding = isinstance(agent.conv, EmbeddingConvBase)
+    return {"obs_dim": [int(d) for d in getattr(agent, "obs_dim", (4, 7, 7))],
+            "action_dim": int(agent.actor[-1].out_features),
+            "n_channels": len(agent.conv.VOCAB_SIZES) if embedding else int(agent.conv.conv1.in_channels),
+            "encoder": "embedding" if embedding else "conv"}
+
+def save_weights(agent, path, config=None):
+    """Writes the header `path` and, unless an identical one exists, the blob of the agent weights."""
+    tensors, chunks, offset = [], [], 0
+    for name, tensor in agent.state_dict().items():
+        array = tensor.detach().cpu().contiguous().numpy()
+        padding = -offset % ALIGNMENT
+        chunks += [b"\0" * padding, array.tobytes()]
+        offset += padding
+        tensors.append({"name": name, "dtype": array.dtype.str, "shape": list(array.shape), "offset": offset})
+        offset += array.nbytes
+    data = b"".join(chunks)
+    digest = hashlib.sha256(data).hexdigest()
+
+    blob_path = os.path.join(blob_dir(path), f"{digest}.bin")
+    if not os.path.exists(blob_path):
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        with open(blob_path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(blob_path + ".tmp", blob_path)
+
+    header = {"format": FORMAT_VERSION, "architecture": agent_architecture(agent), "config": config or {},
+              "blob": digest, "size": len(data), "tensors": tensors}
+    with open(path + ".tmp", "w") as f:
+        json.dump(header, f, indent=1, default=str)
+    os.replace(path + ".tmp", path)
+    return digest
+
+def read_header(path):
+    with open(path) as f:
+        header = json.load(f)
+    assert header["format"] == FORMAT_VERSION, f"unsupported checkpoint format {header['format']}"
+    return header
+
+def load_state_dict(path, header=None):
+    """State dict of the checkpoint `path` as tensors backed by the memory-mapped blob (copy on write)."""
+    header = header or read_header(path)
+    blob = np.memmap(os.path.join(blob_dir(path), f"{header['blob']}.bin"), dtype=np.uint8, mode="c")
+    state_dict = {}
+    for tensor in header["tensors"]:
+        dtype = np.dtype(tensor["dtype"])
+        count = int(np.prod(tensor["shape"]))
+        array = blob[tensor["offset"]:tensor["offset"] + count * dtype.itemsize].view(dtype).reshape(tensor["shape"])
+        state_dict[tensor["name"]] = torch.from_numpy(array)
+    return state_dict
+
+def empty_agent(architecture):
+    """MiniGridAgent of `architecture` with parameters on the meta device (no memory, no initialisation)."""
+    from models import MiniGridAgent
+    with torch.device("meta"):
+        return MiniGridAgent(architecture["obs_dim"], architecture["action_dim"],
+                             n_channels=architecture["n_channels"], encoder=architecture["encoder"])
+
+def load_agent(path, device=torch.device("cpu")):
+    """MiniGridAgent of the checkpoint `path`, its parameters are the memory-mapped tensors on CPU."""
+    header = read_header(path)
+    agent = empty_agent(header["architecture"])
+    agent.load_state_dict(load_state_dict(path, header), assign=True)
+    return agent.to(device).eval()
+
+_templates = {} # one weightless agent per architecture, shared by the checkpoints loaded with load_forward
+
+def load_forward(path, device=torch.device("cpu")):
+    """
+    Inference forward (observations to (logits, value)) of the checkpoint `path`, without
+    building an agent: the memory-mapped weights are passed to a shared weightless agent.
+    Faster than load_agent when many agents are loaded.
+    """
+    header = read_header(path)
+    key = json.dumps(header["architecture"], sort_keys=True)
+    if key not in _templates:
+        _templates[key] = empty_agent(header["architecture"]).eval()
+    template, state_dict = _templates[key], load_state_dict(path, header)
+    if device.type != "cpu":
+        state_dict = {name: tensor.to(device) for name, tensor in state_dict.items()}
+    return lambda x: torch.func.functional_call(template, state_dict, (x,))
+
+def convert(pth_path):
+    """Writes the checkpoint of a pickled agent next to it, returns the header path and blob digest."""
+    agent = torch.load(pth_path, map_location="cpu", weights_only=False)
+    path = os.path.splitext(pth_path)[0] + ".json"
+    return path, save_weights(agent, path, config={"converted_from": os.path.basename(pth_path)})
+
+def agent_paths(model_dir, names=None):
+    """
+    Checkpoint of every agent of `model_dir` (or of the agents `names`), the .json header
+    when the agent has been converted and the pickled .pth otherwise.
+    """
+    if names is None:
+        names = sorted({os.path.splitext(os.path.basename(path))[0][len("actor_"):]
+                        for path in glob.glob(os.path.join(model_dir, "actor_*.pth")) + glob.glob(os.path.join(model_dir, "actor_*.json"))})
+    paths = []
+    for name in names:
+        path = os.path.join(model_dir, f"actor_{name}.json")
+        paths.append(path if os.path.exists(path) else os.path.join(model_dir, f"actor_{name}.pth"))
+    return paths
+
+def collect_garbage(models_dir="trained-models"):
+    """Removes the blobs no header of `models_dir` refers to, returns the number of bytes freed."""
+    referenced = {read_header(path)["blob"] for path in glob.glob(os.path.join(models_dir, "*", "actor_*.json"))}
+    freed = 0
+    for blob_path in glob.glob(os.path.join(models_dir, "blobs", "*.bin")):
+        if os.path.basename(blob_path)[:-len(".bin")] not in referenced:
+            freed += os.path.getsize(blob_path)
+            os.remove(blob_path)
+    return freed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory-mapped agent checkpoints")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert_parser = subparsers.add_parser("convert", help="convert pickled .pth agents")
+    convert_parser.add_argument("paths", type=str, nargs="+")
+    info_parser = subparsers.add_parser("info", help="print the header of checkpoints")
+    info_parser.add_argument("paths", type=str, nargs="+")
+    gc_parser = subparsers.add_parser("gc", help="remove unreferenced blobs")
+    gc_parser.add_argument("--models-dir", type=str, default="trained-models")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        digests = set()
+        for pth_path in args.paths:
+            path, digest = convert(pth_path)
+            digests.add(digest)
+            print(f"{pth_path} -> {path} (blob {digest[:12]})")
+        print(f"Converted {len(args.paths)} agents, {len(digests)} distinct blobs")
+    elif args.command == "info":
+        for path in args.paths:
+            header = read_header(path)
+            print(f"{path}: {header['architecture']}, blob {header['blob'][:12]} ({header['size'] / 1024:.0f} KB, "
+                  f"{len(header['tensors'])} tensors), config {header['config']}")
+    elif args.command == "gc":
+        print(f"Freed {collect_garbage(args.models_dir) / 1024 ** 2:.1f} MB")